@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark the coadd_query entry points (image queries, zeropoint, blacklist, ancillary
+queries and the *_to_LLD conversions) against synthetic DES databases (see
+mepipelineappintg.synthetic_des) at several scales.  Wall time, row counts, Python
+allocations (tracemalloc) and peak RSS are recorded to JSON, and a run can be compared
+against a stored baseline to flag regressions.
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import time
+import tracemalloc
+
+from mepipelineappintg.sqlite_dbi import SqliteDbi
+import mepipelineappintg.synthetic_des as sd
+import mepipelineappintg.coadd_query as cq
+
+verbose = 0
+
+SE_TAG = 'Y6A1_FINALCUT'
+ME_TAG = 'Y6A1_COADD'
+PIFF_TAG = 'Y6A1_PIFF'
+ARCHIVE = 'desar2home'
+SCHEMA = 'des_admin.'
+ANC_TYPES = ['red_bkg', 'red_segmap', 'psfex_model', 'piff_model', 'coadd_head_scamp', 'cat_finalcut']
+
+
+######################################################################################
+def open_fixture(nexp, ntile, seed, dbdir=None, verbose=0):
+    """ Open (creating when needed) the synthetic database for a given scale.
+
+        Inputs:
+            nexp:       Number of exposures per band
+            ntile:      Number of tiles along RA and Dec
+            seed:       Random seed
+            dbdir:      Directory in which fixture databases are kept (None gives in-memory databases)
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            dbh:        Database connection (SqliteDbi)
+            Ctx:        Dict of the values needed by the benchmarks (tilename, attempt ID, ...)
+    """
+    dbfile = None
+    if dbdir is not None:
+        os.makedirs(dbdir, exist_ok=True)
+        dbfile = os.path.join(dbdir, f"synthetic_nexp{nexp:d}_ntile{ntile:d}_seed{seed:d}.db")
+    exists = dbfile is not None and os.path.isfile(dbfile)
+    dbh = SqliteDbi(dbfile, verbose=max(verbose - 1, 0))
+    if not exists:
+        sd.make_synthetic_des(dbh, ntile_ra=ntile, ntile_dec=ntile, nexp=nexp, se_tag=SE_TAG, me_tag=ME_TAG,
+                              piff_tag=PIFF_TAG, archive_name=ARCHIVE, seed=seed, verbose=max(verbose - 1, 0))
+
+    curDB = dbh.cursor()
+    curDB.execute("select tilename from coaddtile_geom order by id")
+    tilename = curDB.fetchone()[0]
+    curDB.execute(f"""select av.pfw_attempt_id from pfw_attempt_val av, proctag t
+        where av.key='tilename' and av.val='{tilename:s}' and av.pfw_attempt_id=t.pfw_attempt_id and t.tag='{ME_TAG:s}'""")
+    attemptID = curDB.fetchone()[0]
+    curDB.execute("select count(*) from image where filetype='red_immask'")
+    nimage = curDB.fetchone()[0]
+    curDB.close()
+    Ctx = {'tilename': tilename, 'attemptID': attemptID, 'nimage': nimage}
+
+    return dbh, Ctx
+
+
+######################################################################################
+def bench_steps(dbh, Ctx):
+    """ Form the list of benchmarks (name, callable) in the order they are run.  Each callable
+        returns the number of rows/records it produced.  Steps that feed later steps store their
+        results in Ctx.
+    """
+    Zpt = {'table': f"{SCHEMA:s}zeropoint", 'source': 'FGCM', 'version': 'v2.0', 'flag': '16'}
+    Blacklist = {'table': f"{SCHEMA:s}blacklist"}
+
+    def edges():
+        Ctx['ImgDict'] = cq.query_coadd_img_by_edges({}, Ctx['tilename'], SE_TAG, sd.BandList, ARCHIVE, dbh, SCHEMA)
+        return len(Ctx['ImgDict'])
+
+    def fiat():
+        return len(cq.query_coadd_img_by_fiat({}, Ctx['tilename'], SE_TAG, sd.BandList, ARCHIVE,
+                                              f"{SCHEMA:s}fiat_tile_input", dbh, SCHEMA))
+
+    def from_attempt():
+        return len(cq.query_coadd_img_from_attempt({}, Ctx['attemptID'], sd.BandList, ARCHIVE, dbh, SCHEMA))
+
+    def zeropoint():
+        Ctx['ZptDict'] = cq.query_zeropoint(dict(Ctx['ImgDict']), Zpt, None, dbh, SCHEMA)
+        return len(Ctx['ZptDict'])
+
+    def zeropoint_single():
+        return len(cq.query_zeropoint(dict(Ctx['ImgDict']), Zpt, None, dbh, SCHEMA, SingleQuery=True))
+
+    def blacklist():
+        Ctx['BlDict'] = cq.query_blacklist(dict(Ctx['ZptDict']), Blacklist, dbh, SCHEMA)
+        return len(Ctx['BlDict'])
+
+    def ancillary():
+        Ctx['AncDict'] = cq.query_ancillary(Ctx['BlDict'], ANC_TYPES, ARCHIVE, dbh, SCHEMA,
+                                            attemptID=Ctx['attemptID'], PIFFtag=PIFF_TAG)
+        return sum([len(AncDict) for AncDict in Ctx['AncDict'].values()])
+
+    def bkg_img():
+        return len(cq.query_bkg_img(Ctx['BlDict'], ARCHIVE, dbh, SCHEMA))
+
+    def segmap():
+        return len(cq.query_segmap(Ctx['BlDict'], ARCHIVE, dbh, SCHEMA))
+
+    def psfmodel():
+        return len(cq.query_psfmodel(Ctx['BlDict'], ARCHIVE, dbh, SCHEMA))
+
+    def piffmodel():
+        return len(cq.query_PIFFmodel(Ctx['BlDict'], ARCHIVE, dbh, SCHEMA, PIFF_TAG))
+
+    def headfile():
+        return len(cq.query_headfile_from_attempt(Ctx['BlDict'], Ctx['attemptID'], ARCHIVE, dbh, SCHEMA))
+
+    def catfinalcut():
+        return len(cq.query_catfinalcut(Ctx['BlDict'], ARCHIVE, dbh, SCHEMA))
+
+    def img_to_lld():
+        OutDict = {}
+        for Img in Ctx['BlDict']:
+            if all([Img in Ctx['AncDict'][ftype] for ftype in ['coadd_head_scamp', 'red_segmap', 'red_bkg', 'psfex_model']]):
+                OutDict[Img] = {'red': Ctx['BlDict'][Img], 'head': Ctx['AncDict']['coadd_head_scamp'][Img],
+                                'seg': Ctx['AncDict']['red_segmap'][Img], 'bkg': Ctx['AncDict']['red_bkg'][Img],
+                                'psf': Ctx['AncDict']['psfex_model'][Img]}
+        mdatatypes = {'red': ['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero']}
+        for ftype in ['head', 'seg', 'bkg', 'psf']:
+            mdatatypes[ftype] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
+        return len(cq.ImgDict_to_LLD(OutDict, ['red', 'head', 'seg', 'bkg', 'psf'], mdatatypes))
+
+    def cat_to_lld():
+        CatDict = cq.query_astref_catfinalcut({}, Ctx['tilename'], SE_TAG, dbh, SCHEMA, sd.BandList)
+        return len(cq.CatDict_to_LLD(CatDict, ['catfile'], ['expnum', 'band', 'ccdnum']))
+
+    return [('query_coadd_img_by_edges', edges),
+            ('query_coadd_img_by_fiat', fiat),
+            ('query_coadd_img_from_attempt', from_attempt),
+            ('query_zeropoint', zeropoint),
+            ('query_zeropoint_single', zeropoint_single),
+            ('query_blacklist', blacklist),
+            ('query_ancillary', ancillary),
+            ('query_bkg_img', bkg_img),
+            ('query_segmap', segmap),
+            ('query_psfmodel', psfmodel),
+            ('query_PIFFmodel', piffmodel),
+            ('query_headfile_from_attempt', headfile),
+            ('query_catfinalcut', catfinalcut),
+            ('ImgDict_to_LLD', img_to_lld),
+            ('CatDict_to_LLD', cat_to_lld)]
+
+
+######################################################################################
+def run_benchmark(func, repeat=5, warmup=1, quiet=True):
+    """ Time a benchmark (after warmup calls) and measure its Python allocations.
+
+        Returns:
+            Result:     Dict with rows, wall times (min, median, all), allocation peak/net (bytes)
+                        and the process peak RSS (kB) after the benchmark
+    """
+    out = io.StringIO() if quiet else None
+    with (contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext()):
+        for _ in range(warmup):
+            func()
+        walls = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            nrows = func()
+            walls.append(time.perf_counter() - t0)
+        #
+        #   Allocations are measured on a separate call (tracing slows execution)
+        #
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {'rows': nrows,
+            'wall_min': min(walls),
+            'wall_median': statistics.median(walls),
+            'wall': walls,
+            'alloc_peak': peak,
+            'alloc_net': current,
+            'rss_peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+######################################################################################
+def compare_baseline(Results, Baseline, threshold=0.2, min_delta=0.001):
+    """ Compare results against a baseline (matching benchmarks by name and scale).
+
+        Inputs:
+            Results:    Output of this run (dict with key 'results')
+            Baseline:   Earlier output (dict with key 'results')
+            threshold:  Fractional increase (of wall_min or alloc_peak) flagged as a regression
+            min_delta:  Increases in wall time smaller than this (seconds) are ignored (noise)
+
+        Returns:
+            Report:     List of dicts (one per benchmark found in both) with ratios and flags
+    """
+    Base = {(r['name'], r['scale']): r for r in Baseline['results']}
+    Report = []
+    for r in Results['results']:
+        b = Base.get((r['name'], r['scale']))
+        if b is None:
+            continue
+        wratio = r['wall_min'] / b['wall_min'] if b['wall_min'] > 0 else float('inf')
+        aratio = r['alloc_peak'] / b['alloc_peak'] if b['alloc_peak'] > 0 else 1.0
+        flags = []
+        if wratio > 1.0 + threshold and r['wall_min'] - b['wall_min'] > min_delta:
+            flags.append('TIME')
+        if aratio > 1.0 + threshold:
+            flags.append('ALLOC')
+        if r['rows'] != b['rows']:
+            flags.append('ROWS')
+        Report.append({'name': r['name'], 'scale': r['scale'], 'wall_ratio': wratio, 'alloc_ratio': aratio,
+                       'rows': r['rows'], 'baseline_rows': b['rows'], 'flags': flags})
+    return Report
+
+
+######################################################################################
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark coadd_query entry points against synthetic DES databases.')
+    parser.add_argument('--scales', action='store', type=str, default='5,10,20',
+                        help='Comma separated list of scales (exposures per band) to run (default=5,10,20)')
+    parser.add_argument('--ntile', action='store', type=int, default=2,
+                        help='Size of the block of tiles (ntile x ntile) in each database (default=2)')
+    parser.add_argument('--seed', action='store', type=int, default=1,
+                        help='Random seed for the synthetic databases (default=1)')
+    parser.add_argument('--dbdir', action='store', type=str, default=None,
+                        help='Directory to keep (and re-use) fixture databases (default: generate in memory)')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Number of timed calls per benchmark (default=5)')
+    parser.add_argument('--warmup', action='store', type=int, default=1,
+                        help='Number of untimed calls before timing (default=1)')
+    parser.add_argument('--only', action='store', type=str, default=None,
+                        help='Comma separated list of benchmarks to run (default: all)')
+    parser.add_argument('-o', '--output', action='store', type=str, default=None,
+                        help='JSON file to write results')
+    parser.add_argument('--baseline', action='store', type=str, default=None,
+                        help='JSON file (from an earlier run) to compare against')
+    parser.add_argument('--threshold', action='store', type=float, default=0.2,
+                        help='Fractional slowdown (or allocation growth) flagged as a regression (default=0.2)')
+    parser.add_argument('--min_delta', action='store', type=float, default=0.001,
+                        help='Slowdowns smaller than this (seconds) are not flagged (default=0.001)')
+    parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
+                        help='Verbosity (defualt:0; currently values up to 2)')
+    args = parser.parse_args()
+    if args.verbose:
+        print("Args: ", args)
+
+    verbose = args.verbose
+    Scales = [int(d) for d in args.scales.split(',')]
+
+    Results = {'meta': {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                        'sqlite': sqlite3.sqlite_version, 'host': platform.node(), 'ntile': args.ntile,
+                        'seed': args.seed, 'repeat': args.repeat, 'warmup': args.warmup},
+               'results': []}
+
+    print(f"# {'benchmark':30s} {'scale':>5s} {'nimage':>6s} {'rows':>6s} {'min(s)':>9s} {'med(s)':>9s} {'alloc(kB)':>10s} {'rss(MB)':>8s}")
+    for scale in Scales:
+        t0 = time.time()
+        dbh, Ctx = open_fixture(scale, args.ntile, args.seed, dbdir=args.dbdir, verbose=verbose)
+        if verbose > 0:
+            print(f"# Fixture for scale={scale:d} ready ({Ctx['nimage']:d} images). Execution time: {time.time() - t0:.2f}")
+        for name, func in bench_steps(dbh, Ctx):
+            if args.only is not None and name not in args.only.split(','):
+                #   Steps that feed later steps are still run (untimed)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    func()
+                continue
+            Result = run_benchmark(func, repeat=args.repeat, warmup=args.warmup, quiet=(verbose < 2))
+            Result.update({'name': name, 'scale': scale, 'nimage': Ctx['nimage']})
+            Results['results'].append(Result)
+            print(f"  {name:30s} {scale:5d} {Ctx['nimage']:6d} {Result['rows']:6d} {Result['wall_min']:9.4f} "
+                  f"{Result['wall_median']:9.4f} {Result['alloc_peak'] / 1024.:10.1f} {Result['rss_peak_kb'] / 1024.:8.1f}")
+        dbh.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(Results, fout, indent=1)
+        print(f"# Wrote benchmark results to: {args.output}")
+
+    nregress = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fin:
+            Baseline = json.load(fin)
+        Report = compare_baseline(Results, Baseline, threshold=args.threshold, min_delta=args.min_delta)
+        print(f"# Comparison with baseline {args.baseline} (threshold={args.threshold:.2f})")
+        print(f"# {'benchmark':30s} {'scale':>5s} {'time':>7s} {'alloc':>7s}  flags")
+        for r in Report:
+            print(f"  {r['name']:30s} {r['scale']:5d} {r['wall_ratio']:7.2f} {r['alloc_ratio']:7.2f}  {','.join(r['flags'])}")
+            if len(r['flags']) > 0:
+                nregress += 1
+        print(f"# {nregress:d} of {len(Report):d} benchmarks flagged")
+
+    exit(1 if nregress > 0 else 0)
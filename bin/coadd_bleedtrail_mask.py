@@ -6,6 +6,13 @@ Code to provide re-estimation of bleed trail masking needed in a coadd tile base
 bleed trails detected in single-frames.
 """
 
+#
+#   Columns retained (per tile) for each bleed trail
+#
+BleedDtype=[('ra_1','f8'),('ra_2','f8'),('ra_3','f8'),('ra_4','f8'),
+            ('dec_1','f8'),('dec_2','f8'),('dec_3','f8'),('dec_4','f8'),
+            ('band','U8'),('expnum','i8'),('ccdnum','i4')]
+
 ######################################################################################
 def query_coadd_geometry(TileDict,CoaddTile,ProcTag,dbh,dbSchema,PFWID=None,verbose=0):
     """ Query code to obtain COADD tile geometry
@@ -86,6 +93,36 @@ def query_coadd_geometry(TileDict,CoaddTile,ProcTag,dbh,dbSchema,PFWID=None,verb
                 and av.val=t.tilename
                 and t.tilename=g.str""".format(schema=dbSchema,ptag=ProcTag)
 #
+#   When a snapshot of COADDTILE_GEOM is available only the attempt/tile correspondence is needed
+#   from the DB (the original query above is kept as a fallback when tiles are missing from the snapshot).
+#
+    GeomTable="{schema:s}coaddtile_geom".format(schema=dbSchema)
+    UseCache=(tile_geom.load_tile_geom(GeomTable,dbh,verbose=verbose) is not None)
+    if (PFWID is not None):
+        attquery="""SELECT av.pfw_attempt_id as pfw_attempt_id, av.val as tilename
+            FROM {schema:s}pfw_attempt_val av
+            WHERE av.pfw_attempt_id={pfwid:d}
+                and av.key='tilename'""".format(schema=dbSchema,pfwid=PFWID)
+    elif (CoaddTile is None):
+        attquery="""SELECT av.pfw_attempt_id as pfw_attempt_id, av.val as tilename
+            FROM {schema:s}pfw_attempt_val av, {schema:s}proctag pt
+            WHERE pt.tag='{ptag:s}'
+                and pt.pfw_attempt_id=av.pfw_attempt_id
+                and av.key='tilename'""".format(schema=dbSchema,ptag=ProcTag)
+    else:
+        attquery="""SELECT av.pfw_attempt_id as pfw_attempt_id, av.val as tilename
+            FROM {schema:s}pfw_attempt_val av, {schema:s}proctag pt, gtt_str g
+            WHERE pt.tag='{ptag:s}'
+                and pt.pfw_attempt_id=av.pfw_attempt_id
+                and av.key='tilename'
+                and av.val=g.str""".format(schema=dbSchema,ptag=ProcTag)
+    GeomCols=['tilename','ra_cent','dec_cent','rac1','rac2','rac3','rac4','decc1','decc2','decc3','decc4',
+              'crossra0','racmin','racmax','deccmin','deccmax','uramin','uramax','udecmin','udecmax',
+              'pixelscale','naxis1','naxis2']
+    query_geom=query
+    if (UseCache):
+        query=attquery
+#
 #   Have worked out which query is needed, get on with it
 #
     if (verbose > 0):
@@ -118,6 +155,25 @@ def query_coadd_geometry(TileDict,CoaddTile,ProcTag,dbh,dbSchema,PFWID=None,verb
     curDB.execute(query)
     desc = [d[0].lower() for d in curDB.description]
 
+    if (UseCache):
+        AttDict={}
+        for row in curDB:
+            rowd = dict(zip(desc, row))
+            AttDict[rowd['tilename']]=rowd['pfw_attempt_id']
+        CacheDict=tile_geom.get_tile_geom(list(AttDict),GeomTable,dbh,columns=GeomCols,verbose=verbose)
+        if (len(CacheDict) == len(AttDict)):
+            for TileName in AttDict:
+                TileDict[TileName]={'pfw_attempt_id':AttDict[TileName]}
+                TileDict[TileName].update(CacheDict[TileName])
+            curDB.close()
+            return TileDict
+#
+#       Some tile(s) not present in the snapshot... fall back to obtaining geometry from the DB.
+#
+        print("# Tile geometry snapshot is missing {:d} tiles. Falling back to query.".format(len(AttDict)-len(CacheDict)))
+        curDB.execute(query_geom)
+        desc = [d[0].lower() for d in curDB.description]
+
     for row in curDB:
         rowd = dict(zip(desc, row))
         TileName=rowd['tilename']
@@ -129,22 +185,19 @@ def query_coadd_geometry(TileDict,CoaddTile,ProcTag,dbh,dbSchema,PFWID=None,verb
 
 
 ######################################################################################
-def query_coadd_bleed(AID,dbh,dbSchema,BandList=[],verbose=0):
+def query_coadd_bleed(AID,dbh,dbSchema,BandList=[],arraysize=100000,verbose=0):
     """ Query code to obtain bleedtrail records for image inputs into a COADD 
 
         Inputs:
-##            ImgDict:    Existing ImgDict, new records are added (and possibly old records updated)
-##            CoaddTile:  Name of COADD tile for search
-##            ProcTag:    Processing Tag used to constrain pool of input images
-##            Blacklistnfo: Dictionary containing information about Blacklist Constraint 
-##                            (NoneType yields no constraint)
-##                            BlacklistInfo['table'] provides table to use
-            curDB:      Database connection to be used
+            AID:        List of PFW_ATTEMPT_IDs (each as a list to load into GTT_ID)
+            dbh:        Database connection to be used
             dbSchema:   Schema over which queries will occur.
+            arraysize:  Number of rows fetched from the DB in each batch.
             verbose:    Integer setting level of verbosity when running.
 
         Returns:
-            BleedDict:    Updated version of input ImgDict
+            BleedDict:  Dict (keyed by tilename) holding a structured array of bleed trails 
+                            (fields given by BleedDtype)
     """
 
 
@@ -163,11 +216,9 @@ def query_coadd_bleed(AID,dbh,dbSchema,BandList=[],verbose=0):
 
     query="""SELECT 
         av.val as tilename,
-        i.filename as filename,
         c.expnum as expnum,
         c.ccdnum as ccdnum,
         c.band as band,
-        b.rnum as rnum,
         b.ra_1 as ra_1,
         b.ra_2 as ra_2,
         b.ra_3 as ra_3,
@@ -201,30 +252,159 @@ def query_coadd_bleed(AID,dbh,dbSchema,BandList=[],verbose=0):
         if (verbose > 1):
             print(query)
 
+    curDB.arraysize=arraysize
     curDB.execute(query)
     desc = [d[0].lower() for d in curDB.description]
 
-    BleedDict={}
-    for row in curDB:
-        rowd = dict(zip(desc, row))
 #
-#       Fix any known problematic NoneTypes before they get in the way.
+#   Fetch in batches directly into structured arrays 
+#   (note a NULL band becomes 'None' when cast to a string).
+#
+    ColType=dict(BleedDtype)
+    ColType['tilename']='U32'
+    RowDtype=[(col,ColType[col]) for col in desc]
+    BatchList=[]
+    while True:
+        rows=curDB.fetchmany()
+        if (not(rows)):
+            break
+        BatchList.append(np.array([tuple(row) for row in rows],dtype=RowDtype))
+    curDB.close()
+
+    if (len(BatchList) > 0):
+        BleedData=np.concatenate(BatchList)
+    else:
+        BleedData=np.zeros(0,dtype=RowDtype)
+    t1=time.time()
+
+#
+#   Split into a structured array per tile (preserving the order returned).
 #
-        if (rowd['band'] is None):
-            rowd['band']='None'
-        Tile=rowd['tilename']
-#        Img=rowd['filename']
-        if (Tile not in BleedDict):
-            BleedDict[Tile]=[]
-        BleedDict[Tile].append(rowd)
+    BleedDict={}
+    TileNames,TileIndex=np.unique(BleedData['tilename'],return_inverse=True)
+    order=np.argsort(TileIndex,kind='stable')
+    TileSplit=np.split(order,np.where(np.diff(TileIndex[order]) != 0)[0]+1)
+    for Tile,rows in zip(TileNames,TileSplit):
+        TileBleeds=np.zeros(rows.size,dtype=BleedDtype)
+        for col in TileBleeds.dtype.names:
+            TileBleeds[col]=BleedData[col][rows]
+        BleedDict[str(Tile)]=TileBleeds
 
     t3=time.time()
-    print("Completed query to obtain BLEED TRAIL data")
-    print("Elapsed time: {:.2f} seconds.".format(t3-t0))
+    print("Completed query to obtain BLEED TRAIL data ({:d} trails)".format(BleedData.size))
+    print("Elapsed time: {:.2f} seconds (fetch: {:.2f}, split: {:.2f}).".format(t3-t0,t1-t0,t3-t1))
 
     return BleedDict
 
 
+######################################################################################
+def bleedlist_to_array(BleedList):
+    """ Convert a list of bleed trails (one dict per trail) to a structured array.
+
+        Inputs:
+            BleedList:  List of dicts (with at least the keys in BleedDtype)
+
+        Returns:
+            BleedArray: Structured array (with fields from BleedDtype)
+    """
+
+    BleedArray=np.zeros(len(BleedList),dtype=BleedDtype)
+    for col in BleedArray.dtype.names:
+        BleedArray[col]=[BleedTrail[col] for BleedTrail in BleedList]
+
+    return BleedArray
+
+
+
+
+######################################################################################
+def find_overlap_groups(racen,deccen,rasz,decsz,maxpairs=4000000,verbose=0):
+    """ Group boxes that overlap (either directly or through a chain of overlapping boxes).
+
+        Boxes are swept in order of their lower RA edge so that only pairs with intersecting
+        RA extents are ever compared (rather than forming a dense NxN matching array).  Those
+        candidate pairs are tested with the same overlap criterion used previously and
+        connected groups are formed with a union-find structure.
+
+        Inputs:
+            racen:      Array of box centers (RA)
+            deccen:     Array of box centers (Dec)
+            rasz:       Array of box extents (RA)
+            decsz:      Array of box extents (Dec)
+            maxpairs:   Maximum number of candidate pairs to be tested at once (limits memory).
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            GroupList:  List of index arrays (one per group).  Groups are ordered by their lowest
+                            index and members are in ascending order (i.e. the same groups in the same
+                            order as the previous iterative search).
+    """
+
+    nsize=racen.size
+    if (nsize < 1):
+        return []
+
+#
+#   Sort on the lower RA edge.  For each box, the candidates are the boxes that follow it (in
+#   sorted order) with a lower edge before its upper edge.  The small pad guards against
+#   roundoff in forming the edges (so that no pair accepted by the test below can be missed).
+#
+    pad=1.0e-9
+    ra_lo=racen-0.5*rasz
+    ra_hi=racen+0.5*rasz+pad
+    order=np.argsort(ra_lo,kind='stable')
+    iend=np.searchsorted(ra_lo[order],ra_hi[order],side='right')
+    ncand=iend-np.arange(nsize)-1
+    ncand[ncand<0]=0
+    cumcand=np.cumsum(ncand)
+
+    parent=list(range(nsize))
+    def find_root(ix):
+        while (parent[ix] != ix):
+            parent[ix]=parent[parent[ix]]
+            ix=parent[ix]
+        return ix
+
+    npairs=0
+    istart=0
+    while (istart < nsize):
+#
+#       Work through the sorted list in blocks that keep the number of candidate pairs manageable.
+#
+        istop=int(np.searchsorted(cumcand,cumcand[istart]-ncand[istart]+maxpairs,side='right'))
+        if (istop <= istart):
+            istop=istart+1
+        blk_cand=ncand[istart:istop]
+        nblk=int(blk_cand.sum())
+        if (nblk > 0):
+            pos_i=np.repeat(np.arange(istart,istop),blk_cand)
+            pos_j=pos_i+1+np.arange(nblk)-np.repeat(np.cumsum(blk_cand)-blk_cand,blk_cand)
+            ind_i=order[pos_i]
+            ind_j=order[pos_j]
+            wsm=np.where(np.logical_and(
+                2.0*np.abs(racen[ind_j]-racen[ind_i]) < rasz[ind_j]+rasz[ind_i],
+                2.0*np.abs(deccen[ind_j]-deccen[ind_i]) < decsz[ind_j]+decsz[ind_i]))
+            npairs=npairs+wsm[0].size
+            for ix,iy in zip(ind_i[wsm].tolist(),ind_j[wsm].tolist()):
+                rx=find_root(ix)
+                ry=find_root(iy)
+                if (rx != ry):
+#                   Keep the lowest index as the root (so groups can be ordered by it)
+                    if (rx < ry):
+                        parent[ry]=rx
+                    else:
+                        parent[rx]=ry
+        istart=istop
+
+    if (verbose > 2):
+        print("Tested {:d} candidate pairs and found {:d} overlaps".format(int(cumcand[-1]),npairs))
+
+    roots=np.array([find_root(ix) for ix in range(nsize)])
+    gorder=np.argsort(roots,kind='stable')
+    gsplit=np.where(np.diff(roots[gorder]) != 0)[0]+1
+    GroupList=np.split(gorder,gsplit)
+
+    return GroupList
 
 
 ######################################################################################
@@ -235,7 +415,8 @@ def work_bleedlist(Tile,BleedDict,mrad=4.0,SkipEdgeBleed=False,ThinPix=3.3,MinFr
 
         Inputs:
             Tile:           Just for messsaging currently.
-            BleedDict:      Dict of Bleeds w/ attributes from query code.
+            BleedDict:      Dict of Bleeds (structured array per tile) from query code.
+                                A list of dicts (one per trail) is also accepted.
             mrad:           Matching radius (currently not used)
             SkipEdgeBleed:  Do not try to mix EdgeBleeds into the final result.
             ThinPix:        Extent (in pix) in Declination direction where a bleed might arise from CCD
@@ -269,76 +450,55 @@ def work_bleedlist(Tile,BleedDict,mrad=4.0,SkipEdgeBleed=False,ThinPix=3.3,MinFr
 #   Preprocess Trails subdividing into classes.
 #
     BleedList=BleedDict[Tile]
+    if (isinstance(BleedList,list)):
+        BleedList=bleedlist_to_array(BleedList)
     if (verbose > 1):
-        print("Input BleedTrail List size: {:d}".format(len(BleedList)))
-
-    bandlist=[]
+        print("Input BleedTrail List size: {:d}".format(BleedList.size))
+
+    bleed_ra=np.stack([BleedList['ra_1'],BleedList['ra_2'],BleedList['ra_3'],BleedList['ra_4']],axis=1)
+    bleed_ra[bleed_ra>180.0]-=360.0
+    bleed_dec=np.stack([BleedList['dec_1'],BleedList['dec_2'],BleedList['dec_3'],BleedList['dec_4']],axis=1)
+    BleedCol={'ra_cen':np.average(bleed_ra,axis=1),'dec_cen':np.average(bleed_dec,axis=1),
+              'ra_min':np.amin(bleed_ra,axis=1),'ra_max':np.amax(bleed_ra,axis=1),
+              'dec_min':np.amin(bleed_dec,axis=1),'dec_max':np.amax(bleed_dec,axis=1),
+              'ra_corn':bleed_ra,'dec_corn':bleed_dec}
+    BleedCol['ra_size']=BleedCol['ra_max']-BleedCol['ra_min']
+    BleedCol['dec_size']=BleedCol['dec_max']-BleedCol['dec_min']
+
+#
+#   Separate regions that describe amplifier size blocks for EdgeBleeds
+#   Eliminate extremely small, thin regions:
+#       - recall if they are associated with a bright star they will also be masked by the star
+#       - Bad column/hot pixels can generate a flagged bleed but are typically just 1 pix wide 
+#           (expanded to 3 in the mask)
+#       - Three-pixel wide region would be 0.000225 deg 
+#   Finally the "normal" bleeds
+#
+    IsEdge=(BleedCol['dec_size'] > 0.05)
+    IsThin=np.logical_and(np.logical_not(IsEdge),BleedCol['dec_size'] < ThinAsec)
+    IsNormal=np.logical_not(np.logical_or(IsEdge,IsThin))
+
+    band_uniq,band_first=np.unique(BleedList['band'],return_index=True)
+    bandlist=[str(band) for band in band_uniq[np.argsort(band_first)]]
     BleedPerBand={}
     EdgeBleedPerBand={}
     ThinSmall={}
-    for BleedTrail in BleedList:
-        if (BleedTrail['band'] not in bandlist):
-            bandlist.append(BleedTrail['band'])
-            BleedPerBand[BleedTrail['band']]=[]
-            EdgeBleedPerBand[BleedTrail['band']]=[]
-            ThinSmall[BleedTrail['band']]=[]
-
-        bleed_ra=np.array([BleedTrail['ra_1'],BleedTrail['ra_2'],BleedTrail['ra_3'],BleedTrail['ra_4']])
-        wsm=np.where(bleed_ra>180.0)
-        bleed_ra[wsm]=bleed_ra[wsm]-360.0
-        bleed_dec=np.array([BleedTrail['dec_1'],BleedTrail['dec_2'],BleedTrail['dec_3'],BleedTrail['dec_4']])
-        ra_cen=np.average(bleed_ra)
-        dec_cen=np.average(bleed_dec)
-        ra_min=np.amin(bleed_ra)
-        ra_max=np.amax(bleed_ra)
-        dec_min=np.amin(bleed_dec)
-        dec_max=np.amax(bleed_dec)
-        ra_size=ra_max-ra_min
-        dec_size=dec_max-dec_min
-
-        if (dec_size > 0.05):
-#
-#           Separate regions that describe amplifier size blocks for EdgeBleeds
-#
-            EdgeBleedPerBand[BleedTrail['band']].append(
-                {'ra_cen':ra_cen,'dec_cen':dec_cen,
-                 'ra_size':ra_size,'dec_size':dec_size,
-                 'ra_min':ra_min,'ra_max':ra_max,
-                 'dec_min':dec_min,'dec_max':dec_max,
-                 'ra_corn':bleed_ra,'dec_corn':bleed_dec})
-        else:
-            if ((dec_size < ThinAsec)):
-#
-#               Eliminate extremely small, thin regions:
-#                   - recall if they are associated with a bright star they will also be masked by the star
-#                   - Bad column/hot pixels can generate a flagged bleed but are typically just 1 pix wide 
-#                       (expanded to 3 in the mask)
-#                   - Three-pixel wide region would be 0.000225 deg 
-#
-                ThinSmall[BleedTrail['band']].append(
-                    {'ra_cen':ra_cen,'dec_cen':dec_cen,
-                     'ra_size':ra_size,'dec_size':dec_size,
-                     'ra_min':ra_min,'ra_max':ra_max,
-                     'dec_min':dec_min,'dec_max':dec_max,
-                     'ra_corn':bleed_ra,'dec_corn':bleed_dec})
-                if (verbose>2):
-                    print(" ThinSmall {:11.7f} {:11.7f}  {:9.6f} {:9.6f}  {:} {:}".format(
-                        ra_cen,dec_cen,ra_size,dec_size,bleed_ra,bleed_dec))
-            else:
-#
-#               Finally the "normal" bleeds
-#
-                BleedPerBand[BleedTrail['band']].append(
-                    {'ra_cen':ra_cen,'dec_cen':dec_cen,
-                     'ra_size':ra_size,'dec_size':dec_size,
-                     'ra_min':ra_min,'ra_max':ra_max,
-                     'dec_min':dec_min,'dec_max':dec_max,
-                     'ra_corn':bleed_ra,'dec_corn':bleed_dec})
+    for band in bandlist:
+        InBand=(BleedList['band']==band)
+        BleedPerBand[band]={key:BleedCol[key][np.logical_and(InBand,IsNormal)] for key in BleedCol}
+        EdgeBleedPerBand[band]={key:BleedCol[key][np.logical_and(InBand,IsEdge)] for key in BleedCol}
+        ThinSmall[band]={key:BleedCol[key][np.logical_and(InBand,IsThin)] for key in BleedCol}
+        if (verbose>2):
+            for ix in range(ThinSmall[band]['ra_cen'].size):
+                print(" ThinSmall {:11.7f} {:11.7f}  {:9.6f} {:9.6f}  {:} {:}".format(
+                    ThinSmall[band]['ra_cen'][ix],ThinSmall[band]['dec_cen'][ix],
+                    ThinSmall[band]['ra_size'][ix],ThinSmall[band]['dec_size'][ix],
+                    ThinSmall[band]['ra_corn'][ix],ThinSmall[band]['dec_corn'][ix]))
 
 #   Summary
     for band in bandlist:
         print(" {:s}-band trails subdivided: {:d} normal, {:d} thin-small, and {:d} probable edge-bleeds".format(
-            band,len(BleedPerBand[band]),len(ThinSmall[band]),len(EdgeBleedPerBand[band])))
+            band,BleedPerBand[band]['ra_cen'].size,ThinSmall[band]['ra_cen'].size,EdgeBleedPerBand[band]['ra_cen'].size))
 
 
     t00=time.time()
@@ -357,116 +517,75 @@ def work_bleedlist(Tile,BleedDict,mrad=4.0,SkipEdgeBleed=False,ThinPix=3.3,MinFr
 #   Begin consolidating Bleeds on a by-band basis
 #
     for band in bandlist:
-        nsize=len(BleedPerBand[band])
-        match=np.zeros((nsize,nsize),dtype=int)
-        used=np.zeros((nsize),dtype=int)
 
 #
-#       Determine which bleed trails intersect
+#       Determine which bleed trails intersect (and group them)
 #
         t0=time.time()
-        racen=np.array([BleedPerBand[band][ix]['ra_cen'] for ix in range(nsize)])
-        deccen=np.array([BleedPerBand[band][ix]['dec_cen'] for ix in range(nsize)])
-        rasz=np.array([BleedPerBand[band][ix]['ra_size'] for ix in range(nsize)])
-        decsz=np.array([BleedPerBand[band][ix]['dec_size'] for ix in range(nsize)])
-
-        for iy in range(nsize):
-            dra=np.abs(racen-racen[iy])
-            ddec=np.abs(deccen-deccen[iy])
-            sra=rasz+rasz[iy]
-            sdec=decsz+decsz[iy]
-            wsm=np.where(np.logical_and(2.0*dra < sra,2.0*ddec < sdec))
-            match[iy,:][wsm]=1
-        print("Form Matching array for {:s}-band. Execution Time: {:.2f}".format(band,time.time()-t0))
+        racen=BleedPerBand[band]['ra_cen']
+        deccen=BleedPerBand[band]['dec_cen']
+        rasz=BleedPerBand[band]['ra_size']
+        decsz=BleedPerBand[band]['dec_size']
+        ramin=BleedPerBand[band]['ra_min']
+        ramax=BleedPerBand[band]['ra_max']
+        decmin=BleedPerBand[band]['dec_min']
+        decmax=BleedPerBand[band]['dec_max']
+
+        GroupList=find_overlap_groups(racen,deccen,rasz,decsz,verbose=verbose)
+        print("Form overlapping groups for {:s}-band. Execution Time: {:.2f}".format(band,time.time()-t0))
 
         t0=time.time()
         ######################
-        #  Iterative grouping together of overlaps...
+        #  Consolidate each group of overlaps...
 
-        xind=np.arange(nsize)
         BleedSet[band]=[]
-        cnt=1
         NumOrphans=0
         NumRejects=0
-        for iy in range(nsize):
-            if (used[iy]==0):
-                if (verbose > 2):
-                    print("Starting on entry {:d}".format(iy))
-                mlist=[]
-                mlist.append(iy)
-                used[iy]=1
-                nfound=1
-                # Find matches based on box overlap.
-                wsm=np.where(np.logical_and(match[iy,:]==1,used==0))
-                used[wsm]=1
-                for ix in xind[wsm]:
-                    mlist.append(ix)
-                niter=1
-                if (verbose > 2):
-                    print("Niter {:d} found a group of {:d}".format(niter,len(mlist)))
-                if (verbose > 3):
-                    print("mlist: ",mlist)
-                # Now Iterate through matches of matches until list stops growing.
-                while (len(mlist)>nfound):
-                    nfound=len(mlist)
-                    for ifnd in range(nfound):
-                        wsm=np.where(np.logical_and(match[mlist[ifnd],:]==1,used==0))
-                        if(used[wsm].size > 0):
-                            used[wsm]=1
-                            for ix in xind[wsm]:
-                                mlist.append(ix)
-                    niter=niter+1
-                    if (verbose > 2):
-                        print("Niter {:d} found a group of {:d}".format(niter,len(mlist)))
-                    if (verbose > 3):
-                        print(mlist)
-                if (verbose > 2):
-                    print("Finished")
-                if (verbose > 4):
-                    for ifnd in mlist:
-                        print(" {:6d} {:13.7f} {:13.7f} {:13.7f} {:13.7f} ".format(
-                            ifnd,
-                            BleedPerBand[band][ifnd]['ra_min'],
-                            BleedPerBand[band][ifnd]['ra_max'],
-                            BleedPerBand[band][ifnd]['dec_min'],
-                            BleedPerBand[band][ifnd]['dec_max']))
-                    for ifnd in mlist:
-                        print("fk5;box({:13.7f},{:13.7f},{:13.7f}\",{:13.7f}\")".format(
-                            BleedPerBand[band][ifnd]['ra_cen'],
-                            BleedPerBand[band][ifnd]['dec_cen'],
-                            3600.*BleedPerBand[band][ifnd]['ra_size']*np.cos(deg2rad*BleedPerBand[band][ifnd]['dec_cen']),
-                            3600.*BleedPerBand[band][ifnd]['dec_size']))
-
-                bleed_ra_min=np.array([BleedPerBand[band][ifnd]['ra_min'] for ifnd in mlist])
-                bleed_ra_max=np.array([BleedPerBand[band][ifnd]['ra_max'] for ifnd in mlist])
-                bleed_dec_min=np.array([BleedPerBand[band][ifnd]['dec_min'] for ifnd in mlist])
-                bleed_dec_max=np.array([BleedPerBand[band][ifnd]['dec_max'] for ifnd in mlist])
-                if (bleed_ra_min.size < 2):
-                    NumOrphans=NumOrphans+1
-                if (bleed_ra_min.size < MinFrame):
-                    NumRejects=NumRejects+1
-                else:
-                    BDict={}
-                    BDict['count']=bleed_ra_min.size
-                    if (bleed_ra_min.size > 1):
-                        BDict['ra_min']=np.amin(bleed_ra_min)
-                        BDict['ra_max']=np.amax(bleed_ra_max)
-                        BDict['dec_min']=np.amin(bleed_dec_min)
-                        BDict['dec_max']=np.amax(bleed_dec_max)
-                        BDict['mra_min']=np.median(bleed_ra_min)
-                        BDict['mra_max']=np.median(bleed_ra_max)
-                        BDict['mdec_min']=np.median(bleed_dec_min)
-                        BDict['mdec_max']=np.median(bleed_dec_max)
-                    else:    
-                        BDict['ra_min']=bleed_ra_min[0]
-                        BDict['ra_max']=bleed_ra_max[0]
-                        BDict['dec_min']=bleed_dec_min[0]
-                        BDict['dec_max']=bleed_dec_max[0]
-                        BDict['mra_min']=bleed_ra_min[0]
-                        BDict['mra_max']=bleed_ra_max[0]
-                        BDict['mdec_min']=bleed_dec_min[0]
-                        BDict['mdec_max']=bleed_dec_max[0]
-                    BleedSet[band].append(BDict)
+        for mlist in GroupList:
+            if (verbose > 2):
+                print("Group starting with entry {:d} has {:d} members".format(mlist[0],mlist.size))
+            if (verbose > 3):
+                print("mlist: ",mlist)
+            if (verbose > 4):
+                for ifnd in mlist:
+                    print(" {:6d} {:13.7f} {:13.7f} {:13.7f} {:13.7f} ".format(
+                        ifnd,ramin[ifnd],ramax[ifnd],decmin[ifnd],decmax[ifnd]))
+                for ifnd in mlist:
+                    print("fk5;box({:13.7f},{:13.7f},{:13.7f}\",{:13.7f}\")".format(
+                        racen[ifnd],deccen[ifnd],
+                        3600.*rasz[ifnd]*np.cos(deg2rad*deccen[ifnd]),
+                        3600.*decsz[ifnd]))
+
+            bleed_ra_min=ramin[mlist]
+            bleed_ra_max=ramax[mlist]
+            bleed_dec_min=decmin[mlist]
+            bleed_dec_max=decmax[mlist]
+            if (bleed_ra_min.size < 2):
+                NumOrphans=NumOrphans+1
+            if (bleed_ra_min.size < MinFrame):
+                NumRejects=NumRejects+1
+            else:
+                BDict={}
+                BDict['count']=bleed_ra_min.size
+                if (bleed_ra_min.size > 1):
+                    BDict['ra_min']=np.amin(bleed_ra_min)
+                    BDict['ra_max']=np.amax(bleed_ra_max)
+                    BDict['dec_min']=np.amin(bleed_dec_min)
+                    BDict['dec_max']=np.amax(bleed_dec_max)
+                    BDict['mra_min']=np.median(bleed_ra_min)
+                    BDict['mra_max']=np.median(bleed_ra_max)
+                    BDict['mdec_min']=np.median(bleed_dec_min)
+                    BDict['mdec_max']=np.median(bleed_dec_max)
+                else:    
+                    BDict['ra_min']=bleed_ra_min[0]
+                    BDict['ra_max']=bleed_ra_max[0]
+                    BDict['dec_min']=bleed_dec_min[0]
+                    BDict['dec_max']=bleed_dec_max[0]
+                    BDict['mra_min']=bleed_ra_min[0]
+                    BDict['mra_max']=bleed_ra_max[0]
+                    BDict['mdec_min']=bleed_dec_min[0]
+                    BDict['mdec_max']=bleed_dec_max[0]
+                BleedSet[band].append(BDict)
 
         print("Integration Execution Time: {:.2f}".format(time.time()-t0))
 
@@ -484,20 +603,22 @@ def work_bleedlist(Tile,BleedDict,mrad=4.0,SkipEdgeBleed=False,ThinPix=3.3,MinFr
         if (SkipEdgeBleed):
             print("Skipping check on edgebleeds")
         else:
-            if (len(EdgeBleedPerBand[band])>0):
+            nedge=EdgeBleedPerBand[band]['ra_cen'].size
+            if (nedge>0):
                 print("Working on EdgeBleeds")
                 if (verbose > 3):
-                    for Bleed in EdgeBleedPerBand[band]:
+                    Bleed=EdgeBleedPerBand[band]
+                    for ix in range(nedge):
                         print(" {:13.7f} {:13.7f} {:13.7f} {:13.7f} {:13.7f} {:13.7f} {:13.7f} {:13.7f} ".format(
-                            Bleed['ra_cen'],Bleed['dec_cen'],
-                            Bleed['ra_size'],Bleed['dec_size'],
-                            Bleed['ra_min'],Bleed['ra_max'],
-                            Bleed['dec_min'],Bleed['dec_max']))
-
-                bleed_ra_min=np.array([BleedPerBand[band][ifnd]['ra_min'] for ifnd in range(len(EdgeBleedPerBand[band])) ])
-                bleed_ra_max=np.array([BleedPerBand[band][ifnd]['ra_max'] for ifnd in range(len(EdgeBleedPerBand[band])) ])
-                bleed_dec_min=np.array([BleedPerBand[band][ifnd]['dec_min'] for ifnd in range(len(EdgeBleedPerBand[band])) ])
-                bleed_dec_max=np.array([BleedPerBand[band][ifnd]['dec_max'] for ifnd in range(len(EdgeBleedPerBand[band])) ])
+                            Bleed['ra_cen'][ix],Bleed['dec_cen'][ix],
+                            Bleed['ra_size'][ix],Bleed['dec_size'][ix],
+                            Bleed['ra_min'][ix],Bleed['ra_max'][ix],
+                            Bleed['dec_min'][ix],Bleed['dec_max'][ix]))
+
+                bleed_ra_min=BleedPerBand[band]['ra_min'][np.arange(nedge)]
+                bleed_ra_max=BleedPerBand[band]['ra_max'][np.arange(nedge)]
+                bleed_dec_min=BleedPerBand[band]['dec_min'][np.arange(nedge)]
+                bleed_dec_max=BleedPerBand[band]['dec_max'][np.arange(nedge)]
                 BDict={}
                 BDict['count']=bleed_ra_min.size
                 if (bleed_ra_min.size > 1):
@@ -527,6 +648,69 @@ def work_bleedlist(Tile,BleedDict,mrad=4.0,SkipEdgeBleed=False,ThinPix=3.3,MinFr
     return BleedSet
 
 
+######################################################################################
+def write_bleed_region(outfile,Tile,band,BleedSet):
+    """ Write a region file describing the consolidated bleed trails for a tile/band.
+        A file (with only a header) is written even when no trails were present in a band.
+
+        Inputs:
+            outfile:    Name of output region file
+            Tile:       COADD tile name (used in header)
+            band:       Band being written
+            BleedSet:   Consolidated list(s) of bleeds (as returned by work_bleedlist)
+
+        Returns:
+            nbleed:     Number of bleed regions written
+    """
+
+    freg=open(outfile,'w')
+    freg.write("# bleed trail region for {:s} {:s}-band \n".format(Tile,band))
+    nbleed=0
+    if (band in BleedSet):
+        for Bleed in BleedSet[band]:
+            nbleed=nbleed+1
+            freg.write(" fk5;polygon({:.7f},{:.7f},".format(Bleed['ra_min'],Bleed['dec_min']))
+            freg.write("{:.7f},{:.7f},".format(Bleed['ra_max'],Bleed['dec_min']))
+            freg.write("{:.7f},{:.7f},".format(Bleed['ra_max'],Bleed['dec_max']))
+            freg.write("{:.7f},{:.7f}) # color=red width=2 \n".format(Bleed['ra_min'],Bleed['dec_max']))
+    freg.close()
+
+    return nbleed
+
+
+######################################################################################
+def work_tile_bleeds(TileArgs):
+    """ Worker to consolidate the bleed trails for a single tile and write its region file(s).
+        Intended to be mapped over a set of tiles by a process pool (batch mode).
+
+        Inputs:
+            TileArgs:   Tuple containing (Tile, BleedList, BandList, OutDir, OutFmt, WorkOpts), where
+                            BandList: list of bands to write (None writes all bands found)
+                            OutFmt:   format for output filenames (with keywords tile, band)
+                            WorkOpts: dictionary of keyword arguments passed to work_bleedlist
+
+        Returns:
+            TileSum:    Dictionary summarizing work (tile, files written, trails, and timing)
+    """
+
+    Tile,BleedList,BandList,OutDir,OutFmt,WorkOpts=TileArgs
+    t0=time.time()
+    BleedSet=work_bleedlist(Tile,{Tile:BleedList},**WorkOpts)
+    t1=time.time()
+
+    if (BandList is None):
+        BandList=sorted(BleedSet.keys())
+    TileSum={'tile':Tile,'nbleed':{},'files':[]}
+    for band in BandList:
+        outfile=os.path.join(OutDir,OutFmt.format(tile=Tile,band=band))
+        TileSum['nbleed'][band]=write_bleed_region(outfile,Tile,band,BleedSet)
+        TileSum['files'].append(outfile)
+    TileSum['work_time']=t1-t0
+    TileSum['write_time']=time.time()-t1
+
+    return TileSum
+
+
 ######################################################################################
 ######################################################################################
 ######################################################################################
@@ -540,8 +724,10 @@ if __name__ == "__main__":
     import time
     import re
     import sys
+    import multiprocessing
     import numpy as np
     import intgutils.queryutils as queryutils
+    import mepipelineappintg.tile_geom as tile_geom
 #    import multiepoch_appintg.coadd_query as me
     
     parser = argparse.ArgumentParser(description='Query code to obtain image inputs for COADD/multiepoch pipelines.')
@@ -551,10 +737,16 @@ if __name__ == "__main__":
                         help='COADD tile name for which to asssemble inputs (default=None)')
     parser.add_argument('-A', '--attemptID', action='store', type=int, default=None, 
                         help='Alternate (PFW_ATTEMPT_ID) for tile processing attempt (for untagged data or mid-proceess use)')
-    parser.add_argument('-b', '--band', action='store', type=str, required=True,
-                        help='Band being considered')
-    parser.add_argument('-o', '--outfile',  action='store', type=str, required=True, 
-                        help='Output region file to be returned')
+    parser.add_argument('-b', '--band', action='store', type=str, default=None,
+                        help='Band being considered (batch mode: comma separated list, default=all bands found)')
+    parser.add_argument('-o', '--outfile',  action='store', type=str, default=None, 
+                        help='Output region file to be returned (required unless --outdir is used)')
+    parser.add_argument('--outdir',  action='store', type=str, default=None, 
+                        help='Batch mode: write one region file per tile/band into this directory (default=None)')
+    parser.add_argument('--outfmt',  action='store', type=str, default='{tile:s}_{band:s}_bleedtrail.reg', 
+                        help='Batch mode: format for output region filenames (default={tile:s}_{band:s}_bleedtrail.reg)')
+    parser.add_argument('--nproc', action='store', type=int, default=1, 
+                        help='Batch mode: number of processes used to work tiles in parallel (default=1)')
 #    parser.add_argument('--exclude_list',  action='store', type=str, default='EXCLUDE_LIST', 
 #                        help='EXCLUDE_LIST table to use in queries. (Default=EXCLUDE_LIST, "NONE", results in no exclude list constraint')
     parser.add_argument('--skipedgebleed', action='store_true', default=False, 
@@ -576,6 +768,19 @@ if __name__ == "__main__":
 
     verbose=args.verbose
 
+    if (args.outdir is None):
+        if ((args.outfile is None)or(args.band is None)):
+            print("Must specify --band and --outfile (or use batch mode with --outdir)")
+            print("Aborting!")
+            exit(1)
+    else:
+        if (not(os.path.isdir(args.outdir))):
+            os.makedirs(args.outdir)
+        if (args.band is None):
+            BatchBandList=None
+        else:
+            BatchBandList=args.band.split(',')
+
     if (args.Schema is None):
         dbSchema=""
     else:
@@ -632,13 +837,46 @@ if __name__ == "__main__":
 
     t0=time.time()
     BleedDict={}
-    BleedDict=query_coadd_bleed(AIDList,dbh,dbSchema,verbose)
+    BleedDict=query_coadd_bleed(AIDList,dbh,dbSchema,verbose=verbose)
     print("BleedTrails acquired by query of image inputs tile={:}".format(TileList))
     print("    Execution Time: {:.2f}".format(time.time()-t0))
     print("    BleedDict size: {:d}".format(len(BleedDict)))
 
     dbh.close()
 
+    if (args.outdir is not None):
+#
+#       Batch mode: work each tile in a pool of processes, write region files for each tile/band.
+#
+        WorkOpts={'SkipEdgeBleed':args.skipedgebleed,'ThinPix':args.thinpix,'MinFrame':args.minframe,'verbose':verbose}
+        TileArgList=[]
+        for Tile in TileDict:
+            if (Tile in BleedDict):
+                TileArgList.append((Tile,BleedDict[Tile],BatchBandList,args.outdir,args.outfmt,WorkOpts))
+            else:
+                TileArgList.append((Tile,[],BatchBandList,args.outdir,args.outfmt,WorkOpts))
+
+        t0=time.time()
+        TileSumList=[]
+        if ((args.nproc > 1)and(len(TileArgList) > 1)):
+            with multiprocessing.get_context('fork').Pool(processes=args.nproc) as pool:
+                for TileSum in pool.imap_unordered(work_tile_bleeds,TileArgList):
+                    TileSumList.append(TileSum)
+        else:
+            for TileArgs in TileArgList:
+                TileSumList.append(work_tile_bleeds(TileArgs))
+        twork=time.time()-t0
+
+        print("#")
+        print("# Per-tile summary:")
+        print("# {:12s} {:>9s} {:>9s}  {:s}".format("tile","work[s]","write[s]","trails per band"))
+        for TileSum in sorted(TileSumList,key=lambda x: x['tile']):
+            print("  {:12s} {:9.2f} {:9.2f}  {:s}".format(TileSum['tile'],TileSum['work_time'],TileSum['write_time'],
+                " ".join(["{:s}:{:d}".format(band,TileSum['nbleed'][band]) for band in TileSum['nbleed']])))
+        print("# Worked {:d} tiles (wrote {:d} region files) using {:d} process(es).  Execution Time: {:.2f}".format(
+            len(TileSumList),sum([len(TileSum['files']) for TileSum in TileSumList]),args.nproc,twork))
+        exit(0)
+
 
 #    ftxt=open("%s.satstars.dat"%(args.outfile),'w') 
 #    ftxt.write("# {:s} \n".format(args.tile))
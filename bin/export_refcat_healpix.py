@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+"""
+Export a reference catalog (e.g. GAIA_DR2) into a local HEALPix partitioned store
+(for use by get_GAIA_for_tile.py --refcat-store)
+"""
+
+verbose = 0
+
+######################################################################################
+
+if __name__ == "__main__":
+
+    import argparse
+    import os
+    import despydb.desdbi
+    import mepipelineappintg.refcat_store as rs
+
+
+    parser = argparse.ArgumentParser(description='Export a reference catalog into a local HEALPix partitioned store.')
+    parser.add_argument('--table', action='store', type=str, default='GAIA_DR2',
+                        help='Catalog table (must have RA,Dec) to export (default=GAIA_DR2)')
+    parser.add_argument('--cols', action='store', type=str, default='ra,dec,phot_g_mean_mag',
+                        help='Comma separated list of (numeric) columns to export (default=ra,dec,phot_g_mean_mag)')
+    parser.add_argument('--nside', action='store', type=int, default=32,
+                        help='HEALPix nside used to partition the catalog (default=32)')
+    parser.add_argument('--dec_step', action='store', type=float, default=1.0,
+                        help='Width (degrees) of the declination stripes queried during export (default=1.0)')
+    parser.add_argument('-o', '--output', action='store', type=str, required=True,
+                        help='Directory to hold the store')
+    parser.add_argument('-s', '--section', action='store', type=str, default='db-dessci',
+                        help='section of .desservices file with connection info')
+    parser.add_argument('-S', '--Schema', action='store', type=str, default='des_admin',
+                        help='DB schema (do not include \'.\').')
+    parser.add_argument('-T', '--Timing', action='store_true', default=False,
+                        help='If set timing information accompanies output')
+    parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
+                        help='Verbosity (defualt:0; currently values up to 2)')
+    args = parser.parse_args()
+    if args.verbose:
+        print("Args: ", args)
+
+    verbose = args.verbose
+
+    if args.Schema is None:
+        dbSchema = ""
+    else:
+        dbSchema = f"{args.Schema}."
+
+    ########################################################
+    #
+    #   Setup a DB connection
+    #
+    try:
+        desdmfile = os.environ["des_services"]
+    except KeyError:
+        desdmfile = None
+    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+
+    Index = rs.export_refcat(dbh, args.output, dbSchema=dbSchema, table=args.table, cols=args.cols.split(','),
+                             nside=args.nside, dec_step=args.dec_step, Timing=args.Timing, verbose=verbose)
+    print(f"# Wrote store of {Index['nrows']:d} objects from {Index['table']} to: {args.output}")
+    dbh.close()
+
+    exit(0)
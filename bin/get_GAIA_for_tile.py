@@ -16,6 +16,7 @@ if __name__ == "__main__":
 #    import time
 #    import yaml
     import mepipelineappintg.cat_query as cq
+    import mepipelineappintg.refcat_store as rs
     import fitsio
 
 
@@ -28,6 +29,12 @@ if __name__ == "__main__":
                         help='Method to used with --extend. Either "fractional" (expand by a factor) or "fixed" (default) number of arcminutes')
     parser.add_argument('-o', '--output', action='store', type=str, required=True,
                         help='Output FITS table to be written')
+    parser.add_argument('--tile-list', dest='tile_list', action='store', type=str, default=None,
+                        help='File with a list of tilenames (one per line) to be processed together (requires --outdir)')
+    parser.add_argument('--outdir', action='store', type=str, default=None,
+                        help='Directory for per-tile outputs when using --tile-list (written as OUTDIR/TILENAME/basename of --output)')
+    parser.add_argument('--refcat-store', dest='refcat_store', action='store', type=str, default=None,
+                        help='Local reference catalog store (from export_refcat_healpix.py) to use rather than querying GAIA_DR2')
     parser.add_argument('-s', '--section', action='store', type=str, default='db-dessci',
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default='des_admin',
@@ -43,6 +50,16 @@ if __name__ == "__main__":
     #
     verbose = args.verbose
 
+    if (args.tile_list is not None):
+        if (args.outdir is None):
+            print("Use of --tile-list requires an output directory (--outdir)")
+            print("Aborting!")
+            exit(1)
+    elif (args.tilename is None):
+        print("Must provide either a tilename (--tilename) or a list of tiles (--tile-list)")
+        print("Aborting!")
+        exit(1)
+
     if args.Schema is None:
         dbSchema = ""
     else:
@@ -56,46 +73,108 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    #
+    #   When a local store is used, a DB connection is only made if the tile is absent from the cached tile geometry
+    #
+    if (args.refcat_store is None):
+        dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    else:
+        dbh = None
     #    cur = dbh.cursor()
 
-    tileDict=cq.query_Tile_edges(args.tilename,dbh,dbSchema,verbose=args.verbose)
+    def get_tile_edges(tile):
+        global dbh
+        try:
+            return cq.query_Tile_edges(tile,dbh,dbSchema,verbose=args.verbose)
+        except ValueError:
+            if (dbh is not None):
+                raise
+            dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+            return cq.query_Tile_edges(tile,dbh,dbSchema,verbose=args.verbose)
+
+    if (args.tile_list is None):
+        TileList=[args.tilename]
+    else:
+        TileList=[]
+        with open(args.tile_list, 'r') as ftile:
+            for line in ftile:
+                if line.strip() and not line.strip().startswith('#'):
+                    TileList.append(line.split()[0])
+
+    BoxDict={}
+    for Tile in TileList:
+        tileDict=get_tile_edges(Tile)
 
-    if (args.extend != 0.0):
-        tileDict=cq.expand_range(tileDict,extend=args.extend,method=args.method,verbose=args.verbose)
+        if (args.extend != 0.0):
+            tileDict=cq.expand_range(tileDict,extend=args.extend,method=args.method,verbose=args.verbose)
 
 #
-#   Since I apparently am  not consistent crowbar the structure for bounds of a tile to that used in 
-#   bounding an RA/DEC search.
+#       Since I apparently am  not consistent crowbar the structure for bounds of a tile to that used in 
+#       bounding an RA/DEC search.
 #
-    radec_box={}
-    for tile in tileDict:
-        if (tileDict[tile]['crossra0']=="Y"):
-            radec_box['crossra0']=True
-        else:
-            radec_box['crossra0']=False
-        radec_box['ra1']=tileDict[tile]['racmin']
-        radec_box['ra2']=tileDict[tile]['racmax']
-        radec_box['dec1']=tileDict[tile]['deccmin']
-        radec_box['dec2']=tileDict[tile]['deccmax']
+        radec_box={}
+        for tile in tileDict:
+            if (tileDict[tile]['crossra0']=="Y"):
+                radec_box['crossra0']=True
+            else:
+                radec_box['crossra0']=False
+            radec_box['ra1']=tileDict[tile]['racmin']
+            radec_box['ra2']=tileDict[tile]['racmax']
+            radec_box['dec1']=tileDict[tile]['deccmin']
+            radec_box['dec2']=tileDict[tile]['deccmax']
+        BoxDict[Tile]=radec_box
 
-    GCol=['ra','dec','phot_g_mean_mag']
-    GCat,GHead=cq.get_cat_radec_range(radec_box,dbh,dbSchema=dbSchema,table='GAIA_DR2',cols=GCol,verbose=args.verbose)
-
-    if (args.method == "fixed"):
-        hopt=[{'name':'TILENAME','value':args.tilename},
-              {'name':'EXPAND',  'value':args.extend, 'comment':'arcminutes'},
-              {'name':'METHOD',  'value':args.method},
-              {'name':'CATALOG', 'value':'GAIA_DR2'}]
+#
+#   In --tile-list mode overlapping (expanded) tiles are merged into larger regions that are each
+#   queried once, and the objects for each tile are then selected from its region
+#
+    if (args.tile_list is None):
+        Regions=[dict(BoxDict[args.tilename],members=[args.tilename])]
     else:
-        hopt=[{'name':'TILENAME','value':args.tilename},
-              {'name':'EXPAND',  'value':args.extend*100., 'comment':'percentage'},
-              {'name':'METHOD',  'value':args.method},
-              {'name':'CATALOG', 'value':'GAIA_DR2'}]
-            
-   # Write a fits file with the record array
-    fitsio.write(args.output, GCat, header=hopt, extname='GAIA_OBJECT', clobber=True)
-    print("# Wrote GAIA objects to: {ftab:s}".format(ftab=args.output))
+        Regions=cq.merge_radec_boxes(BoxDict,verbose=args.verbose)
 
+    GCol=['ra','dec','phot_g_mean_mag']
+    nfetch=0
+    nwrite=0
+    for Region in Regions:
+        if (args.refcat_store is None):
+            GCat,GHead=cq.get_cat_radec_range(Region,dbh,dbSchema=dbSchema,table='GAIA_DR2',cols=GCol,verbose=args.verbose)
+        else:
+            GCat,GHead=rs.get_refcat_radec_range(Region,args.refcat_store,cols=GCol,verbose=args.verbose)
+        nfetch+=GCat[GHead[0]].size
+
+        for Tile in Region['members']:
+            if (len(Region['members']) > 1):
+                InBox=cq.select_radec_box(GCat,BoxDict[Tile])
+                TCat={col:GCat[col][InBox] for col in GHead}
+            else:
+                TCat=GCat
+            nwrite+=TCat[GHead[0]].size
+
+            if (args.method == "fixed"):
+                hopt=[{'name':'TILENAME','value':Tile},
+                      {'name':'EXPAND',  'value':args.extend, 'comment':'arcminutes'},
+                      {'name':'METHOD',  'value':args.method},
+                      {'name':'CATALOG', 'value':'GAIA_DR2'}]
+            else:
+                hopt=[{'name':'TILENAME','value':Tile},
+                      {'name':'EXPAND',  'value':args.extend*100., 'comment':'percentage'},
+                      {'name':'METHOD',  'value':args.method},
+                      {'name':'CATALOG', 'value':'GAIA_DR2'}]
+
+            if (args.tile_list is None):
+                output=args.output
+            else:
+                tdir=os.path.join(args.outdir,Tile)
+                os.makedirs(tdir,exist_ok=True)
+                output=os.path.join(tdir,os.path.basename(args.output))
+
+            # Write a fits file with the record array
+            fitsio.write(output, TCat, header=hopt, extname='GAIA_OBJECT', clobber=True)
+            print("# Wrote GAIA objects to: {ftab:s}".format(ftab=output))
+
+    if (args.tile_list is not None):
+        print("# Fetched {:d} GAIA objects in {:d} queries for {:d} tiles; wrote {:d} objects (fetched/written={:.3f})".format(
+            nfetch,len(Regions),len(TileList),nwrite,nfetch/max(nwrite,1)))
 
     exit(0)
@@ -17,6 +17,7 @@ if __name__ == "__main__":
 #    import yaml
     import mepipelineappintg.meds_query as mq
     import mepipelineappintg.piff_qa_query as pq
+    import mepipelineappintg.db_query as db_query
 
 
     parser = argparse.ArgumentParser(description='Query code to obtain image inputs for COADD/multiepoch pipelines.')
@@ -36,6 +37,8 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 4)')
     args = parser.parse_args()
@@ -69,7 +72,9 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
     #    cur = dbh.cursor()
 
     if (args.pfw_attempt_id is None):
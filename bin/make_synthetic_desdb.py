@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+
+"""
+Generate a synthetic DES-like SQLite database (for offline testing, profiling and
+benchmarking of the query code, see mepipelineappintg.sqlite_dbi.SqliteDbi)
+"""
+
+verbose = 0
+
+######################################################################################
+
+if __name__ == "__main__":
+
+    import argparse
+    import os
+    import json
+    from mepipelineappintg.sqlite_dbi import SqliteDbi
+    import mepipelineappintg.synthetic_des as sd
+
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic DES-like SQLite database.')
+    parser.add_argument('-o', '--output', action='store', type=str, required=True,
+                        help='SQLite database file to write')
+    parser.add_argument('--ntile_ra', action='store', type=int, default=2,
+                        help='Number of tiles along RA (default=2)')
+    parser.add_argument('--ntile_dec', action='store', type=int, default=2,
+                        help='Number of tiles along Dec (default=2)')
+    parser.add_argument('--nexp', action='store', type=int, default=10,
+                        help='Number of exposures per band (default=10)')
+    parser.add_argument('--nccd', action='store', type=int, default=62,
+                        help='Number of CCDs per exposure (default=62)')
+    parser.add_argument('--bandlist', action='store', type=str, default='g,r,i,z,Y',
+                        help='Comma separated list of bands (Default="g,r,i,z,Y").')
+    parser.add_argument('--ra0', action='store', type=float, default=30.0,
+                        help='RA of the first tile center (default=30.0)')
+    parser.add_argument('--dec0', action='store', type=float, default=-30.0,
+                        help='Dec of the first tile center (default=-30.0)')
+    parser.add_argument('--gaia_density', action='store', type=float, default=2000.0,
+                        help='Number of GAIA_DR2 stars per square degree (default=2000)')
+    parser.add_argument('--release_prefix', action='store', type=str, default=None,
+                        help='Comma separated list of release prefixes (e.g. Y6A1_) under which tables are also available')
+    parser.add_argument('--seed', action='store', type=int, default=1,
+                        help='Random seed (default=1)')
+    parser.add_argument('--summary', action='store', type=str, default=None,
+                        help='Optional JSON file to write a summary (tilenames, row counts)')
+    parser.add_argument('--clobber', action='store_true', default=False,
+                        help='Replace an existing output database')
+    parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
+                        help='Verbosity (defualt:0; currently values up to 2)')
+    args = parser.parse_args()
+    if args.verbose:
+        print("Args: ", args)
+
+    verbose = args.verbose
+
+    if os.path.exists(args.output):
+        if not args.clobber:
+            parser.error(f"Output {args.output} exists (use --clobber to replace it)")
+        os.remove(args.output)
+
+    ReleasePrefixes = None
+    if args.release_prefix is not None:
+        ReleasePrefixes = [d.strip() for d in args.release_prefix.split(',')]
+
+    dbh = SqliteDbi(args.output, verbose=verbose)
+    Summary = sd.make_synthetic_des(dbh, ntile_ra=args.ntile_ra, ntile_dec=args.ntile_dec, nexp=args.nexp,
+                                    nccd=args.nccd, bands=[d.strip() for d in args.bandlist.split(',')],
+                                    ra0=args.ra0, dec0=args.dec0, gaia_density=args.gaia_density,
+                                    release_prefixes=ReleasePrefixes, seed=args.seed, verbose=verbose)
+    dbh.close()
+    print(f"# Wrote synthetic DES database ({len(Summary['tilenames']):d} tiles: {','.join(Summary['tilenames'])}) to: {args.output}")
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as fout:
+            json.dump(Summary, fout, indent=1)
+
+    exit(0)
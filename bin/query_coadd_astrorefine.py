@@ -23,6 +23,7 @@ if __name__ == "__main__":
     from despymisc.miscutils import fwsplit
     import intgutils.queryutils as queryutils
     import mepipelineappintg.coadd_query as me
+    import mepipelineappintg.db_query as db_query
 
     svnid = "$Id: query_coadd_astrorefine.py 43836 2016-08-25 20:15:59Z rgruendl $"
 
@@ -45,6 +46,8 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 3)')
     args = parser.parse_args()
@@ -87,7 +90,9 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
     #    cur = dbh.cursor()
 
     t0 = time.time()
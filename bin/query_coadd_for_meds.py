@@ -18,11 +18,11 @@ if __name__ == "__main__":
     import despydb.desdbi
     import time
     import yaml
-    import intgutils.queryutils as queryutils
     import mepipelineappintg.meds_query as mq
     import mepipelineappintg.coadd_query as cq
     import mepipelineappintg.mepochmisc as mepochmisc
     import mepipelineappintg.metadetect_pizza_cutter_tools as mdetpizza
+    import mepipelineappintg.db_query as db_query
 
     svnid = "$Id: query_coadd_for_meds.py 48316 2019-03-01 20:00:27Z rgruendl $"
 
@@ -47,6 +47,8 @@ if __name__ == "__main__":
                         help='SOURCE constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--z2version', action='store', type=str, default=None,
                         help='VERSION constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--zpt_single_query', action='store_true', default=False,
+                        help='Resolve primary and secondary ZPTs with a single query. (Default=False)')
     parser.add_argument('--z2flag', action='store', type=str, default=None,
                         help='FLAG constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--archive', action='store', type=str, default='desar2home',
@@ -65,6 +67,8 @@ if __name__ == "__main__":
                         help='Proctag TAG containing PIFF afterburner products (PIFF models)')
     parser.add_argument('--imglist', action='store', type=str, default=None,
                         help='Optional output of a txt-file listing showing expnum, ccdnum, band, zeropoint')
+    parser.add_argument('--type-lists', dest='type_lists', action='store', type=str, default=None,
+                        help='Optional prefix for per-filetype lists of the files written (PREFIX_<filetype>.list)')
     parser.add_argument('--ima_list', action='store', default=None,
                         help='Filename with list of returned IMG list')
     parser.add_argument('--head_list', action='store', default=None,
@@ -79,12 +83,15 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 4)')
     parser.add_argument('--pizza-cutter-yaml', action='store', default=None,
                         help='Path + Base Filename with metadetect pizza-cutter YAML information.')
     parser.add_argument('--gaia-cat', action='store', default=None,
-                        help='Path + Base Filename with GAIA source information (for pizza-cutter YAML).')
+                        help='Path + Base Filename with GAIA source information (for pizza-cutter YAML). '
+                             'With --tile-list the catalog for each tile is taken from OUTDIR/TILENAME/basename.')
     parser.add_argument('--target_path', action='store', type=str, default=None,
                         help='Config file, when present is used to override/replace archive filepaths with relative filepath on target machine.')
     parser.add_argument('--me_proctag', action='store', type=str, default=None,
@@ -93,6 +100,10 @@ if __name__ == "__main__":
                         help='Tilename (as an alternative to using -A to specify a COADD run, requires use of --me_proctag')
     parser.add_argument('--sel_band', action='store', type=str, default=None,
                         help='Only use sel_band on text list created')
+    parser.add_argument('--tile-list', dest='tile_list', action='store', type=str, default=None,
+                        help='File with a list of tilenames (one per line) to be processed together (requires --me_proctag and --outdir)')
+    parser.add_argument('--outdir', action='store', type=str, default=None,
+                        help='Directory for per-tile outputs when using --tile-list (written as OUTDIR/TILENAME/basename of each output)')
     args = parser.parse_args()
     if args.verbose:
         print("Args: ", args)
@@ -110,7 +121,12 @@ if __name__ == "__main__":
     #
     #   Check whether a PFW_ATTEMPT_ID was provided (or if one needs to be determined from --tilename --me_proctag)
     #
-    if (args.pfw_attempt_id is None):
+    if (args.tile_list is not None):
+        if (args.me_proctag is None)or(args.outdir is None):
+            print("Use of --tile-list requires a PROCTAG (--me_proctag) and an output directory (--outdir)")
+            print("Aborting!")
+            exit(1)
+    elif (args.pfw_attempt_id is None):
         if (args.me_proctag is None)or(args.tilename is None):
             print("Must provide either a PFW_ATTEMPT_ID (-A) or PROCTAG and TILENAME (--me_proctag --tilename)")
             print("Aborting!")
@@ -243,208 +259,235 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
     #    cur = dbh.cursor()
 
-    if (args.pfw_attempt_id is None):
-        IntID = mq.query_attempt_from_tag_tile(args.me_proctag,args.tilename,dbh,dbSchema,verbose)
-        if (IntID is None):
-            print("Failed to obtain a PFW_ATTEMPT_ID so will not be able to identify a run to base inputs on")
-            print("Aborting")
-            exit(1)
-        PFWattemptID=str(IntID)
-    else:
-        PFWattemptID = args.pfw_attempt_id
-
+    #
+    #   Identify the attempt(s) to base inputs on.  In --tile-list mode the attempts (and then images) for
+    #   all tiles are found together and subsequent queries run once over the union of images.
+    #
     t0 = time.time()
     bands = args.bandlist.split(",")
-    ImgDict, HeadDict = mq.query_imgs_from_attempt(PFWattemptID, bands, dbh, dbSchema, verbose)
+    if (args.tile_list is None):
+        if (args.pfw_attempt_id is None):
+            IntID = mq.query_attempt_from_tag_tile(args.me_proctag,args.tilename,dbh,dbSchema,verbose)
+            if (IntID is None):
+                print("Failed to obtain a PFW_ATTEMPT_ID so will not be able to identify a run to base inputs on")
+                print("Aborting")
+                exit(1)
+            PFWattemptID=str(IntID)
+        else:
+            PFWattemptID = args.pfw_attempt_id
+        AttemptDict = {args.tilename: PFWattemptID}
+
+        ImgDict, HeadDict = mq.query_imgs_from_attempt(PFWattemptID, bands, dbh, dbSchema, verbose)
+        TileImgDict = {args.tilename: ImgDict}
+        TileHeadDict = {args.tilename: HeadDict}
+    else:
+        TileList = []
+        with open(args.tile_list, 'r') as ftile:
+            for line in ftile:
+                if line.strip() and not line.strip().startswith('#'):
+                    TileList.append(line.split()[0])
+        print(f" Working from proctag={args.me_proctag:s} for {len(TileList):d} tiles")
+        AttemptDict = {Tile: str(IntID) for Tile, IntID in
+                       mq.query_attempts_from_tag_tiles(args.me_proctag, TileList, dbh, dbSchema, verbose).items()}
+        if len(AttemptDict) < 1:
+            print("Failed to obtain any PFW_ATTEMPT_ID so will not be able to identify runs to base inputs on")
+            print("Aborting")
+            exit(1)
+        TileImgDict, TileHeadDict = mq.query_imgs_from_attempts(AttemptDict, bands, dbh, dbSchema, verbose)
     print(f"    Execution Time: {time.time() - t0:.2f}")
-    print("    Img Dict size: ", len(ImgDict))
-    print("    Head Dict size: ", len(HeadDict))
+    print("    Img Dict size: ", sum([len(TileImgDict[Tile]) for Tile in TileImgDict]))
+    print("    Head Dict size: ", sum([len(TileHeadDict[Tile]) for Tile in TileHeadDict]))
 
     #
     #   Now a bunch of rigamarole to get zeropoints
-    #
-    NeedZPT = False
-    for Img in ImgDict:
-        if 'mag_zero' not in ImgDict[Img]:
-            NeedZPT = True
-        else:
-            if ImgDict[Img]['mag_zero'] is None:
-                NeedZPT = True
+    #   (images lacking a zeropoint are gathered across tiles so that a single query is run)
+    #
+    ZptImgDict = {}
+    NeedZPTList = {}
+    for Tile in TileImgDict:
+        NeedZPTList[Tile] = set()
+        for Img in TileImgDict[Tile]:
+            if 'mag_zero' not in TileImgDict[Tile][Img]:
+                NeedZPTList[Tile].add(Img)
+            else:
+                if TileImgDict[Tile][Img]['mag_zero'] is None:
+                    NeedZPTList[Tile].add(Img)
+        for Img in TileImgDict[Tile]:
+            if Img in NeedZPTList[Tile] and Img not in ZptImgDict:
+                ZptImgDict[Img] = TileImgDict[Tile][Img]
+    NeedZPT = len(ZptImgDict) > 0
 
     if not NeedZPT:
         print("All images already have zeropoints (inherited from a previous run/step).  Skipping further ZPT queries")
     else:
         if ZptInfo is not None:
-            ImgDict = cq.query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose)
+            ZptImgDict = cq.query_zeropoint(ZptImgDict, ZptInfo, ZptSecondary, dbh, dbSchema,
+                                            SingleQuery=args.zpt_single_query, verbose=verbose)
+            #
+            #           Propagate zeropoints to each tile (removing images that have no zeropoint and
+            #           ordering as query_zeropoint would have for that tile alone)
+            #
+            ZptRank = {Img: rank for rank, Img in enumerate(ZptImgDict)}
+            for Tile in TileImgDict:
+                ImgDict = TileImgDict[Tile]
+                NewImgDict = {Img: ImgDict[Img] for Img in ImgDict if Img not in NeedZPTList[Tile]}
+                for Img in sorted([Img for Img in NeedZPTList[Tile] if Img in ZptRank], key=ZptRank.get):
+                    NewImgDict[Img] = ImgDict[Img]
+                    NewImgDict[Img]['mag_zero'] = ZptImgDict[Img]['mag_zero']
+                TileImgDict[Tile] = NewImgDict
             print("ZeroPoint query run ")
             print(f"    Execution Time: {time.time() - t0:.2f}")
-            print("    Img Dict size: ", len(ImgDict))
+            print("    Img Dict size: ", sum([len(TileImgDict[Tile]) for Tile in TileImgDict]))
         else:
         #
         #           Fallback assign value of MagBase for zeropoints.
         #
-            for Img in ImgDict:
-                if 'mag_zero' not in ImgDict[Img]:
-                    ImgDict[Img]['mag_zero'] = MagBase
-                else:
-                    if ImgDict[Img]['mag_zero'] is None:
-                        ImgDict[Img]['mag_zero'] = MagBase
+            for Tile in TileImgDict:
+                for Img in NeedZPTList[Tile]:
+                    TileImgDict[Tile][Img]['mag_zero'] = MagBase
 
     #
-    #   Optional ability to obtain background and segmap images.
+    #   Optional ability to obtain background and segmap images (queried once over the union of images from all tiles).
     #
+    AllImgDict = {}
+    for Tile in TileImgDict:
+        AllImgDict.update(TileImgDict[Tile])
+    AncTypes = []
+    if args.bkgimg:
+        AncTypes.append('red_bkg')
+    if args.segmap:
+        AncTypes.append('red_segmap')
+    if args.psfmodel:
+        if args.usepiff:
+            AncTypes.append('piff_model')
+        else:
+            AncTypes.append('psfex_model')
+    AncDict = cq.query_ancillary(AllImgDict, AncTypes, ArchiveSite, dbh, dbSchema, PIFFtag=args.pifftag, verbose=verbose)
+
     if args.bkgimg:
-        BkgDict = cq.query_bkg_img(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
         print(" Bkg image query run")
         print(f"    Execution Time: {time.time() - t0:.2f}")
-        print("    Bkg Dict size: ", len(BkgDict))
+        print("    Bkg Dict size: ", len(AncDict['red_bkg']))
 
     if args.segmap:
-        SegDict = cq.query_segmap(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
         print(" Segmentation Map query run")
         print("    Execution Time: {:.2f}".format(time.time() - t0))
-        print("    Seg Dict size: ", len(SegDict))
+        print("    Seg Dict size: ", len(AncDict['red_segmap']))
 
     if args.psfmodel:
         if args.usepiff:
-            PsfDict = cq.query_PIFFmodel(ImgDict, ArchiveSite, dbh, dbSchema, args.pifftag, verbose=verbose)
+            PsfType = 'piff_model'
         else:
-            PsfDict = cq.query_psfmodel(ImgDict, ArchiveSite, dbh, dbSchema, verbose=verbose)
+            PsfType = 'psfex_model'
         print(" PSF Model query run")
         print("    Execution Time: {:.2f}".format(time.time() - t0))
-        print("    PSF Dict size: ", len(PsfDict))
+        print("    PSF Dict size: ", len(AncDict[PsfType]))
 
     #
     #   Close DB connection?
     #
     #    dbh.close()
     #
-    #   If a high level of verbosity is present print the query results.
+    #   Outputs are formed for each tile in turn (in --tile-list mode outputs go to OUTDIR/TILENAME/)
     #
-    if verbose > 2:
-        print("Query results for COADD (SWarp) inputs, prior to mixing among catalogs")
-        for Img in ImgDict:
-            print(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['fluxscale']:6.3f} {ImgDict[Img]['filename']:s}")
+    def tile_output(fname, Tile):
+        if (args.tile_list is None):
+            return fname
+        tdir = os.path.join(args.outdir, Tile)
+        os.makedirs(tdir, exist_ok=True)
+        return os.path.join(tdir, os.path.basename(fname))
 
-    #
-    #   Convert the ImgDict to an LLD (list of list of dictionaries)
-    #   While doing the assembly get a count of number of Imgs per band
-    #
-    OutDict = {}
-    for Img in ImgDict:
-        wrec = True
-        if Img not in HeadDict:
-            wrec = False
-        if args.segmap:
-            if Img not in SegDict:
-                wrec = False
+    for Tile in TileImgDict:
+        ImgDict = TileImgDict[Tile]
+        HeadDict = TileHeadDict[Tile]
+        PFWattemptID = AttemptDict[Tile]
         if args.bkgimg:
-            if Img not in BkgDict:
-                wrec = False
+            BkgDict = {Img: AncDict['red_bkg'][Img] for Img in ImgDict if Img in AncDict['red_bkg']}
+        if args.segmap:
+            SegDict = {Img: AncDict['red_segmap'][Img] for Img in ImgDict if Img in AncDict['red_segmap']}
         if args.psfmodel:
-            if Img not in PsfDict:
-                wrec = False
-        if wrec:
-            OutDict[Img] = {}
-            OutDict[Img]['red'] = ImgDict[Img]
-            OutDict[Img]['head'] = HeadDict[Img]
-            if args.segmap:
-                OutDict[Img]['seg'] = SegDict[Img]
-            if args.bkgimg:
-                OutDict[Img]['bkg'] = BkgDict[Img]
-            if args.psfmodel:
-                OutDict[Img]['psf'] = PsfDict[Img]
-
-    filetypes = ['red', 'head']
-    mdatatypes = {'red': ['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero'],
-                  'head': ['filename', 'compression', 'expnum', 'ccdnum', 'band']}
-    if args.segmap:
-        filetypes.append('seg')
-        mdatatypes['seg'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
-    if args.bkgimg:
-        filetypes.append('bkg')
-        mdatatypes['bkg'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
-    if args.psfmodel:
-        filetypes.append('psf')
-        mdatatypes['psf'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
-
-    Img_LLD = cq.ImgDict_to_LLD(OutDict, filetypes, mdatatypes, verbose)
+            PsfDict = {Img: AncDict[PsfType][Img] for Img in ImgDict if Img in AncDict[PsfType]}
+        if (args.tile_list is not None):
+            print(f" Forming outputs for tile={Tile:s} (PFW_ATTEMPT_ID={PFWattemptID:s}) with {len(ImgDict):d} images")
 
-    #
-    #   If a high level of verbosity is present print the results.
-    #
-    if verbose > 3:
-        print("Query results for COADD (SWarp) inputs (LLD format).")
-        for Img in Img_LLD:
-            print(Img)
-    #
-    #   Here a function call is needed to take the Img_LLD and write results to the output file.
-    #
-    Img_lines = queryutils.convert_multiple_files_to_lines(Img_LLD, filetypes)
-    queryutils.output_lines(args.outfile, Img_lines)
+        #
+        #   If a high level of verbosity is present print the query results.
+        #
+        if verbose > 2:
+            print("Query results for COADD (SWarp) inputs, prior to mixing among catalogs")
+            for Img in ImgDict:
+                print(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['fluxscale']:6.3f} {ImgDict[Img]['filename']:s}")
 
-    #
-    #   Secondary (optional) output of a list of images found by the query.
-    #
-    if args.imglist is not None:
-        imgfile = open(args.imglist, 'w')
-        for Img in ImgDict:
-            wrec = True
-            if Img not in HeadDict:
-                wrec = False
-            if args.segmap:
-                if Img not in SegDict:
-                    wrec = False
-            if args.bkgimg:
-                if Img not in BkgDict:
-                    wrec = False
-            if args.psfmodel:
-                if Img not in PsfDict:
-                    wrec = False
-            if wrec:
-                imgfile.write(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['mag_zero']:8.5f}\n")
-        imgfile.close()
-
-    #   Close up shop.
-
-    # Optional print a list of the location of the inputs
-    if args.ima_list:
-        mepochmisc.write_textlist(dbh, ImgDict, args.ima_list, archive_name=args.archive, sel_band=args.sel_band, fields=['fullname', 'mag_zero'], verb=args.verbose)
-    if args.head_list:
-        mepochmisc.write_textlist(dbh, HeadDict, args.head_list, archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
-    if args.bkg_list:
-        if not args.bkgimg:
-            print(f"Warning: No --bkgimg search requested.  Skipping write for --bkg_list {args.bkg_list:s}")
-        else:
-            mepochmisc.write_textlist(dbh, BkgDict, args.bkg_list, archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
-    if args.seg_list:
-        if not args.segmap:
-            print(f"Warning: No --segmap search requested.  Skipping write for --seg_list {args.seg_list:s}")
-        else:
-            mepochmisc.write_textlist(dbh, SegDict, args.seg_list, archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
-    if args.psf_list:
-        if not args.psfmodel:
-            print(f"Warning: No --psfmodel search requested.  Skipping write for --psf_list {args.psf_list:s}")
-        else:
-            mepochmisc.write_textlist(dbh, PsfDict, args.psf_list, archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
-
-    if args.pizza_cutter_yaml:
-        bands = args.bandlist.split(",")
-        tilename = mdetpizza.get_tilename_from_attempt(
-            PFWattemptID,
-            args.me_proctag,
-            dbh,
-            dbSchema,
-            Timing=True,
-            verbose=verbose,
-        )
-        coadd_data = {}
-        for band in bands:
-            coadd_data[band] = mdetpizza.get_coadd_info_from_attempt(
-                tilename, band, PFWattemptID, args.me_proctag, dbh, dbSchema,
+        #
+        #   Write the list of inputs (the records for each filetype are joined as each line is written)
+        #   and the optional image list (the same set of images as the list of inputs).
+        #
+        filetypes = ['red', 'head']
+        mdatatypes = {'red': ['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero'],
+                      'head': ['filename', 'compression', 'expnum', 'ccdnum', 'band']}
+        AncDicts = {'head': HeadDict}
+        if args.segmap:
+            filetypes.append('seg')
+            mdatatypes['seg'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
+            AncDicts['seg'] = SegDict
+        if args.bkgimg:
+            filetypes.append('bkg')
+            mdatatypes['bkg'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
+            AncDicts['bkg'] = BkgDict
+        if args.psfmodel:
+            filetypes.append('psf')
+            mdatatypes['psf'] = ['filename', 'compression', 'expnum', 'ccdnum', 'band']
+            AncDicts['psf'] = PsfDict
+        TypeLists = None
+        if args.type_lists is not None:
+            TypeLists = {ftype: tile_output(f"{args.type_lists:s}_{ftype:s}.list", Tile) for ftype in filetypes}
+        ImgList = None
+        if args.imglist is not None:
+            ImgList = tile_output(args.imglist, Tile)
+
+        cq.write_image_lists(ImgDict, AncDicts, filetypes, mdatatypes, tile_output(args.outfile, Tile),
+                             imglist=ImgList, typelists=TypeLists, verbose=verbose)
+
+        #   Close up shop.
+
+        # Optional print a list of the location of the inputs
+        if args.ima_list:
+            mepochmisc.write_textlist(dbh, ImgDict, tile_output(args.ima_list, Tile), archive_name=args.archive, sel_band=args.sel_band, fields=['fullname', 'mag_zero'], verb=args.verbose)
+        if args.head_list:
+            mepochmisc.write_textlist(dbh, HeadDict, tile_output(args.head_list, Tile), archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
+        if args.bkg_list:
+            if not args.bkgimg:
+                print(f"Warning: No --bkgimg search requested.  Skipping write for --bkg_list {args.bkg_list:s}")
+            else:
+                mepochmisc.write_textlist(dbh, BkgDict, tile_output(args.bkg_list, Tile), archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
+        if args.seg_list:
+            if not args.segmap:
+                print(f"Warning: No --segmap search requested.  Skipping write for --seg_list {args.seg_list:s}")
+            else:
+                mepochmisc.write_textlist(dbh, SegDict, tile_output(args.seg_list, Tile), archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
+        if args.psf_list:
+            if not args.psfmodel:
+                print(f"Warning: No --psfmodel search requested.  Skipping write for --psf_list {args.psf_list:s}")
+            else:
+                mepochmisc.write_textlist(dbh, PsfDict, tile_output(args.psf_list, Tile), archive_name=args.archive, sel_band=args.sel_band, fields=['fullname'], verb=args.verbose)
+
+        if args.pizza_cutter_yaml:
+            bands = args.bandlist.split(",")
+            tilename = mdetpizza.get_tilename_from_attempt(
+                PFWattemptID,
+                args.me_proctag,
+                dbh,
+                dbSchema,
+                Timing=True,
+                verbose=verbose,
+            )
+            coadd_data = mdetpizza.get_coadd_info_from_attempt_bands(
+                tilename, bands, PFWattemptID, args.me_proctag, dbh, dbSchema,
                 Timing=True, verbose=verbose,
             )
 #
@@ -452,69 +495,76 @@ if __name__ == "__main__":
 #           use values in config file args.target_path to override/replace fullpaths from
 #           archive with appropriate paths on the target machine
 #
-        if (args.target_path is None):
-            if (verbose > 0):
-                print("Using full archive paths in YAML generation")
-
-            # MRB: used for local testing - comment out when not needed
-            # ImgDict = mepochmisc.update_fullname(ImgDict, "JUNK")
-            # HeadDict = mepochmisc.update_fullname(HeadDict, "JUNK")
-            # BkgDict = mepochmisc.update_fullname(BkgDict, "JUNK")
-            # SegDict = mepochmisc.update_fullname(SegDict, "JUNK")
-            # if args.usepiff:
-            #     PsfDict = mepochmisc.update_fullname(PsfDict, "JUNK")
-            # else:
-            #     PsfDict = mepochmisc.update_fullname(PsfDict, "JUNK")
-        else:
-            if (os.path.isfile(args.target_path)):
-                tpath_Dict = mepochmisc.read_target_path(args.target_path,verbose=verbose)
+            if (args.target_path is None):
                 if (verbose > 0):
-                    print("Adjusting filename paths to conform to target machine in YAML generation")
-                for band in bands:
-                    for ftype in coadd_data[band]:
+                    print("Using full archive paths in YAML generation")
+
+                # MRB: used for local testing - comment out when not needed
+                # ImgDict = mepochmisc.update_fullname(ImgDict, "JUNK")
+                # HeadDict = mepochmisc.update_fullname(HeadDict, "JUNK")
+                # BkgDict = mepochmisc.update_fullname(BkgDict, "JUNK")
+                # SegDict = mepochmisc.update_fullname(SegDict, "JUNK")
+                # if args.usepiff:
+                #     PsfDict = mepochmisc.update_fullname(PsfDict, "JUNK")
+                # else:
+                #     PsfDict = mepochmisc.update_fullname(PsfDict, "JUNK")
+            else:
+                if (os.path.isfile(args.target_path)):
+                    tpath_Dict = mepochmisc.read_target_path(args.target_path,verbose=verbose)
+                    if (verbose > 0):
+                        print("Adjusting filename paths to conform to target machine in YAML generation")
+                    for band in bands:
+                        for ftype in coadd_data[band]:
+                            if (ftype not in tpath_Dict):
+                                print("No target side path available for filetype={:s}".format(ftype))
+                                print(ftype,coadd_data[band][ftype]['fullname'])
+                            else:
+                                coadd_data[band][ftype]['fullname']=tpath_Dict[ftype]+'/'+coadd_data[band][ftype]['filename']+coadd_data[band][ftype]['compression']
+                    for ftype in ['red_immask','red_segmap','coadd_head_scamp','red_bkg','piff_model','psfex_model']:
+                        miss_ftype=False
                         if (ftype not in tpath_Dict):
-                            print("No target side path available for filetype={:s}".format(ftype))
-                            print(ftype,coadd_data[band][ftype]['fullname'])
-                        else:
-                            coadd_data[band][ftype]['fullname']=tpath_Dict[ftype]+'/'+coadd_data[band][ftype]['filename']+coadd_data[band][ftype]['compression']
-                for ftype in ['red_immask','red_segmap','coadd_head_scamp','red_bkg','piff_model','psfex_model']:
-                    miss_ftype=False
-                    if (ftype not in tpath_Dict):
-                        print("Target path specification for filetype: {:s} missing! Aborting!".format(ftype))
-                        miss_ftype=True
-                    if (miss_ftype):
-                        exit(1)
-
-                ImgDict  = mepochmisc.update_fullname(ImgDict,tpath_Dict['red_immask'])
-                HeadDict = mepochmisc.update_fullname(HeadDict,tpath_Dict['coadd_head_scamp'])
-                BkgDict  = mepochmisc.update_fullname(BkgDict,tpath_Dict['red_bkg'])
-                SegDict  = mepochmisc.update_fullname(SegDict,tpath_Dict['red_segmap'])
-                if args.usepiff:
-                    PsfDict = mepochmisc.update_fullname(PsfDict,tpath_Dict['piff_model'])
-                else:
-                    PsfDict = mepochmisc.update_fullname(PsfDict,tpath_Dict['psfex_model'])
+                            print("Target path specification for filetype: {:s} missing! Aborting!".format(ftype))
+                            miss_ftype=True
+                        if (miss_ftype):
+                            exit(1)
+
+                    ImgDict  = mepochmisc.update_fullname(ImgDict,tpath_Dict['red_immask'])
+                    HeadDict = mepochmisc.update_fullname(HeadDict,tpath_Dict['coadd_head_scamp'])
+                    BkgDict  = mepochmisc.update_fullname(BkgDict,tpath_Dict['red_bkg'])
+                    SegDict  = mepochmisc.update_fullname(SegDict,tpath_Dict['red_segmap'])
+                    if args.usepiff:
+                        PsfDict = mepochmisc.update_fullname(PsfDict,tpath_Dict['piff_model'])
+                    else:
+                        PsfDict = mepochmisc.update_fullname(PsfDict,tpath_Dict['psfex_model'])
 
 #
 #       Go on and form pizza-cutter YAML
 #
-        if (verbose > 0):
-            print("Forming pizza-cutter YAML files")
-
-        yaml_data = mdetpizza.make_pizza_cutter_yaml(
-            PFWattemptID, tilename, args.gaia_cat,
-            ImgDict, HeadDict, BkgDict, SegDict, PsfDict,
-            bands, coadd_data,
-        )
-        mdetpizza.add_coaddtile_geom(
-            yaml_data, tilename, dbh, dbSchema, Timing=True, verbose=verbose
-        )
-        if args.usepiff and args.pifftag:
-            mdetpizza.add_piff_info_to_yaml(
-                    yaml_data, args.pifftag, dbh, dbSchema, Timing=True, verbose=verbose
-                )
-
-        for band in bands:
-            with open(args.pizza_cutter_yaml + f"_{band}.yaml", "w") as fp:
-                fp.write(yaml.dump(yaml_data[band], default_flow_style=False))
+            if (verbose > 0):
+                print("Forming pizza-cutter YAML files")
+
+            #   in --tile-list mode each tile has its own GAIA catalog (OUTDIR/TILENAME/basename, as from get_GAIA_for_tile)
+            GaiaCat = args.gaia_cat
+            if GaiaCat is not None:
+                GaiaCat = tile_output(GaiaCat, Tile)
+            yaml_data = mdetpizza.make_pizza_cutter_yaml(
+                PFWattemptID, tilename, GaiaCat,
+                ImgDict, HeadDict, BkgDict, SegDict, PsfDict,
+                bands, coadd_data,
+            )
+            mdetpizza.add_coaddtile_geom(
+                yaml_data, tilename, dbh, dbSchema, Timing=True, verbose=verbose
+            )
+            if args.usepiff and args.pifftag:
+                mdetpizza.add_piff_info_to_yaml(
+                        yaml_data, args.pifftag, dbh, dbSchema, Timing=True, verbose=verbose
+                    )
+
+            for band in bands:
+                with open(tile_output(args.pizza_cutter_yaml, Tile) + f"_{band}.yaml", "w") as fp:
+                    fp.write(yaml.dump(yaml_data[band], default_flow_style=False))
+
+    if verbose > 0:
+        db_query.print_query_stats()
 
     exit()
@@ -18,9 +18,9 @@ if __name__ == "__main__":
     import despydb.desdbi
     import time
     from despymisc.miscutils import fwsplit
-    import intgutils.queryutils as queryutils
     import mepipelineappintg.coadd_query as me
     import mepipelineappintg.mepochmisc as mepochmisc
+    import mepipelineappintg.db_query as db_query
 
     svnid = "$Id: query_coadd_for_mof.py 47811 2018-10-12 20:39:19Z rgruendl $"
 
@@ -51,6 +51,8 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 4)')
     args = parser.parse_args()
@@ -90,7 +92,9 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
 
     t0 = time.time()
     if args.meds:
@@ -114,43 +118,23 @@ if __name__ == "__main__":
     #
     dbh.close()
     #
-    #   Convert the ImgDict to an LLD (list of list of dictionaries)
-    #   While doing the assembly get a count of number of Imgs per band
+    #   Write the list (WCL) of MEDs or PSF model files.
+    #   While doing so get a count of number of files per band
     #
-    OutDict = {}
     BandCnt = {}
     for band in BandList:
         BandCnt[band] = 0
 
     if args.meds:
-        for MED_Img in MED_Dict:
-            OutDict[MED_Img] = {}
-            OutDict[MED_Img]['meds'] = MED_Dict[MED_Img]
-            BandCnt[MED_Dict[MED_Img]['band']] = BandCnt[MED_Dict[MED_Img]['band']] + 1
+        OutDict = MED_Dict
         filetypes = ['meds']
         mdatatypes = {'meds': ['filename', 'compression', 'band']}
     else:
-        for PSF_Model in PSF_Dict:
-            OutDict[PSF_Model] = {}
-            OutDict[PSF_Model]['psfmodel'] = PSF_Dict[PSF_Model]
-            BandCnt[PSF_Dict[PSF_Model]['band']] = BandCnt[PSF_Dict[PSF_Model]['band']] + 1
+        OutDict = PSF_Dict
         filetypes = ['psfmodel']
         mdatatypes = {'psfmodel': ['filename', 'compression', 'expnum', 'ccdnum', 'band']}
 
-    Img_LLD = me.ImgDict_to_LLD(OutDict, filetypes, mdatatypes, verbose)
-
-    #
-    #   If a high level of verbosity is present print the results.
-    #
-    if verbose > 3:
-        print("Query results for COADD (SWarp) inputs (LLD format).")
-        for Img in Img_LLD:
-            print(Img)
-    #
-    #   Here a function call is needed to take the Img_LLD and write results to the output file.
-    #
-    Img_lines = queryutils.convert_multiple_files_to_lines(Img_LLD, filetypes)
-    queryutils.output_lines(args.outfile, Img_lines)
+    BandCnt.update(me.write_image_lists(OutDict, {}, filetypes, mdatatypes, args.outfile, verbose=verbose))
 
     #
     #   Provide a quick summary of the number of images found for COADD
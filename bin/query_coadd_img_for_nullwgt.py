@@ -18,9 +18,11 @@ if __name__ == "__main__":
     import despydb.desdbi
     import time
     from despymisc.miscutils import fwsplit
-    import intgutils.queryutils as queryutils
     import mepipelineappintg.coadd_query as me
     import mepipelineappintg.mepochmisc as mepochmisc
+    import mepipelineappintg.db_query as db_query
+    from mepipelineappintg.image_table import ImageTable
+    import mepipelineappintg.overlap_index as overlap_index
 
     svnid = "$Id: query_coadd_img_for_nullwgt.py 48356 2019-03-07 16:26:23Z rgruendl $"
 
@@ -48,6 +50,12 @@ if __name__ == "__main__":
     parser.add_argument('--fiat_table', action='store', type=str, default='Y3A1_IMAGE_TO_TILE',
                         help='Optional table that contains a direct correspondence between image (FILENAME) and tile (TILENAME). (Default=Y3A1_IMAGE_TO_TILE)')
     parser.add_argument('--brute_force', action='store_true', default=False, help='Redirects query to obtain images by making a brute force comparison between IMAGE table and COADDTILE_GEOM (Default=False)')
+    parser.add_argument('--overlap_index', action='store_true', default=False,
+                        help='Obtain images using a local (cached) index of image extents for the PROCTAG rather than an image-to-tile query (Default=False)')
+    parser.add_argument('--cache_dir', action='store', type=str, default=None,
+                        help='Directory holding the cached image extents used with --overlap_index (Default=$MEPIPELINEAPPINTG_CACHE_DIR)')
+    parser.add_argument('--rebuild_cache', action='store_true', default=False,
+                        help='Force the cached image extents used with --overlap_index to be rebuilt (Default=False)')
     parser.add_argument('--magbase', action='store', type=float, default=30.0,
                         help='Fiducial/reference magnitude for COADD (default=30.0)')
     parser.add_argument('--zpt2', action='store', type=str, default=None,
@@ -56,6 +64,8 @@ if __name__ == "__main__":
                         help='SOURCE constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--z2version', action='store', type=str, default=None,
                         help='VERSION constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--zpt_single_query', action='store_true', default=False,
+                        help='Resolve primary and secondary ZPTs with a single query. (Default=False)')
     parser.add_argument('--z2flag', action='store', type=str, default=None,
                         help='FLAG constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--archive', action='store', type=str, default='desar2home',
@@ -64,6 +74,8 @@ if __name__ == "__main__":
                         help='Suppress inclusion of BKGD, SEGMAP, PSF model  products')
     parser.add_argument('--imglist', action='store', type=str, default=None,
                         help='Optional output of a txt-file listing showing expnum, ccdnum, band, zeropoint')
+    parser.add_argument('--type-lists', dest='type_lists', action='store', type=str, default=None,
+                        help='Optional prefix for per-filetype lists of the files written (PREFIX_<filetype>.list)')
     parser.add_argument('--ima_list', action='store', default=None,
                         help='Filename for optional list of returned RED_IMMASK images')
     parser.add_argument('--seg_list', action='store', default=None,
@@ -72,10 +84,14 @@ if __name__ == "__main__":
                         help='Filename for optional list of returned BKG images')
     parser.add_argument('--psf_list', action='store', default=None,
                         help='Filename for optional list of returned PSF models')
+    parser.add_argument('--parallel-stages', dest='parallel_stages', action='store', type=int, default=1,
+                        help='Number of independent query stages (each with its own DB connection) run concurrently (default=1)')
     parser.add_argument('-s', '--section', action='store', type=str, default=None,
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 4)')
     args = parser.parse_args()
@@ -233,7 +249,9 @@ if __name__ == "__main__":
         FiatTable = args.fiat_table
     else:
         FiatTable = f'{dbSchema}{args.fiat_table}'
-    if not args.brute_force:
+    if args.overlap_index:
+        print(" Will use a local index of image extents to tie Image to Tiles.")
+    elif not args.brute_force:
         print(f" Proceeding with constraints using {FiatTable:s} to tie Image to Tiles.")
     else:
         print(" Will perform a brute force query to tie Image to Tiles.")
@@ -247,12 +265,23 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
+    def connect():
+        return db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
     #    cur = dbh.cursor()
 
     t0 = time.time()
-    ImgDict = {}
-    if args.brute_force:
+    ImgDict = ImageTable()
+    if args.overlap_index:
+        print(f"Images Acquired from local overlap index for tile={args.tile}")
+        TileDict = me.query_coadd_geometry({}, args.tile, dbh, dbSchema, verbose)
+        OverlapIndex = overlap_index.get_overlap_index(args.proctag, ArchiveSite, dbh, dbSchema,
+                                                       cachedir=args.cache_dir, rebuild=args.rebuild_cache,
+                                                       verbose=verbose)
+        ImgDict = overlap_index.query_coadd_img_by_index(ImgDict, TileDict[args.tile], BandList, OverlapIndex, verbose)
+    elif args.brute_force:
         print(f"Images Acquired by Brute Force Query using edges for tile={args.tile}")
         ImgDict = me.query_coadd_img_by_edges(ImgDict, args.tile, args.proctag, BandList, ArchiveSite,
                                               dbh, dbSchema, verbose)
@@ -264,47 +293,32 @@ if __name__ == "__main__":
     print(f"    Execution Time: {time.time() - t0:.2f}")
     print("    Img Dict size: ", len(ImgDict))
 
-    if ZptInfo is not None:
-        ImgDict = me.query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose)
-        print("ZeroPoint query run ")
-        print(f"    Execution Time: {time.time() - t0:.2f}")
-        print("    Img Dict size: ", len(ImgDict))
-
-    if BlacklistInfo is not None:
-        ImgDict = me.query_blacklist(ImgDict, BlacklistInfo, dbh, dbSchema, verbose)
-        print("Blacklist query run ")
-        print(f"    Execution Time: {time.time() - t0:.2f}")
-        print("    Img Dict size: ", len(ImgDict))
+    if not args.no_MEDs:
+        AncTypes = ['red_bkg', 'red_segmap', 'psfex_model', 'cat_finalcut']
+    else:
+        AncTypes = ['cat_finalcut']
     #
-    #   Convert zeropoint (mag_zero) into a fluxscale.
+    #   Zeropoint and blacklist queries run as independent stages, the ancillary query (after conversion
+    #   of zeropoints into fluxscale) depends on both.
     #
-    for Img in ImgDict:
-        if 'mag_zero' in ImgDict[Img]:
-            ImgDict[Img]['fluxscale'] = 10. ** (0.4 * (MagBase - ImgDict[Img]['mag_zero']))
-        else:
-            ImgDict[Img]['mag_zero'] = MagBase
-            ImgDict[Img]['fluxscale'] = 1.0
+    ImgDict, AncDict = me.query_image_inputs_staged(ImgDict, ZptInfo, ZptSecondary, BlacklistInfo, AncTypes,
+                                                    ArchiveSite, dbh, dbSchema, MagBase=MagBase,
+                                                    SingleQuery=args.zpt_single_query,
+                                                    nconn=args.parallel_stages, connect=connect, verbose=verbose)
+    print("ZeroPoint, Blacklist and ancillary queries run ")
+    print(f"    Execution Time: {time.time() - t0:.2f}")
+    print("    Img Dict size: ", len(ImgDict))
 
     if not args.no_MEDs:
-        BkgDict = me.query_bkg_img(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
-        print(" Bkg image query run")
-        print(f"    Execution Time: {time.time() - t0:.2f}")
+        BkgDict = AncDict['red_bkg']
+        SegDict = AncDict['red_segmap']
+        PsfDict = AncDict['psfex_model']
+        print(" Bkg image, Segmentation Map, and PSF model query run")
         print("    Bkg Dict size: ", len(BkgDict))
-
-    #if not args.no_MEDs:
-        SegDict = me.query_segmap(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
-        print(" Segmentation Map query run")
-        print(f"    Execution Time: {time.time() - t0:.2f}")
         print("    Seg Dict size: ", len(SegDict))
-
-    #if  not args.no_MEDs:
-        PsfDict = me.query_psfmodel(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
-        print(" Segmentation Map query run")
-        print(f"    Execution Time: {time.time() - t0:.2f}")
         print("    PSF Dict size: ", len(PsfDict))
 
-
-    CatDict = me.query_catfinalcut(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
+    CatDict = AncDict['cat_finalcut']
     print(" Catalog query run")
     print(f"    Execution Time: {time.time() - t0:.2f}")
     print("    Cat Dict size: ", len(CatDict))
@@ -323,32 +337,15 @@ if __name__ == "__main__":
             print(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['fluxscale']:6.3f} {ImgDict[Img]['filename']:s}")
 
     #
-    #   Convert the ImgDict to an LLD (list of list of dictionaries)
-    #   While doing the assembly get a count of number of Imgs per band
+    #   Write the list of inputs (the records for each filetype are joined as each line is written)
+    #   and the optional image list.  While doing so get a count of number of Imgs per band
     #
-    OutDict = {}
-    BandCnt = {}
-    for band in BandList:
-        BandCnt[band] = 0
-    for Img in ImgDict:
-        if args.no_MEDs:
-            if Img in CatDict:
-                OutDict[Img] = {'red': ImgDict[Img],
-                                'cat': CatDict[Img]}
-                BandCnt[ImgDict[Img]['band']] = BandCnt[ImgDict[Img]['band']] + 1
-        else:
-            if Img in BkgDict and Img in SegDict and Img in CatDict and Img in PsfDict:
-                OutDict[Img] = {'red': ImgDict[Img],
-                                'bkg': BkgDict[Img],
-                                'seg': SegDict[Img],
-                                'psf': PsfDict[Img],
-                                'cat': CatDict[Img]}
-                BandCnt[ImgDict[Img]['band']] = BandCnt[ImgDict[Img]['band']] + 1
-
     if args.no_MEDs:
         filetypes = ['red', 'cat']
         mdatatypes = {'red': ['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero', 'fluxscale'],
                       'cat': ['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero']}
+        AncDicts = {'cat': CatDict}
+        ImgListTypes = ['cat']
     else:
         filetypes = ['red', 'bkg', 'seg', 'psf', 'cat']
         mdatatypes = {'red':['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero', 'fluxscale'],
@@ -356,20 +353,15 @@ if __name__ == "__main__":
                       'seg':['filename', 'compression', 'expnum', 'ccdnum', 'band'],
                       'psf':['filename', 'compression', 'expnum', 'ccdnum', 'band'],
                       'cat':['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero']}
-    Img_LLD = me.ImgDict_to_LLD(OutDict, filetypes, mdatatypes, verbose)
+        AncDicts = {'bkg': BkgDict, 'seg': SegDict, 'psf': PsfDict, 'cat': CatDict}
+        ImgListTypes = ['bkg', 'seg', 'cat']
+    TypeLists = None
+    if args.type_lists is not None:
+        TypeLists = {ftype: f"{args.type_lists:s}_{ftype:s}.list" for ftype in filetypes}
 
-    #
-    #   If a high level of verbosity is present print the results.
-    #
-    if verbose > 3:
-        print("Query results for COADD (SWarp) inputs (LLD format).")
-        for Img in Img_LLD:
-            print(Img)
-    #
-    #   Here a function call is needed to take the Img_LLD and write results to the output file.
-    #
-    Img_lines = queryutils.convert_multiple_files_to_lines(Img_LLD, filetypes)
-    queryutils.output_lines(args.outfile, Img_lines)
+    BandCnt = {band: 0 for band in BandList}
+    BandCnt.update(me.write_image_lists(ImgDict, AncDicts, filetypes, mdatatypes, args.outfile, imglist=args.imglist,
+                                        imglist_types=ImgListTypes, typelists=TypeLists, verbose=verbose))
 
     #
     #   Provide a quick summary of the number of images found for COADD
@@ -379,22 +371,6 @@ if __name__ == "__main__":
         print("Summary results for COADD image imputs")
         for band in BandList:
             print(f"  Identified {BandCnt[band]:5d} images for {band:s}-band")
-    #
-    #   Secondary (optional) output of a list of images found by the query.
-    #
-    if args.imglist is not None:
-        imgfile = open(args.imglist, 'w')
-        for Img in ImgDict:
-            wrec = False
-            if args.no_MEDs:
-                if Img in CatDict:
-                    wrec = True
-            else:
-                if Img in BkgDict and Img in SegDict and Img in CatDict:
-                    wrec = True
-            if wrec:
-                imgfile.write(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['mag_zero']:8.5f}\n")
-        imgfile.close()
 
     #
     #   Check that all bands that make up the detection image have at least one entry
@@ -444,4 +420,7 @@ if __name__ == "__main__":
         else:
             print(f"Option --no_MEDs precludes search for PSF models.  Skipping write for --psf_list {args.psf_list:s}")
 
+    if verbose > 0:
+        db_query.print_query_stats()
+
     exit()
@@ -20,9 +20,10 @@ if __name__ == "__main__":
     import despydb.desdbi
     import time
     from despymisc.miscutils import fwsplit
-    import intgutils.queryutils as queryutils
     import mepipelineappintg.coadd_query as me
     import mepipelineappintg.mepochmisc as mepochmisc
+    import mepipelineappintg.db_query as db_query
+    from mepipelineappintg.image_table import ImageTable
 
     svnid = "$Id: query_coadd_meds_standalone.py 46438 2018-01-04 20:38:17Z rgruendl $"
 
@@ -56,12 +57,16 @@ if __name__ == "__main__":
                         help='SOURCE constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--z2version', action='store', type=str, default=None,
                         help='VERSION constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--zpt_single_query', action='store_true', default=False,
+                        help='Resolve primary and secondary ZPTs with a single query. (Default=False)')
     parser.add_argument('--z2flag', action='store', type=str, default=None,
                         help='FLAG constraint on secondary ZPT queries. (Default=None)')
     parser.add_argument('--archive', action='store', type=str, default='desar2home',
                         help='Archive site where data are being drawn from')
     parser.add_argument('--imglist', action='store', type=str, default=None,
                         help='Optional output of a txt-file listing showing expnum, ccdnum, band, zeropoint')
+    parser.add_argument('--type-lists', dest='type_lists', action='store', type=str, default=None,
+                        help='Optional prefix for per-filetype lists of the files written (PREFIX_<filetype>.list)')
     parser.add_argument('--ima_list', action='store', default=None,
                         help='Filename with list of returned IMG list')
     parser.add_argument('--bkg_list', action='store', default=None,
@@ -70,6 +75,8 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 4)')
     args = parser.parse_args()
@@ -241,7 +248,9 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section, retry=True)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section, retry=True))
     #    cur = dbh.cursor()
 
     t0 = time.time()
@@ -261,46 +270,26 @@ if __name__ == "__main__":
     #   Now obtain the input images and their associated .head files by matching to the nullwgt images from the COADD attempt
     #
     print(f"Acquiring single-epoch images based on previous attempt for tile={args.tile:s}")
-    ImgDict = {}
+    ImgDict = ImageTable()
     ImgDict = me.query_coadd_img_from_attempt(ImgDict, attemptID, BandList, ArchiveSite, dbh,
                                               dbSchema, verbose)
     print(f"    Execution Time: {time.time() - t0:.2f}")
     print(f"    Img Dict size: {len(ImgDict):d}")
 
-    ImgDict = me.query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose)
+    ImgDict, AncDict = me.query_image_inputs_staged(ImgDict, ZptInfo, ZptSecondary, None,
+                                                    ['coadd_head_scamp', 'red_bkg', 'red_segmap'],
+                                                    ArchiveSite, dbh, dbSchema, MagBase=MagBase,
+                                                    SingleQuery=args.zpt_single_query,
+                                                    attemptID=attemptID, verbose=verbose)
     print("ZeroPoint query run ")
-    print(f"    Execution Time: {time.time() - t0:.2f}")
     print(f"    Img Dict size: {len(ImgDict):d}")
-
-    #    if (BlacklistInfo is not None):
-    #        ImgDict=me.query_blacklist(ImgDict,BlacklistInfo,dbh,dbSchema,verbose)
-    #        print "Blacklist query run "
-    #        print "    Execution Time: %.2f" % (time.time()-t0)
-    #        print "    Img Dict size: ",len(ImgDict)
-
-    #
-    #   Convert zeropoint (mag_zero) into a fluxscale.
-    #
-    for Img in ImgDict:
-        if 'mag_zero' in ImgDict[Img]:
-            ImgDict[Img]['fluxscale'] = 10. ** (0.4 * (MagBase - ImgDict[Img]['mag_zero']))
-        else:
-            ImgDict[Img]['mag_zero'] = MagBase
-            ImgDict[Img]['fluxscale'] = 1.0
-
-    HeadDict = me.query_headfile_from_attempt(ImgDict, attemptID, ArchiveSite, dbh, dbSchema, verbose)
-    print(" Head file query run")
+    HeadDict = AncDict['coadd_head_scamp']
+    BkgDict = AncDict['red_bkg']
+    SegDict = AncDict['red_segmap']
+    print(" Head file, Bkg image, and Segmentation Map query run")
     print(f"    Execution Time: {time.time() - t0:.2f}")
     print(f"    Head Dict size: {len(HeadDict):d} ")
-
-    BkgDict = me.query_bkg_img(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
-    print(" Bkg image query run")
-    print(f"    Execution Time: {time.time() - t0:.2f}")
     print(f"    Bkg Dict size: {len(BkgDict):d}")
-
-    SegDict = me.query_segmap(ImgDict, ArchiveSite, dbh, dbSchema, verbose)
-    print(" Segmentation Map query run")
-    print(f"    Execution Time: {time.time() - t0:.2f}")
     print(f"    Seg Dict size: {len(SegDict):d}")
 
     #
@@ -316,40 +305,22 @@ if __name__ == "__main__":
             print(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['fluxscale']:6.3f} {ImgDict[Img]['filename']:s}")
 
     #
-    #   Convert the ImgDict to an LLD (list of list of dictionaries)
-    #   While doing the assembly get a count of number of Imgs per band
+    #   Write the list of inputs (the records for each filetype are joined as each line is written)
+    #   and the optional image list.  While doing so get a count of number of Imgs per band
     #
-    OutDict = {}
-    BandCnt = {}
-    for band in BandList:
-        BandCnt[band] = 0
-    for Img in ImgDict:
-        if Img in BkgDict and Img in SegDict and Img in HeadDict:
-            OutDict[Img] = {'red': ImgDict[Img],
-                            'bkg': BkgDict[Img],
-                            'seg': SegDict[Img],
-                            'head': HeadDict[Img]}
-            BandCnt[ImgDict[Img]['band']] = BandCnt[ImgDict[Img]['band']] + 1
-
     filetypes = ['red', 'bkg', 'seg', 'head']
     mdatatypes = {'red':['filename', 'compression', 'expnum', 'ccdnum', 'band', 'mag_zero', 'fluxscale'],
                   'bkg':['filename', 'compression', 'expnum', 'ccdnum', 'band'],
                   'seg':['filename', 'compression', 'expnum', 'ccdnum', 'band'],
                   'head':['filename', 'compression', 'expnum', 'ccdnum', 'band']}
-    Img_LLD = me.ImgDict_to_LLD(OutDict, filetypes, mdatatypes, verbose)
+    AncDicts = {'bkg': BkgDict, 'seg': SegDict, 'head': HeadDict}
+    TypeLists = None
+    if args.type_lists is not None:
+        TypeLists = {ftype: f"{args.type_lists:s}_{ftype:s}.list" for ftype in filetypes}
 
-    #
-    #   If a high level of verbosity is present print the results.
-    #
-    if verbose > 3:
-        print("Query results for COADD (SWarp) inputs (LLD format).")
-        for Img in Img_LLD:
-            print(Img)
-    #
-    #   Here a function call is needed to take the Img_LLD and write results to the output file.
-    #
-    Img_lines = queryutils.convert_multiple_files_to_lines(Img_LLD, filetypes)
-    queryutils.output_lines(args.outfile, Img_lines)
+    BandCnt = {band: 0 for band in BandList}
+    BandCnt.update(me.write_image_lists(ImgDict, AncDicts, filetypes, mdatatypes, args.outfile, imglist=args.imglist,
+                                        typelists=TypeLists, verbose=verbose))
 
     #
     #   Provide a quick summary of the number of images found for COADD
@@ -359,18 +330,6 @@ if __name__ == "__main__":
         print("Summary results for COADD image imputs")
         for band in BandList:
             print(f"  Identified {BandCnt[band]:5d} images for {band:s}-band")
-    #
-    #   Secondary (optional) output of a list of images found by the query.
-    #
-    if args.imglist is not None:
-        imgfile = open(args.imglist, 'w')
-        for Img in ImgDict:
-            wrec = False
-            if Img in BkgDict and Img in SegDict and Img in HeadDict:
-                wrec = True
-            if wrec:
-                imgfile.write(f" {ImgDict[Img]['expnum']:8d} {ImgDict[Img]['ccdnum']:2d} {ImgDict[Img]['band']:5s} {ImgDict[Img]['mag_zero']:8.5f}\n")
-        imgfile.close()
 
     #
     #   Check that all bands that make up the detection image have at least one entry
@@ -401,4 +360,7 @@ if __name__ == "__main__":
     if args.bkg_list:
         mepochmisc.write_textlist(dbh, BkgDict, args.bkg_list, fields=['fullname', 'band'], verb=args.verbose)
 
+    if verbose > 0:
+        db_query.print_query_stats()
+
     exit()
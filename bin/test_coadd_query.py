@@ -19,8 +19,10 @@ if __name__ == "__main__":
     import os
     import despydb.desdbi
     import time
+    import copy
     from despymisc.miscutils import fwsplit
     import mepipelineappintg.coadd_query as me
+    import mepipelineappintg.db_query as db_query
 
     svnid = "$Id: test_coadd_query.py 42694 2016-06-13 21:56:09Z rgruendl $"
 
@@ -47,6 +49,16 @@ if __name__ == "__main__":
                         help='VERSION constraint on ZEROPOINT table to use in queries. (Default=None)')
     parser.add_argument('--zflag', action='store', type=str, default=None,
                         help='FLAG constraint on ZEROPOINT table to use in queries. (Default=None)')
+    parser.add_argument('--zpt2', action='store', type=str, default=None,
+                        help='ZEROPOINT table to use secondary ZPT queries. (Default=None)')
+    parser.add_argument('--z2source', action='store', type=str, default=None,
+                        help='SOURCE constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--z2version', action='store', type=str, default=None,
+                        help='VERSION constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--z2flag', action='store', type=str, default=None,
+                        help='FLAG constraint on secondary ZPT queries. (Default=None)')
+    parser.add_argument('--zptcompare', action='store_true', default=False,
+                        help='Compare results and timing for the separate and single query zeropoint paths (requires edge query)')
     parser.add_argument('--blacklist', action='store', type=str, default='BLACKLIST',
                         help='BLACKLIST table to use in queries. (Default=BLACKLIST, "NONE", results in no blacklist constraint')
     parser.add_argument('--magbase', action='store', type=float, default=30.0,
@@ -59,6 +71,8 @@ if __name__ == "__main__":
                         help='section of .desservices file with connection info')
     parser.add_argument('-S', '--Schema', action='store', type=str, default=None,
                         help='DB schema (do not include \'.\').')
+    parser.add_argument('--db-trace', dest='db_trace', action='store', type=str, default=None,
+                        help='Write a JSON trace of the DB calls (timing, rows, bytes per query) to this file at exit')
     parser.add_argument('-v', '--verbose', action='store', type=int, default=0,
                         help='Verbosity (defualt:0; currently values up to 2)')
     args = parser.parse_args()
@@ -148,6 +162,25 @@ if __name__ == "__main__":
         if ZptInfo is not None:
             print("   Skipping constraint on ZEROPOINT using FLAG")
 
+    #
+    #   Secondary ZEROPOINT capablity/constraint
+    #
+    if args.zpt2 is None:
+        ZptSecondary = None
+    else:
+        ZptSecondary = {}
+        if len(args.zpt2.split('.')) > 1:
+            ZptSecondary['table'] = args.zpt2
+        else:
+            ZptSecondary['table'] = '{}{}'.format(dbSchema, args.zpt2)
+        if args.z2source is not None:
+            ZptSecondary['source'] = args.z2source
+        if args.z2version is not None:
+            ZptSecondary['version'] = args.z2version
+        if args.z2flag is not None:
+            ZptSecondary['flag'] = args.z2flag
+        print(" Proceeding with secondary ZPT constraints: {}".format(ZptSecondary))
+
     #
     #   Specify BLACKLIST table for use
     #
@@ -169,7 +202,9 @@ if __name__ == "__main__":
         desdmfile = os.environ["des_services"]
     except KeyError:
         desdmfile = None
-    dbh = despydb.desdbi.DesDbi(desdmfile, args.section)
+    if args.db_trace is not None:
+        db_query.enable_trace(args.db_trace)
+    dbh = db_query.trace_connection(despydb.desdbi.DesDbi(desdmfile, args.section))
     #    cur = dbh.cursor()
 
     if args.tile == "TESTBED":
@@ -229,7 +264,7 @@ if __name__ == "__main__":
         if args.edgequery or TestAll:
             t0 = time.time()
             ImgDict = {}
-            ImgDict = me.query_coadd_img_by_edges(ImgDict, tile, args.proctag, BlacklistInfo,
+            ImgDict = me.query_coadd_img_by_edges(ImgDict, tile, args.proctag, BandList,
                                                   ArchiveSite, dbh, dbSchema, verbose)
             print("Img Acquired by Query using edges for tile={}".format(tile))
             print("    Execution Time: {:.2f}".format(time.time() - t0))
@@ -243,6 +278,27 @@ if __name__ == "__main__":
                 else:
                     ImgDict[Img]['fluxscale'] = 1.0
 
+        if (args.edgequery or TestAll) and args.zptcompare and ZptInfo is not None:
+            #
+            #   Compare the (two query) zeropoint path with the single query version
+            #
+            t0 = time.time()
+            ZptDict1 = me.query_zeropoint(copy.deepcopy(ImgDict), ZptInfo, ZptSecondary, dbh, dbSchema, verbose=verbose)
+            t1 = time.time()
+            ZptDict2 = me.query_zeropoint(copy.deepcopy(ImgDict), ZptInfo, ZptSecondary, dbh, dbSchema,
+                                          SingleQuery=True, verbose=verbose)
+            t2 = time.time()
+            print("Zeropoint comparison for tile={}".format(tile))
+            print("    Separate queries: {:d} images  Execution Time: {:.2f}".format(len(ZptDict1), t1 - t0))
+            print("    Single query:     {:d} images  Execution Time: {:.2f}".format(len(ZptDict2), t2 - t1))
+            nDiff = 0
+            for Img in set(ZptDict1) | set(ZptDict2):
+                if Img not in ZptDict1 or Img not in ZptDict2 or ZptDict1[Img]['mag_zero'] != ZptDict2[Img]['mag_zero']:
+                    nDiff = nDiff + 1
+                    if verbose > 0:
+                        print("    Mismatch: {:s}".format(Img))
+            print("    Number of mismatched images: {:d}".format(nDiff))
+
         if args.compIMG or TestAll:
             for Img in ImgDict:
                 if Img in MeImgDict:
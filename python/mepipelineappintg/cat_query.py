@@ -9,15 +9,17 @@ and then extracting catalog data (organized with RA, Dec) based on those boundar
 """
 
 import time
-import pandas as pd
 import numpy as np
 
+from mepipelineappintg.tile_geom import get_tile_geom
+from mepipelineappintg.db_query import bind, query_cursor
+
 ########################################################################
 def query_Tile_edges(Tile,dbh,dbSchema='DES_ADMIN.',table='Y6A1_COADDTILE_GEOM',ubound=False,verbose=0):
     """ Pull tile edges from a COADDTILE_GEOM release table:
 
         Tile:       Name of Tile to poll for information.
-        dbh:        Database connection to be used
+        dbh:        Database connection to be used (None limits lookup to the cached geometry)
         dbSchema:   DB schema (default='DES_ADMIN')
         table:      Name of coadd tile geometry table (default='Y6A1_COADDTILE_GEOM')
         ubound:     Use unique area boundaries rather than tile edge.
@@ -26,21 +28,36 @@ def query_Tile_edges(Tile,dbh,dbSchema='DES_ADMIN.',table='Y6A1_COADDTILE_GEOM',
         Return:     Dict with Tile for key containing information
     """
     
+#
+#   Use the (cached) snapshot of the COADDTILE_GEOM table when possible
+#
+    if (ubound):
+        GeomCols={'tilename':'tilename','racmin':'uramin','racmax':'uramax','deccmin':'udecmin','deccmax':'udecmax','crossra0':'crossra0'}
+    else:
+        GeomCols=['tilename','racmin','racmax','deccmin','deccmax','crossra0']
+    tile_data=get_tile_geom(Tile,"{schema:s}{tbl:s}".format(schema=dbSchema,tbl=table),dbh,columns=GeomCols,verbose=verbose)
+    if (Tile in tile_data):
+        if ((ubound)and(verbose > 0)):
+            print("Note: returning UNIQUE area columns (e.g. URAMIN) as if they were those describing total extent (e.g. RACMIN)")
+        print("# Sucessfull lookup for {schema:s}{tbl:s} (cached geometry)".format(schema=dbSchema,tbl=table))
+        return tile_data
+    if (dbh is None):
+        raise ValueError("ERROR: {tname:s} not found in cached geometry for {schema:s}{tbl:s} (and no DB connection to query)".format(
+            schema=dbSchema,tbl=table,tname=Tile))
 
     if (ubound):
-        QUERY = """select tilename,uramin as racmin,uramax as racmax,udecmin as deccmin,udecmax as deccmax,crossra0 from {schema:s}{tbl:s} where tilename='{tname:s}'""".format(schema=dbSchema,tbl=table,tname=Tile)
+        QUERY = """select tilename,uramin as racmin,uramax as racmax,udecmin as deccmin,udecmax as deccmax,crossra0 from {schema:s}{tbl:s} where tilename={tname:s}""".format(schema=dbSchema,tbl=table,tname=bind(dbh,'tilename'))
         if (verbose > 0):
             print("Note: query is pulling a fast one.")
             print("   Returning UNIQUE area columns (e.g. URAMIN) as if they were those describing total extent (e.g. RACMIN)")
     else:
-        QUERY = """select tilename,racmin,racmax,deccmin,deccmax,crossra0 from {schema:s}{tbl:s} where tilename='{tname:s}'""".format(schema=dbSchema,tbl=table,tname=Tile)
+        QUERY = """select tilename,racmin,racmax,deccmin,deccmax,crossra0 from {schema:s}{tbl:s} where tilename={tname:s}""".format(schema=dbSchema,tbl=table,tname=bind(dbh,'tilename'))
 
     if (verbose>0):
         print("# Will query: ")
         print(QUERY)
 
-    curDB = dbh.cursor()
-    curDB.execute(QUERY)
+    curDB = query_cursor(dbh,QUERY,{'tilename':Tile},verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     tile_data={}
@@ -167,6 +184,155 @@ def expand_range(tDict,extend=0.0,method='fixed',verbose=0):
     return tDict
 
 
+#########################################################################
+def column_dtype(desc,value=None):
+    """ Choose a numpy type for a column based on the cursor description (falling back
+        to the type of a returned value when the description does not say)
+
+        desc:       Entry from curDB.description for the column (name,type_code,...,precision,scale,...)
+        value:      A (non-NULL) value from the column (or None)
+
+        Return:     numpy dtype (object for strings, which are converted once all rows are read)
+    """
+    if (not typed_by_value(desc)):
+        tname=str(getattr(desc[1],'name',desc[1])).upper()
+        if (('DOUBLE' in tname)or('FLOAT' in tname)):
+            return np.dtype('f8')
+        if ('NUMBER' in tname):
+            prec=desc[4] if len(desc) > 4 else None
+            scale=desc[5] if len(desc) > 5 else None
+            if ((scale == 0)and(prec is not None)and(0 < prec < 19)):
+                return np.dtype('i8')
+            return np.dtype('f8')
+        if (('CHAR' in tname)or('STRING' in tname)):
+            return np.dtype(object)
+#
+#   Description did not identify the type (e.g. other DBI implementations, or a NUMBER that
+#   may hold integers beyond the precision of a float) so use a value
+#
+    if (isinstance(value,(bool,np.bool_))):
+        return np.dtype('?')
+    if (isinstance(value,(int,np.integer))):
+        return np.dtype('i8')
+    if (isinstance(value,(float,np.floating))):
+        return np.dtype('f8')
+    return np.dtype(object)
+
+
+#########################################################################
+def typed_by_value(desc):
+    """ Check whether a column must be typed from its values (rather than the cursor description).
+        This is the case for a description without a recognized type, and for NUMBER columns that
+        are unconstrained or are integers of 19 or more digits (e.g. GAIA source_id), which would
+        lose precision as f8.
+
+        desc:       Entry from curDB.description for the column (name,type_code,...,precision,scale,...)
+
+        Return:     Bool
+    """
+    tname=str(getattr(desc[1],'name',desc[1])).upper()
+    if (('DOUBLE' in tname)or('FLOAT' in tname)or('CHAR' in tname)or('STRING' in tname)):
+        return False
+    if ('NUMBER' in tname):
+        prec=desc[4] if len(desc) > 4 else None
+        scale=desc[5] if len(desc) > 5 else None
+        if ((prec is None)or(prec == 0)or(scale is None)or(scale == -127)):
+            return True
+        return ((scale == 0)and(prec >= 19))
+    return True
+
+
+#########################################################################
+def integer_values_dtype(vals):
+    """ Choose the numpy type able to hold (exactly) a chunk of values from a column typed as integer
+
+        vals:       Sequence of values
+
+        Return:     numpy dtype: i8, f8 (when non-integer values are present), or object (when
+                        values exceed int64, or to keep integers exact alongside NULLs)
+    """
+    null=False
+    real=False
+    for v in vals:
+        if (v is None):
+            null=True
+        elif (isinstance(v,(float,np.floating))):
+            real=True
+        elif (not (-2**63 <= v < 2**63)):
+            return np.dtype(object)
+    if (real):
+        return np.dtype('f8')
+    if (null):
+        return np.dtype(object)
+    return np.dtype('i8')
+
+
+#########################################################################
+def fetch_columns(curDB,header,prefetch=100000,verbose=0):
+    """ Stream the rows of an executed query (using fetchmany) into numpy column buffers.
+        Buffers are preallocated and grown/trimmed in place (so that the only copy of the data held
+        is the arrays themselves plus one chunk of rows).
+
+        curDB:      Cursor (query already executed)
+        header:     List of column names (order matching curDB.description)
+        prefetch:   Number of rows fetched per call (also the initial buffer size)
+        verbose:    Sets level of verbosity.
+
+        Return:     Dict of numpy arrays (one for each column), Number of rows
+    """
+
+    curDB.arraysize=int(prefetch)
+    desc=curDB.description
+    ValueTyped=set([col for i,col in enumerate(header) if typed_by_value(desc[i])])
+    Buffer=None
+    nrow=0
+    while True:
+        rows=curDB.fetchmany(int(prefetch))
+        if (len(rows) < 1):
+            break
+        ColVals=list(zip(*rows))
+        if (Buffer is None):
+            Buffer={}
+            for i,col in enumerate(header):
+                firstval=next((v for v in ColVals[i] if v is not None),None)
+                Buffer[col]=np.empty(max(int(prefetch),len(rows)),dtype=column_dtype(desc[i],firstval))
+        if (nrow+len(rows) > Buffer[header[0]].size):
+            newsize=max(2*Buffer[header[0]].size,nrow+len(rows))
+            for col in header:
+                Buffer[col].resize(newsize,refcheck=False)
+        for i,col in enumerate(header):
+#
+#           Integer columns typed from their values are widened when a chunk holds values that i8 cannot
+#           (exactly) represent
+#
+            if ((col in ValueTyped)and(Buffer[col].dtype == np.dtype('i8'))):
+                dtype=integer_values_dtype(ColVals[i])
+                if (dtype != Buffer[col].dtype):
+                    Buffer[col]=Buffer[col].astype(dtype)
+            try:
+                Buffer[col][nrow:nrow+len(rows)]=ColVals[i]
+            except (TypeError,ValueError):
+#
+#               An integer column with NULLs (promote to float so NULL can be NaN)
+#
+                Buffer[col]=Buffer[col].astype('f8')
+                Buffer[col][nrow:nrow+len(rows)]=np.array(ColVals[i],dtype='f8')
+        nrow=nrow+len(rows)
+        if (verbose > 2):
+            print("# Fetched {:d} rows".format(nrow))
+
+    CatDict={}
+    for col in header:
+        if (Buffer is None):
+            CatDict[col]=np.array([])
+        elif (Buffer[col].dtype == object):
+            CatDict[col]=np.array(Buffer[col][:nrow].tolist())
+        else:
+            Buffer[col].resize(nrow,refcheck=False)
+            CatDict[col]=Buffer[col]
+    return CatDict,nrow
+
+
 #########################################################################
 def get_cat_radec_range(radec_box,dbh,dbSchema='des_admin.',table='GAIA_DR2',cols=['ra','dec','phot_g_mean_mag'],Timing=False,verbose=0):
 
@@ -190,30 +356,30 @@ def get_cat_radec_range(radec_box,dbh,dbSchema='des_admin.',table='GAIA_DR2',col
 #
         query="""select {cname:s}
             from {schema:s}{tbl:s} 
-            where (ra < {r2:.6f} or ra > {r1:.6f})
-                and dec between {d1:.6f} and {d2:.6f}""".format(
+            where (ra < {r2:s} or ra > {r1:s})
+                and dec between {d1:s} and {d2:s}""".format(
         cname=",".join(cols),
         schema=dbSchema,
         tbl=table,
-        r1=radec_box['ra1'],
-        r2=radec_box['ra2'],
-        d1=radec_box['dec1'],
-        d2=radec_box['dec2'])
+        r1=bind(dbh,'ra1'),
+        r2=bind(dbh,'ra2'),
+        d1=bind(dbh,'dec1'),
+        d2=bind(dbh,'dec2'))
     else:
 #
 #       Form query for normal workhorse case
 #
         query="""select {cname:s}
             from {schema:s}{tbl:s} 
-            where ra between {r1:.6f} and {r2:.6f}
-                and dec between {d1:.6f} and {d2:.6f}""".format(
+            where ra between {r1:s} and {r2:s}
+                and dec between {d1:s} and {d2:s}""".format(
         cname=",".join(cols),
         schema=dbSchema,
         tbl=table,
-        r1=radec_box['ra1'],
-        r2=radec_box['ra2'],
-        d1=radec_box['dec1'],
-        d2=radec_box['dec2'])
+        r1=bind(dbh,'ra1'),
+        r2=bind(dbh,'ra2'),
+        d1=bind(dbh,'dec1'),
+        d2=bind(dbh,'dec2'))
 #
     if (verbose > 0):
         if (verbose == 1):
@@ -225,26 +391,16 @@ def get_cat_radec_range(radec_box,dbh,dbSchema='des_admin.',table='GAIA_DR2',col
         if (verbose > 1):
             print("{:s}".format(query))
 #
-#   Establish a DB cursor
+#   Execute (with RA/Dec bounds as bind variables)
 #
-    curDB = dbh.cursor()
+    QueryParams={'ra1':float(radec_box['ra1']),'ra2':float(radec_box['ra2']),'dec1':float(radec_box['dec1']),'dec2':float(radec_box['dec2'])}
+    curDB = query_cursor(dbh,query,QueryParams,verbose=verbose)
 
     prefetch=100000
-    curDB.arraysize=int(prefetch)
-    curDB.execute(query)
     header=[d[0].upper() for d in curDB.description]
-    cat_data=pd.DataFrame(curDB.fetchall())
-
-    CatDict={}
-    if (cat_data.empty):
+    CatDict,nrow=fetch_columns(curDB,header,prefetch=prefetch,verbose=verbose)
+    if (nrow < 1):
         print("# No values returned from query of {tval:s} ".format(tval="GAIA_DR2"))
-        for val in header:
-            CatDict[val]=np.array([])
-    else:
-        cat_data.columns=header
-        for val in header:
-            CatDict[val]=np.array(cat_data[val])
-    curDB.close()
 
     if (verbose>0):
         print("# Number of objects found in {schema:s}{tbl:s} is {nval:d} ".format(
@@ -258,6 +414,94 @@ def get_cat_radec_range(radec_box,dbh,dbSchema='des_admin.',table='GAIA_DR2',col
     return CatDict,header
 
 
+#########################################################################
+def select_radec_box(CatDict,radec_box):
+    """ Select the entries of a catalog that fall within an RA/Dec box (with the same
+        constraints that get_cat_radec_range places on a query)
+
+    CatDict:    Dict of numpy arrays (must include RA and DEC)
+    radec_box:  Dict w/ keys: ra1,ra2,dec1,dec2, and crossra0[bool] that describe box to search
+
+    Return:     Boolean numpy array (True for entries in the box)
+    """
+
+    ra=CatDict['RA']
+    dec=CatDict['DEC']
+    if (radec_box['crossra0']):
+        InBox=((ra<radec_box['ra2'])|(ra>radec_box['ra1']))
+    else:
+        InBox=((ra>=radec_box['ra1'])&(ra<=radec_box['ra2']))
+    InBox&=((dec>=radec_box['dec1'])&(dec<=radec_box['dec2']))
+
+    return InBox
+
+
+#########################################################################
+def merge_radec_boxes(BoxDict,verbose=0):
+    """ Merge a set of (overlapping) RA/Dec boxes into larger boxes, so that a set of
+        neighboring tiles can be served by fewer queries.  Two (overlapping) boxes are merged
+        when the box bounding them both is no larger than the sum of their areas.  This does
+        not make the merged box equal to their union (e.g. boxes offset in both RA and Dec),
+        but the sky added that neither box needs is at most the area of their overlap.
+
+    BoxDict:    Dict (keyed by name, e.g. tilename) of boxes with keys: ra1,ra2,dec1,dec2,crossra0[bool]
+    verbose:    Sets level of verbosity.
+
+    Return:     List of merged boxes (each a dict with keys ra1,ra2,dec1,dec2,crossra0,
+                and members: the list of names of the boxes it covers)
+    """
+
+#
+#   Work with RA unwrapped (so a box crossing RA=0h runs from a negative RA to a positive RA)
+#
+    Names=list(BoxDict)
+    lo=np.array([BoxDict[n]['ra1']-360. if (BoxDict[n]['crossra0']) else BoxDict[n]['ra1'] for n in Names],dtype='f8')
+    hi=np.array([BoxDict[n]['ra2'] for n in Names],dtype='f8')
+    dlo=np.array([BoxDict[n]['dec1'] for n in Names],dtype='f8')
+    dhi=np.array([BoxDict[n]['dec2'] for n in Names],dtype='f8')
+    Members=[[n] for n in Names]
+    Live=np.ones(len(Names),dtype=bool)
+
+    merged=True
+    while (merged):
+        merged=False
+        for i in np.flatnonzero(Live):
+            if (not Live[i]):
+                continue
+            area=(hi-lo)*(dhi-dlo)
+            for shift in [0.,-360.,360.]:
+                blo=np.minimum(lo[i],lo+shift)
+                bhi=np.maximum(hi[i],hi+shift)
+                barea=(bhi-blo)*(np.maximum(dhi[i],dhi)-np.minimum(dlo[i],dlo))
+                Cand=Live&(barea<=area[i]+area)&((lo+shift)<=hi[i])&((hi+shift)>=lo[i])&(dlo<=dhi[i])&(dhi>=dlo[i])&(bhi-blo<360.)
+                Cand[i]=False
+                if (np.any(Cand)):
+                    j=np.flatnonzero(Cand)[0]
+                    lo[i]=blo[j]
+                    hi[i]=bhi[j]
+                    dlo[i]=min(dlo[i],dlo[j])
+                    dhi[i]=max(dhi[i],dhi[j])
+                    Members[i].extend(Members[j])
+                    Live[j]=False
+                    merged=True
+                    break
+
+    Regions=[]
+    for i in np.flatnonzero(Live):
+        rlo=lo[i]
+        rhi=hi[i]
+        if (rlo < 0.):
+            rlo=rlo+360.
+        if (rhi > 360.):
+            rhi=rhi-360.
+        Regions.append({'ra1':float(rlo),'ra2':float(rhi),'dec1':float(dlo[i]),'dec2':float(dhi[i]),
+                        'crossra0':bool(rlo > rhi),'members':Members[i]})
+    if (verbose > 0):
+        print("# Merged {:d} boxes into {:d} regions".format(len(Names),len(Regions)))
+
+    return Regions
+
+
 #########################################################################
 def get_ALL_cat(dbh,dbSchema='DES_ADMIN.',table='GAIA_DR2',cols=['ra','dec','phot_g_mean_mag'],Timing=False,verbose=0):
 
@@ -298,17 +542,9 @@ def get_ALL_cat(dbh,dbSchema='DES_ADMIN.',table='GAIA_DR2',cols=['ra','dec','pho
     curDB.execute(query)
 #    header=[d[0].lower() for d in curDB.description]
     header=[d[0].upper() for d in curDB.description]
-    cat_data=pd.DataFrame(curDB.fetchall())
-
-    CatDict={}
-    if (cat_data.empty):
+    CatDict,nrow=fetch_columns(curDB,header,prefetch=prefetch,verbose=verbose)
+    if (nrow < 1):
         print("# No values returned from query of {tval:s} ".format(tval="GAIA_DR2"))
-        for val in header:
-            CatDict[val]=np.array([])
-    else:
-        cat_data.columns=header
-        for val in header:
-            CatDict[val]=np.array(cat_data[val])
     curDB.close()
 
     if (verbose>0):
@@ -4,8 +4,18 @@
 # $LastCha
 """
 A set of queries to obtain inputs for the COADD pipeline.
+
+Functions that accept an ImgDict also accept an image_table.ImageTable, and the dictionaries
+of records they return are then also ImageTables.
 """
 
+import contextlib
+
+from mepipelineappintg.tile_geom import get_tile_geom
+from mepipelineappintg.stage_scheduler import run_stages
+from mepipelineappintg.db_query import bind, query_cursor
+from mepipelineappintg.image_table import empty_like
+
 ######################################################################################
 def query_coadd_geometry(TileDict, CoaddTile, dbh, dbSchema, verbose=0):
     """ Query code to obtain COADD tile geometry
@@ -21,6 +31,17 @@ def query_coadd_geometry(TileDict, CoaddTile, dbh, dbSchema, verbose=0):
             TileDict:  Updated version of input TileDict
     """
 
+    #
+    # Use the (cached) snapshot of COADDTILE_GEOM when possible
+    #
+    GeomCols = ['tilename', 'ra_cent', 'dec_cent', 'rac1', 'rac2', 'rac3', 'rac4',
+                'decc1', 'decc2', 'decc3', 'decc4', 'crossra0',
+                'racmin', 'racmax', 'deccmin', 'deccmax', 'pixelscale', 'naxis1', 'naxis2']
+    CacheDict = get_tile_geom(CoaddTile, f"{dbSchema}coaddtile_geom", dbh, columns=GeomCols, verbose=verbose)
+    if CoaddTile in CacheDict:
+        TileDict[CoaddTile] = CacheDict[CoaddTile]
+        return TileDict
+
     #
     # Query to obtain geometric specification of a specific COADD tile.
     #
@@ -31,9 +52,10 @@ def query_coadd_geometry(TileDict, CoaddTile, dbh, dbSchema, verbose=0):
         t.rac1 as rac1, t.rac2 as rac2, t.rac3 as rac3, t.rac4 as rac4,
         t.decc1 as decc1, t.decc2 as decc2, t.decc3 as decc3, t.decc4 as decc4,
         t.crossra0 as crossra0,
+        t.racmin as racmin, t.racmax as racmax, t.deccmin as deccmin, t.deccmax as deccmax,
         t.pixelscale as pixelscale, t.naxis1 as naxis1, t.naxis2 as naxis2
         FROM {dbSchema}coaddtile_geom t
-        WHERE t.tilename = '{CoaddTile}'
+        WHERE t.tilename = {bind(dbh, 'tilename')}
         """
 
     if verbose > 0:
@@ -46,8 +68,7 @@ def query_coadd_geometry(TileDict, CoaddTile, dbh, dbSchema, verbose=0):
         if verbose > 1:
             print(query)
 
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -112,12 +133,12 @@ def query_coadd_img_by_edges(ImgDict, CoaddTile, ProcTag, BandList, ArchiveSite,
         i.rac1 as rac1, i.rac2 as rac2, i.rac3 as rac3, i.rac4 as rac4,
         i.decc1 as decc1, i.decc2 as decc2, i.decc3 as decc3, i.decc4 as decc4
         FROM {dbSchema:s}image i, {dbSchema:s}file_archive_info fai, {dbSchema:s}proctag t, {dbSchema:s}coaddtile_geom ct
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=i.pfw_attempt_id
         and i.filetype='red_immask'
         and i.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
-        and ct.tilename = '{CoaddTile:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
+        and ct.tilename = {bind(dbh, 'tilename')}
         and ((ct.crossra0='N'
         AND ((i.racmin between ct.racmin and ct.racmax)OR(i.racmax between ct.racmin and ct.racmax))
         AND ((i.deccmin between ct.deccmin and ct.deccmax)OR(i.deccmax between ct.deccmin and ct.deccmax))
@@ -133,8 +154,7 @@ def query_coadd_img_by_edges(ImgDict, CoaddTile, ProcTag, BandList, ArchiveSite,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'archive_name': ArchiveSite, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -206,13 +226,13 @@ def query_coadd_img_by_fiat(ImgDict, CoaddTile, ProcTag, BandList, ArchiveSite,
         i.rac1 as rac1, i.rac2 as rac2, i.rac3 as rac3, i.rac4 as rac4,
         i.decc1 as decc1, i.decc2 as decc2, i.decc3 as decc3, i.decc4 as decc4
         FROM {dbSchema:s}image i, {dbSchema:s}file_archive_info fai, {dbSchema:s}proctag t, {FiatTable:s} y
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=i.pfw_attempt_id
         and i.filetype='red_immask'
         and i.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         and i.filename=y.filename
-        and y.tilename='{CoaddTile:s}'
+        and y.tilename={bind(dbh, 'tilename')}
         """
 
     if verbose > 0:
@@ -221,8 +241,7 @@ def query_coadd_img_by_fiat(ImgDict, CoaddTile, ProcTag, BandList, ArchiveSite,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'archive_name': ArchiveSite, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -291,14 +310,14 @@ def query_coadd_img_from_attempt(ImgDict, attemptID, BandList, ArchiveSite, dbh,
         i.rac1 as rac1, i.rac2 as rac2, i.rac3 as rac3, i.rac4 as rac4,
         i.decc1 as decc1, i.decc2 as decc2, i.decc3 as decc3, i.decc4 as decc4
         FROM {dbSchema:s}image i, {dbSchema:s}desfile d, {dbSchema:s}desfile d2, {dbSchema:s}opm_was_derived_from wdf, {dbSchema:s}file_archive_info fai
-        WHERE d.pfw_attempt_id={attemptID:d}
+        WHERE d.pfw_attempt_id={bind(dbh, 'attempt_id')}
         and d.filetype='coadd_nwgint'
         and d.id=wdf.child_desfile_id
         and wdf.parent_desfile_id=d2.id
         and d2.filetype='red_immask'
         and d2.filename=i.filename
         and d2.id=fai.desfile_id
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -307,8 +326,7 @@ def query_coadd_img_from_attempt(ImgDict, attemptID, BandList, ArchiveSite, dbh,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'attempt_id': attemptID, 'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -327,7 +345,7 @@ def query_coadd_img_from_attempt(ImgDict, attemptID, BandList, ArchiveSite, dbh,
 
 
 ######################################################################################
-def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
+def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, SingleQuery=False, verbose=0):
     """ Query code to obtain zeropoints for a set of images in existing ImgDict.
         Use an existing DB connection to execute a query to obtain ZEROPOINTs
         for an existing set of images.  If images in the input list are not
@@ -350,11 +368,16 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
                             ZptSecondary['flag']:    Zpt flag constraint
             dbh:       Database connection to be used
             dbSchema:  Schema over which queries will occur.
+            SingleQuery: Resolve primary and secondary zeropoints with a single query
+                         (see query_zeropoint_single)
             verbose:   Integer setting level of verbosity when running.
 
         Returns:
             ImgDict:   Updated version of input ImgDict
     """
+    if SingleQuery and ZptInfo is not None:
+        return query_zeropoint_single(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=verbose)
+
     #
     #   Pre-assemble portions of query that pertain to ZEROPOINT (no constraint will output mag_zero=30 for all exposures)
     #
@@ -383,7 +406,7 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
     #   Prepare GTT_FILENAME table with list of possible inputs
     #
     ImgList = []
-    NewImgDict = {}
+    NewImgDict = empty_like(ImgDict)
     for ImgName in ImgDict:
         if 'mag_zero' not in ImgDict[ImgName]:
             ImgList.append([ImgName])
@@ -418,7 +441,7 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
             print(f"# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     #
@@ -435,6 +458,7 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
     #
     if ZptSecondary is not None:
         ZptData = 'z.mag_zero as mag_zero,'
+        ZptTable = f", {ZptSecondary['table']} z"
         ZptSrcConstraint = ''
         if 'source' in ZptSecondary:
             ZptSrcConstraint = f"and z.source='{ZptSecondary['source']}'"
@@ -484,7 +508,7 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
                 print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
             else:
                 print(f"# sql = {query:s}")
-        curDB.execute(query)
+        curDB = query_cursor(dbh, query, verbose=verbose)
         desc = [d[0].lower() for d in curDB.description]
 
         for row in curDB:
@@ -507,6 +531,123 @@ def query_zeropoint(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
     return ImgDict
 
 
+######################################################################################
+def zeropoint_constraint(Zpt, alias='z', imgcol='i.filename'):
+    """ Form the constraint (SQL) on a ZEROPOINT table given a dictionary describing it
+
+        Inputs:
+            Zpt:       Dictionary containing information about Zeropoint Constraint (see query_zeropoint)
+            alias:     Alias of the ZEROPOINT table in the query
+            imgcol:    Column that ZEROPOINT.IMAGENAME is joined against
+
+        Returns:
+            ZptConstraint: String with constraints (each begins with "and")
+    """
+    ZptConstraint = f"and {alias:s}.imagename={imgcol:s} and {alias:s}.mag_zero>-100."
+    if 'source' in Zpt:
+        ZptConstraint = f"{ZptConstraint:s} and {alias:s}.source='{Zpt['source']}'"
+    if 'version' in Zpt:
+        ZptConstraint = f"{ZptConstraint:s} and {alias:s}.version='{Zpt['version']}'"
+    if 'flag' in Zpt:
+        ZptConstraint = f"{ZptConstraint:s} and {alias:s}.flag<{Zpt['flag']:s}"
+
+    return ZptConstraint
+
+
+######################################################################################
+def query_zeropoint_single(ImgDict, ZptInfo, ZptSecondary, dbh, dbSchema, verbose=0):
+    """ Query code to obtain zeropoints for a set of images in existing ImgDict.
+        Same result as query_zeropoint but GTT_FILENAME is loaded once and the primary
+        and secondary zeropoints are resolved by a single query (UNION ALL).  Precedence is
+        given to the primary table server-side (the secondary branch only returns images that
+        have no primary zeropoint).
+
+        Inputs:
+            ImgDict:    Existing ImgDict, (returned dictionary will remove records that have no zeropoint)
+            ZptInfo:    Dictionary containing information about Zeropoint Constraint (see query_zeropoint)
+            ZptSecondary: Dictionary containing information about Secondary Zeropoint Query/Constraint
+                        (NoneType yields no seconady query/constraint)
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            ImgDict:   Updated version of input ImgDict
+    """
+    #
+    #   Prepare GTT_FILENAME table with list of possible inputs
+    #
+    ImgList = []
+    NewImgDict = empty_like(ImgDict)
+    for ImgName in ImgDict:
+        if ImgDict[ImgName].get('mag_zero') is None:
+            ImgList.append([ImgName])
+        else:
+            NewImgDict[ImgName] = ImgDict[ImgName]
+
+    curDB = dbh.cursor()
+    curDB.execute('delete from GTT_FILENAME')
+    print(f"# Loading GTT_FILENAME table for zeropoint queries with entries for {len(ImgList):d} images")
+    dbh.insert_many('GTT_FILENAME', ['FILENAME'], ImgList)
+
+    #
+    #   Query to obtain zeropoints (the rank column identifies the primary (1) and secondary (2) sources)
+    #
+    query = f"""SELECT
+        gtt.filename as filename,
+        z.mag_zero as mag_zero,
+        1 as zpt_rank,
+        i.expnum as expnum,
+        i.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, gtt_filename gtt, {ZptInfo['table']} z
+        WHERE i.filename=gtt.filename
+        {zeropoint_constraint(ZptInfo):s}"""
+    if ZptSecondary is not None:
+        query = f"""{query:s}
+        UNION ALL
+        SELECT
+        gtt.filename as filename,
+        z2.mag_zero as mag_zero,
+        2 as zpt_rank,
+        i.expnum as expnum,
+        i.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, gtt_filename gtt, {ZptSecondary['table']} z2
+        WHERE i.filename=gtt.filename
+        {zeropoint_constraint(ZptSecondary, alias='z2'):s}
+        and not exists (SELECT 1 FROM {ZptInfo['table']} z
+            WHERE 1=1 {zeropoint_constraint(ZptInfo):s})"""
+
+    if verbose > 0:
+        print("# Executing query to obtain (primary and secondary) ZEROPOINTs corresponding to the red_immasked images")
+        if verbose == 1:
+            print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
+        else:
+            print(f"# sql = {query:s}")
+    curDB = query_cursor(dbh, query, verbose=verbose)
+    desc = [d[0].lower() for d in curDB.description]
+
+    #
+    #   Apply precedence as the separate queries did: for the primary the last value returned is kept,
+    #   for the secondary the first.
+    #
+    SecondaryRows = []
+    for row in curDB:
+        rowd = dict(zip(desc, row))
+        ImgName = rowd['filename']
+        if rowd['zpt_rank'] == 1:
+            NewImgDict[ImgName] = ImgDict[ImgName]
+            NewImgDict[ImgName]['mag_zero'] = rowd['mag_zero']
+        else:
+            SecondaryRows.append(rowd)
+    for rowd in SecondaryRows:
+        ImgName = rowd['filename']
+        if ImgName not in NewImgDict:
+            NewImgDict[ImgName] = ImgDict[ImgName]
+            NewImgDict[ImgName]['mag_zero'] = rowd['mag_zero']
+
+    return NewImgDict
+
+
 ######################################################################################
 def query_blacklist(ImgDict, BlacklistInfo, dbh, dbSchema, verbose=0):
     """ Query code to obtain zeropoints (and to remove blacklisted images) from an existing ImgDict
@@ -565,13 +706,13 @@ def query_blacklist(ImgDict, BlacklistInfo, dbh, dbSchema, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     #
     #   New image dictionary is formed so that images that do not return in this query are not returned
     #
-    NewImgDict = {}
+    NewImgDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['filename']
@@ -635,7 +776,7 @@ def query_bkg_img(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
         and k.filetype='red_bkg'
         and i.ccdnum=k.ccdnum
         and k.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -644,10 +785,10 @@ def query_bkg_img(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    BkgDict = {}
+    BkgDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -715,7 +856,7 @@ def query_segmap(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
         and m.filetype='red_segmap'
         and i.ccdnum=m.ccdnum
         and m.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -724,10 +865,10 @@ def query_segmap(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    SegDict = {}
+    SegDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -786,7 +927,7 @@ def query_psfmodel(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
         and m.filetype='psfex_model'
         and i.ccdnum=m.ccdnum
         and m.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -795,10 +936,10 @@ def query_psfmodel(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    PsfDict = {}
+    PsfDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -855,10 +996,10 @@ def query_PIFFmodel(ImgDict, ArchiveSite, dbh, dbSchema, PIFFtag, verbose=0):
         and wdf.child_desfile_id=d1.id
         and d1.filetype='piff_model'
         and d1.pfw_attempt_id=t.pfw_attempt_id
-        and t.tag='{PIFFtag:s}'
+        and t.tag={bind(dbh, 'proctag')}
         and d1.filename=m.filename
         and d1.id=fai.desfile_id
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -867,10 +1008,10 @@ def query_PIFFmodel(ImgDict, ArchiveSite, dbh, dbSchema, PIFFtag, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': PIFFtag, 'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    PsfDict = {}
+    PsfDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -924,12 +1065,12 @@ def query_headfile_from_attempt(ImgDict, attemptID, ArchiveSite, dbh, dbSchema,
         m.ccdnum as ccdnum
         FROM {dbSchema:s}image i, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
         WHERE i.filename=gtt.filename
-        and m.pfw_attempt_id={attemptID:d}
+        and m.pfw_attempt_id={bind(dbh, 'attempt_id')}
         and m.filetype='coadd_head_scamp'
         and i.ccdnum=m.ccdnum
         and i.expnum=m.expnum
         and m.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -938,10 +1079,10 @@ def query_headfile_from_attempt(ImgDict, attemptID, ArchiveSite, dbh, dbSchema,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'attempt_id': attemptID, 'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    HeadDict = {}
+    HeadDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -997,7 +1138,7 @@ def query_catfinalcut(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
         and c.filetype='cat_finalcut'
         and i.ccdnum=c.ccdnum
         and c.filename=fai.filename
-        and fai.archive_name='{ArchiveSite:s}'
+        and fai.archive_name={bind(dbh, 'archive_name')}
         """
 
     if verbose > 0:
@@ -1006,10 +1147,10 @@ def query_catfinalcut(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
-    CatDict = {}
+    CatDict = empty_like(ImgDict)
     for row in curDB:
         rowd = dict(zip(desc, row))
         ImgName = rowd['redfile']
@@ -1020,6 +1161,226 @@ def query_catfinalcut(ImgDict, ArchiveSite, dbh, dbSchema, verbose=0):
     return CatDict
 
 
+######################################################################################
+def query_ancillary(ImgDict, FileTypes, ArchiveSite, dbh, dbSchema, attemptID=None, PIFFtag=None, verbose=0):
+    """ Query code to obtain several types of ancillary products associated with a set of
+        red_immask images using a single load of GTT_FILENAME and a single query (a UNION ALL
+        with one branch per filetype).  Results are the same as from the individual queries
+        (query_bkg_img, query_segmap, query_psfmodel, query_PIFFmodel, query_headfile_from_attempt,
+        query_catfinalcut).
+
+        Inputs:
+            ImgDict:    Existing ImgDict
+            FileTypes:  List of ancillary filetypes to obtain.  Supported values are:
+                            red_bkg, red_segmap, psfex_model, piff_model (requires PIFFtag),
+                            coadd_head_scamp (requires attemptID), cat_finalcut
+            ArchiveSite: Archive_name
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            attemptID: Attempt ID from previous run that gives a specific set of head files
+            PIFFtag:   Proctag that defines a specific afterburner PIFF run.
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            AncDict:   Dictionary (keyed by filetype) of output dictionaries (keyed by red_immask filename)
+    """
+    #
+    #   Form the query branch associated with each filetype
+    #
+    AncColumns = "fai.filename as filename, fai.path as path, fai.compression as compression"
+    QueryBranch = {}
+    QueryParams = {'archive_name': ArchiveSite}
+    for ftype in FileTypes:
+        if ftype == 'red_bkg':
+            QueryBranch[ftype] = f"""SELECT
+        '{ftype:s}' as anctype, i.filename as redfile, {AncColumns:s},
+        k.band as band, k.expnum as expnum, k.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, {dbSchema:s}image k, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
+        WHERE i.filename=gtt.filename
+        and i.pfw_attempt_id=k.pfw_attempt_id
+        and k.filetype='red_bkg'
+        and i.ccdnum=k.ccdnum
+        and k.filename=fai.filename
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+        elif ftype in ['red_segmap', 'psfex_model']:
+            QueryBranch[ftype] = f"""SELECT
+        '{ftype:s}' as anctype, i.filename as redfile, {AncColumns:s},
+        m.band as band, m.expnum as expnum, m.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
+        WHERE i.filename=gtt.filename
+        and i.pfw_attempt_id=m.pfw_attempt_id
+        and m.filetype='{ftype:s}'
+        and i.ccdnum=m.ccdnum
+        and m.filename=fai.filename
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+        elif ftype == 'piff_model':
+            if PIFFtag is None:
+                raise ValueError("query_ancillary: filetype piff_model requires PIFFtag")
+            QueryParams['proctag'] = PIFFtag
+            QueryBranch[ftype] = f"""SELECT
+        '{ftype:s}' as anctype, d2.filename as redfile, {AncColumns:s},
+        m.band as band, m.expnum as expnum, m.ccdnum as ccdnum
+        FROM {dbSchema:s}desfile d1, {dbSchema:s}desfile d2, {dbSchema:s}proctag t, {dbSchema:s}opm_was_derived_from wdf, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
+        WHERE d2.filename=gtt.filename
+        and d2.id=wdf.parent_desfile_id
+        and wdf.child_desfile_id=d1.id
+        and d1.filetype='piff_model'
+        and d1.pfw_attempt_id=t.pfw_attempt_id
+        and t.tag={bind(dbh, 'proctag')}
+        and d1.filename=m.filename
+        and d1.id=fai.desfile_id
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+        elif ftype == 'coadd_head_scamp':
+            if attemptID is None:
+                raise ValueError("query_ancillary: filetype coadd_head_scamp requires attemptID")
+            QueryParams['attempt_id'] = attemptID
+            QueryBranch[ftype] = f"""SELECT
+        '{ftype:s}' as anctype, i.filename as redfile, {AncColumns:s},
+        m.band as band, m.expnum as expnum, m.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
+        WHERE i.filename=gtt.filename
+        and m.pfw_attempt_id={bind(dbh, 'attempt_id')}
+        and m.filetype='coadd_head_scamp'
+        and i.ccdnum=m.ccdnum
+        and i.expnum=m.expnum
+        and m.filename=fai.filename
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+        elif ftype == 'cat_finalcut':
+            QueryBranch[ftype] = f"""SELECT
+        '{ftype:s}' as anctype, i.filename as redfile, {AncColumns:s},
+        c.band as band, c.expnum as expnum, c.ccdnum as ccdnum
+        FROM {dbSchema:s}image i, {dbSchema:s}catalog c, {dbSchema:s}file_archive_info fai, GTT_FILENAME gtt
+        WHERE i.filename=gtt.filename
+        and i.pfw_attempt_id=c.pfw_attempt_id
+        and c.filetype='cat_finalcut'
+        and i.ccdnum=c.ccdnum
+        and c.filename=fai.filename
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+        else:
+            raise ValueError(f"query_ancillary: unsupported filetype {ftype}")
+
+    AncDict = {}
+    for ftype in QueryBranch:
+        AncDict[ftype] = empty_like(ImgDict)
+    if not QueryBranch:
+        return AncDict
+
+    #
+    #   Prepare GTT_FILENAME table with list of possible inputs
+    #
+    ImgList = []
+    for ImgName in ImgDict:
+        ImgList.append([ImgName])
+
+    #   Setup DB cursor
+    curDB = dbh.cursor()
+    #   Make sure the GTT_FILENAME table is empty
+    curDB.execute('delete from GTT_FILENAME')
+    #   Load img ids into opm_filename_gtt table
+    print(f"# Loading GTT_FILENAME table for ancillary queries with entries for {len(ImgList):d} images")
+    dbh.insert_many('GTT_FILENAME', ['FILENAME'], ImgList)
+
+    query = "\n        UNION ALL\n        ".join([QueryBranch[ftype] for ftype in QueryBranch])
+
+    if verbose > 0:
+        print(f"# Executing query to obtain {','.join(QueryBranch):s} corresponding to the red_immasked images")
+        if verbose == 1:
+            print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
+        else:
+            print(f"# sql = {query:s}")
+    curDB = query_cursor(dbh, query, QueryParams, verbose=verbose)
+    desc = [d[0].lower() for d in curDB.description]
+
+    for row in curDB:
+        rowd = dict(zip(desc, row))
+        # (literals of differing length may be returned blank padded)
+        ftype = rowd.pop('anctype').strip()
+        ImgName = rowd['redfile']
+        AncDict[ftype][ImgName] = rowd
+        if ftype == 'cat_finalcut' and 'mag_zero' in ImgDict[ImgName]:
+            AncDict[ftype][ImgName]['mag_zero'] = ImgDict[ImgName]['mag_zero']
+
+    if verbose > 0:
+        for ftype in AncDict:
+            print(f"#   Found {len(AncDict[ftype]):d} {ftype:s} entries")
+
+    return AncDict
+
+
+######################################################################################
+def query_image_inputs_staged(ImgDict, ZptInfo, ZptSecondary, BlacklistInfo, AncTypes, ArchiveSite, dbh, dbSchema,
+                              MagBase=30.0, SingleQuery=False, attemptID=None, PIFFtag=None,
+                              nconn=1, connect=None, verbose=0):
+    """ Obtain zeropoints, remove blacklisted images and obtain the ancillary products for a set
+        of images, run as a set of stages:  zeropoint and blacklist are independent (each loads its
+        own GTT_FILENAME, on its own DB connection when nconn > 1) and the ancillary stage (a single
+        query_ancillary, i.e. one GTT load and one UNION ALL query) depends on both.  Images are kept
+        when they have a zeropoint and are not blacklisted, and their zeropoint (mag_zero, MagBase when
+        absent) is converted into a fluxscale before the ancillary query.
+
+        Inputs:
+            ImgDict:    Existing ImgDict
+            ZptInfo:    Zeropoint constraint (see query_zeropoint), None skips the zeropoint stage
+            ZptSecondary: Secondary zeropoint constraint (see query_zeropoint)
+            BlacklistInfo: Blacklist constraint (see query_blacklist), None skips the blacklist stage
+            AncTypes:   List of ancillary filetypes to obtain (see query_ancillary)
+            ArchiveSite: Archive_name
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            MagBase:   Fiducial magnitude (zeropoint) used to form fluxscale
+            SingleQuery: Resolve primary and secondary zeropoints with a single query
+            attemptID: Attempt ID from previous run that gives a specific set of head files
+            PIFFtag:   Proctag that defines a specific afterburner PIFF run.
+            nconn:     Maximum number of concurrent stages (DB connections)
+            connect:   Callable returning a new database connection
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            ImgDict:   Updated version of input ImgDict (with mag_zero and fluxscale)
+            AncDict:   Dictionary (keyed by filetype) of output dictionaries (keyed by red_immask filename)
+    """
+
+    def zeropoint(conn, Results):
+        return query_zeropoint(ImgDict, ZptInfo, ZptSecondary, conn, dbSchema, SingleQuery=SingleQuery, verbose=verbose)
+
+    def blacklist(conn, Results):
+        return set(query_blacklist(ImgDict, BlacklistInfo, conn, dbSchema, verbose))
+
+    def ancillary(conn, Results):
+        ZptImgDict = Results.get('zeropoint', ImgDict)
+        NewImgDict = empty_like(ImgDict)
+        for Img in ZptImgDict:
+            if 'blacklist' not in Results or Img in Results['blacklist']:
+                NewImgDict[Img] = ZptImgDict[Img]
+        if verbose > 0:
+            print(f"# Kept {len(NewImgDict):d} of {len(ImgDict):d} images (zeropoint/blacklist)")
+        #
+        #   Convert zeropoint (mag_zero) into a fluxscale.
+        #
+        for Img in NewImgDict:
+            if 'mag_zero' in NewImgDict[Img]:
+                NewImgDict[Img]['fluxscale'] = 10. ** (0.4 * (MagBase - NewImgDict[Img]['mag_zero']))
+            else:
+                NewImgDict[Img]['mag_zero'] = MagBase
+                NewImgDict[Img]['fluxscale'] = 1.0
+        if hasattr(NewImgDict, 'compact'):
+            # store the (now complete) numeric columns compactly
+            NewImgDict.compact()
+        AncDict = query_ancillary(NewImgDict, AncTypes, ArchiveSite, conn, dbSchema, attemptID=attemptID,
+                                  PIFFtag=PIFFtag, verbose=verbose)
+        return NewImgDict, AncDict
+
+    Stages = {}
+    if ZptInfo is not None:
+        Stages['zeropoint'] = {'func': zeropoint, 'deps': []}
+    if BlacklistInfo is not None:
+        Stages['blacklist'] = {'func': blacklist, 'deps': []}
+    Stages['ancillary'] = {'func': ancillary, 'deps': list(Stages)}
+    Results, Timing = run_stages(Stages, dbh, connect=connect, nconn=nconn, verbose=verbose)
+
+    return Results['ancillary']
+
+
 ######################################################################################
 def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandList, verbose=0):
     """ Query code to obtain image inputs for COADD (based on centers and extents of Tile/Imgs).
@@ -1053,7 +1414,7 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
     #   Prepare queries used to find images that correspond to a tile (based on their extents)
     #
 
-    query1 = f"""select crossra0 from {dbSchema:s}coaddtile_geom where tilename='{CoaddTile:s}'"""
+    query1 = f"""select crossra0 from {dbSchema:s}coaddtile_geom where tilename={bind(dbh, 'tilename')}"""
 
     query2a = f"""with ima as
         (SELECT /*+ materialize */
@@ -1073,8 +1434,8 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
         ima, {dbSchema:s}proctag, {dbSchema:s}coaddtile_geom tile
         WHERE
         ima.PFW_ATTEMPT_ID = proctag.PFW_ATTEMPT_ID AND
-        proctag.TAG = '{ProcTag:s}' AND
-        tile.tilename = '{CoaddTile:s}' AND
+        proctag.TAG = {bind(dbh, 'proctag')} AND
+        tile.tilename = {bind(dbh, 'tilename')} AND
         (ABS(ima.RA_CENT  -  tile.RA_CENT)  < (0.5*tile.RA_SIZE  + 0.5*ima.RA_SIZE_CCD)) AND
         (ABS(ima.DEC_CENT -  tile.DEC_CENT) < (0.5*tile.DEC_SIZE + 0.5*ima.DEC_SIZE_CCD))
         order by ima.RA_CENT
@@ -1103,8 +1464,8 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
         ima, {dbSchema:s}proctag t, tile
         WHERE
         ima.PFW_ATTEMPT_ID = t.PFW_ATTEMPT_ID AND
-        t.TAG = '{ProcTag:s}' AND
-        tile.tilename = '{CoaddTile:s}' AND
+        t.TAG = {bind(dbh, 'proctag')} AND
+        tile.tilename = {bind(dbh, 'tilename')} AND
         (ABS(ima.RA_CENT  -  tile.RA_CENT)  < (0.5*tile.RA_SIZE  + 0.5*ima.RA_SIZE_CCD)) AND
         (ABS(ima.DEC_CENT -  tile.DEC_CENT) < (0.5*tile.DEC_SIZE + 0.5*ima.DEC_SIZE_CCD))
         order by ima.BAND
@@ -1120,8 +1481,7 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
             print("# sql = " + " ".join([d.strip() for d in query1.split('\n')]))
         else:
             print(f"# sql = {query1:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query1)
+    curDB = query_cursor(dbh, query1, {'tilename': CoaddTile}, verbose=verbose)
     for row in curDB:
         crossravalue = row[0]
 
@@ -1132,7 +1492,7 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
                 print("# sql = " + " ".join([d.strip() for d in query2b.split('\n')]))
             else:
                 print(f"# sql = {query2b:s}")
-        curDB.execute(query2b)
+        curDB = query_cursor(dbh, query2b, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
     else:
         print("# Executing query (condition CROSSRA0=N) to obtain red_immask images (based on their extents)")
         if verbose > 0:
@@ -1140,7 +1500,7 @@ def query_coadd_img_by_extent(ImgDict, CoaddTile, ProcTag, dbh, dbSchema, BandLi
                 print("# sql = " + " ".join([d.strip() for d in query2a.split('\n')]))
             else:
                 print(f"# sql = {query2a:s}")
-        curDB.execute(query2a)
+        curDB = query_cursor(dbh, query2a, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
 
     desc = [d[0].lower() for d in curDB.description]
 
@@ -1205,7 +1565,7 @@ def query_astref_scampcat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandList,
         listagg(d.ccdnum,',') within group (order by d.ccdnum) as ccdnum
         FROM
         {dbSchema:s}miscfile m, {dbSchema:s}catalog c, {dbSchema:s}catalog d, {dbSchema:s}proctag t
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=c.pfw_attempt_id
         and c.filetype='cat_scamp_full'
         {BandConstraint:s}
@@ -1224,7 +1584,7 @@ def query_astref_scampcat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandList,
         AND t.PFW_ATTEMPT_ID=i.PFW_ATTEMPT_ID
         AND i.FILETYPE='red_immask'
         AND i.FILENAME=fai.FILENAME
-        AND ct.tilename = '{CoaddTile:s}'
+        AND ct.tilename = {bind(dbh, 'tilename')}
         and ((
         ct.crossra0='N'
         and ((i.RACMIN between ct.racmin and ct.racmax)or(i.racmax between ct.racmin and ct.racmax))
@@ -1244,8 +1604,7 @@ def query_astref_scampcat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandList,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -1305,7 +1664,7 @@ def query_astref_scampcat_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, Ba
         listagg(d.ccdnum,',') within group (order by d.ccdnum) as ccdnum
         FROM
         {dbSchema:s}miscfile m, {dbSchema:s}catalog c, {dbSchema:s}catalog d, {dbSchema:s}proctag t
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=c.pfw_attempt_id
         and c.filetype='cat_scamp_full'
         {BandConstraint:s}
@@ -1324,7 +1683,7 @@ def query_astref_scampcat_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, Ba
         and t.pfw_attempt_id=i.pfw_attempt_id
         and i.filetype='red_immask'
         and i.filename=y.filename
-        and y.tilename='{CoaddTile:s}'
+        and y.tilename={bind(dbh, 'tilename')}
         )
         group by c.filename,m.filename,m.expnum,m.band """
 
@@ -1334,8 +1693,7 @@ def query_astref_scampcat_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema, Ba
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -1388,7 +1746,7 @@ def query_astref_catfinalcut(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandLis
         c.band as band
         FROM
         {dbSchema:s}catalog c, {dbSchema:s}proctag t
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=c.pfw_attempt_id
         and c.filetype='cat_finalcut'
         {BandConstraint:s}
@@ -1400,7 +1758,7 @@ def query_astref_catfinalcut(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandLis
         WHERE i.expnum=c.expnum
         AND t.PFW_ATTEMPT_ID=i.PFW_ATTEMPT_ID
         AND i.FILETYPE='red_immask'
-        AND ct.tilename = '{CoaddTile:s}'
+        AND ct.tilename = {bind(dbh, 'tilename')}
         and ((
         ct.crossra0='N'
         and ((i.RACMIN between ct.racmin and ct.racmax)or(i.racmax between ct.racmin and ct.racmax))
@@ -1420,8 +1778,7 @@ def query_astref_catfinalcut(CatDict, CoaddTile, ProcTag, dbh, dbSchema, BandLis
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -1480,7 +1837,7 @@ def query_astref_catfinalcut_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema,
         c.band as band
         FROM
         {dbSchema:s}catalog c, {dbSchema:s}proctag t
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=c.pfw_attempt_id
         and c.filetype='cat_finalcut'
         {BandConstraint:s}
@@ -1493,7 +1850,7 @@ def query_astref_catfinalcut_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema,
         and t.pfw_attempt_id=i.pfw_attempt_id
         and i.filetype='red_immask'
         and i.filename=y.filename
-        and y.tilename='{CoaddTile:s}'
+        and y.tilename={bind(dbh, 'tilename')}
         )
         order by c.expnum,c.ccdnum """
 
@@ -1503,8 +1860,7 @@ def query_astref_catfinalcut_by_fiat(CatDict, CoaddTile, ProcTag, dbh, dbSchema,
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': CoaddTile}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     for row in curDB:
@@ -1557,12 +1913,12 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
         m.band as band,
         m.pfw_attempt_id as pfw_attempt_id
         FROM {dbSchema:s}proctag t, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai
-        WHERE t.tag='{CoaddProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=m.pfw_attempt_id
-        and m.tilename='{CoaddTile:s}'
+        and m.tilename={bind(dbh, 'tilename')}
         and m.filetype='coadd_meds'
         and fai.filename=m.filename
-        and fai.archive_name='{ArchiveSite:s}'"""
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
 
     if verbose > 0:
         print("# Executing query to obtain red_immask images (based on their edges/boundaries)")
@@ -1570,8 +1926,7 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
             print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
         else:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': CoaddProcTag, 'tilename': CoaddTile, 'archive_name': ArchiveSite}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     MedDict = {}
@@ -1603,6 +1958,7 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
         #
         #       Query for the PSF Model Files from the Single-Epoch runs.
         #
+        QueryParams = {'attempt_id': uAttID[0], 'archive_name': ArchiveSite}
         if COADD_ONLY:
             query = f"""SELECT fai.filename as filename,
                 fai.path as path,
@@ -1611,10 +1967,10 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
                 -9999 as ccdnum,
                 m.band as band
                 FROM {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai
-                WHERE m.pfw_attempt_id={uAttID[0]:d}
+                WHERE m.pfw_attempt_id={bind(dbh, 'attempt_id')}
                 and m.filetype='coadd_psfex_model'
                 and m.filename=fai.filename
-                and fai.archive_name='{ArchiveSite:s}'"""
+                and fai.archive_name={bind(dbh, 'archive_name')}"""
         else:
             query = f"""SELECT fai.filename as filename,
                 fai.path as path,
@@ -1623,15 +1979,16 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
                 m.ccdnum as ccdnum,
                 m.band as band
                 FROM {dbSchema:s}proctag ts, {dbSchema:s}image i, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai
-                WHERE i.pfw_attempt_id={uAttID[0]:d}
+                WHERE i.pfw_attempt_id={bind(dbh, 'attempt_id')}
                 and i.filetype='coadd_nwgint'
                 and i.ccdnum=m.ccdnum
                 and i.expnum=m.expnum
                 and m.filetype='psfex_model'
                 and m.pfw_attempt_id=ts.pfw_attempt_id
-                and ts.tag='{SE_ProcTag}'
+                and ts.tag={bind(dbh, 'proctag')}
                 and m.filename=fai.filename
-                and fai.archive_name='{ArchiveSite:s}'"""
+                and fai.archive_name={bind(dbh, 'archive_name')}"""
+            QueryParams['proctag'] = SE_ProcTag
 
         if verbose > 0:
             print("# Executing query to obtain PSF models")
@@ -1639,8 +1996,7 @@ def query_meds_psfmodels(QueryType, CoaddTile, CoaddProcTag, SE_ProcTag, COADD_O
                 print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
             else:
                 print(f"# sql = {query:s}")
-        curDB = dbh.cursor()
-        curDB.execute(query)
+        curDB = query_cursor(dbh, query, QueryParams, verbose=verbose)
         desc = [d[0].lower() for d in curDB.description]
 
         PSFDict = {}
@@ -1716,3 +2072,81 @@ def CatDict_to_LLD(CatDict, filetypes, mdatatypes, verbose=0):
         OutLLD.append(tmplist)
 
     return OutLLD
+
+
+######################################################################################
+def write_image_lists(ImgDict, AncDicts, filetypes, mdatatypes, outfile, imglist=None, imglist_types=None,
+                      typelists=None, bufsize=1048576, verbose=0):
+    """ Write the list (WCL) of inputs, and optionally an image list and per-filetype lists,
+        in a single pass over ImgDict.  Records for each filetype are joined (by red image
+        filename) as each line is formed, giving the same LLD as ImgDict_to_LLD without the
+        intermediate per-image dict of filetypes.  The LLD is then written (WCL) with
+        queryutils.convert_multiple_files_to_lines and queryutils.output_lines.
+
+        Inputs:
+            ImgDict:    ImgDict (or ImageTable) of records for the first filetype (e.g. red images)
+            AncDicts:   Dict (keyed by the other filetypes) of dicts of records keyed as ImgDict
+            filetypes:  List of filetypes forming each line (first is the red image)
+            mdatatypes: Dict (keyed by filetype) of the metadata to write for each file
+            outfile:    Output list (WCL) file
+            imglist:    Optional image list file (expnum, ccdnum, band, mag_zero)
+            imglist_types: Filetypes that must be present for an image to appear in imglist
+                           (default: all of them, i.e. the same images as the output list)
+            typelists:  Optional dict (filetype --> file) of lists with one file (fullname, or
+                        filename+compression) per line for the images in the output list
+            bufsize:    Size of the output buffers for imglist and typelists (bytes)
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            BandCnt:    Dict of the number of images (lines) written for each band
+    """
+    import intgutils.queryutils as queryutils
+
+    AncTypes = filetypes[1:]
+    if imglist_types is None:
+        imglist_types = AncTypes
+    if typelists is None:
+        typelists = {}
+
+    BandCnt = {}
+    OutLLD = []
+    with contextlib.ExitStack() as stack:
+        fimg = None
+        if imglist is not None:
+            fimg = stack.enter_context(open(imglist, 'w', buffering=bufsize))
+        ftypes = {ftype: stack.enter_context(open(fname, 'w', buffering=bufsize)) for ftype, fname in typelists.items()}
+
+        for Img in ImgDict:
+            Red = ImgDict[Img]
+            if fimg is not None and all([Img in AncDicts[ftype] for ftype in imglist_types]):
+                fimg.write(f" {Red['expnum']:8d} {Red['ccdnum']:2d} {Red['band']:5s} {Red['mag_zero']:8.5f}\n")
+            if not all([Img in AncDicts[ftype] for ftype in AncTypes]):
+                continue
+
+            BandCnt[Red['band']] = BandCnt.get(Red['band'], 0) + 1
+            Line = []
+            for ifile, ftype in enumerate(filetypes):
+                Rec = Red if ifile == 0 else AncDicts[ftype][Img]
+                Meta = {}
+                for mdata in mdatatypes[ftype]:
+                    if mdata in Rec:
+                        Meta[mdata] = Rec[mdata]
+                    elif verbose > 0:
+                        print(f"Warning: missing metadata {mdata:s} for image {Rec['filename']:s}")
+                Line.append(Meta)
+                if ftype in ftypes:
+                    if 'fullname' in Rec:
+                        ftypes[ftype].write(f"{Rec['fullname']:s}\n")
+                    else:
+                        ftypes[ftype].write(f"{Rec['filename']:s}{Rec.get('compression') or '':s}\n")
+                if verbose > 3:
+                    print(Meta)
+            OutLLD.append(Line)
+    OutLines = queryutils.convert_multiple_files_to_lines(OutLLD, filetypes)
+    queryutils.output_lines(outfile, OutLines)
+
+    if verbose > 0:
+        print(f"# Wrote {len(OutLLD):d} lines to {outfile:s}")
+
+    return BandCnt
+
@@ -0,0 +1,309 @@
+"""
+Shared helper for executing queries with bind variables.  Using bind variables means a
+statement executed repeatedly with new values has the same SQL text, so the server sees a
+single statement (rather than a new one per tile/tag/attempt) and the driver's own statement
+cache (cx_Oracle stmtcachesize) re-uses the prepared statement.  Each call uses a fresh cursor.
+Time spent preparing (client side) and executing each statement is accumulated so that it
+can be reported.
+
+A connection can also be wrapped (trace_connection) so that every statement executed
+through it (by query_cursor or directly on its cursors) and every insert_many (e.g. loads
+of the GTT tables) is recorded: the calling function, parse/execute/fetch durations, rows
+and (approximate) bytes fetched.  The trace is written as JSON at exit (enable_trace).
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+#
+#   Statistics (keyed by SQL text)
+#
+_QueryStats = OrderedDict()
+_StatsLock = threading.Lock()
+
+#
+#   Trace of DB calls (when enabled): statements (SQL text by id) and events (one per call)
+#
+_Trace = {'enabled': False, 'start': 0.0, 'statements': OrderedDict(), 'events': []}
+_TraceLock = threading.Lock()
+
+#
+#   Helper functions that are skipped (in favor of their caller) when labelling a traced call
+#
+TraceSkip = {'_execute_query'}
+
+
+######################################################################################
+def bind(dbh, name):
+    """ Return the string used to reference a named bind variable in a query
+        (e.g. ':name' for Oracle)
+    """
+    return dbh.get_named_bind_string(name)
+
+
+######################################################################################
+def query_cursor(dbh, query, params=None, verbose=0):
+    """ Execute a query (using bind variables) and return the cursor to fetch results.
+
+        Inputs:
+            dbh:       Database connection to be used
+            query:     SQL text (with bind variables for any values)
+            params:    Dict of values for the bind variables
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            curDB:     Cursor (after executing the query)
+    """
+    if params is None:
+        params = {}
+
+    t0 = time.time()
+    curDB = dbh.cursor()
+    if hasattr(curDB, 'prepare'):
+        curDB.prepare(query)
+    tprepare = time.time() - t0
+
+    if verbose > 1:
+        print(f"# bind values: {params}")
+    t1 = time.time()
+    curDB.execute(query, params)
+    texec = time.time() - t1
+
+    with _StatsLock:
+        Stats = _QueryStats.setdefault(query, {'nexec': 0, 'tprepare': 0.0, 'texec': 0.0})
+        Stats['nexec'] += 1
+        Stats['tprepare'] += tprepare
+        Stats['texec'] += texec
+
+    return curDB
+
+
+######################################################################################
+def get_query_stats():
+    """ Return the accumulated statistics (dict keyed by SQL text, each with the number of
+        executions and the time spent preparing (client side) and executing)
+    """
+    with _StatsLock:
+        return {query: dict(Stats) for query, Stats in _QueryStats.items()}
+
+
+######################################################################################
+def print_query_stats():
+    """ Print a summary of the (client) prepare and execute time for each statement executed """
+    Stats = get_query_stats()
+    if len(Stats) < 1:
+        return
+    print("# Query statistics (client prepare vs. execute)")
+    print(f"# {'nexec':>6s} {'tprepare':>8s} {'texec':>8s}  statement")
+    for query, qstat in Stats.items():
+        qline = ' '.join(query.split())
+        if len(qline) > 80:
+            qline = qline[:77] + '...'
+        print(f"# {qstat['nexec']:6d} {qstat['tprepare']:8.3f} {qstat['texec']:8.3f}  {qline:s}")
+    print(f"# Total: prepare(client)={sum([q['tprepare'] for q in Stats.values()]):.3f} "
+          f"execute={sum([q['texec'] for q in Stats.values()]):.3f} "
+          f"for {sum([q['nexec'] for q in Stats.values()]):d} executions of {len(Stats):d} statements")
+
+
+######################################################################################
+def enable_trace(filename=None):
+    """ Start tracing the DB calls made through connections wrapped by trace_connection.
+
+        Inputs:
+            filename:  JSON file to which the trace is written when the process exits
+                       (None: trace is only available through get_trace/write_trace)
+    """
+    with _TraceLock:
+        if not _Trace['enabled']:
+            _Trace['enabled'] = True
+            _Trace['start'] = time.time()
+    if filename is not None:
+        atexit.register(write_trace, filename)
+
+
+######################################################################################
+def trace_connection(dbh):
+    """ Wrap a DB connection so that its calls are traced (returned unchanged when tracing
+        has not been enabled, or when it is already wrapped)
+    """
+    if not _Trace['enabled'] or isinstance(dbh, TracedConnection):
+        return dbh
+    return TracedConnection(dbh)
+
+
+######################################################################################
+def _trace_label():
+    """ Name (module.function) of the function outside this module that made a DB call """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_globals.get('__name__') != __name__ and frame.f_code.co_name not in TraceSkip:
+            module = frame.f_globals.get('__name__', '').split('.')[-1]
+            return f"{module:s}.{frame.f_code.co_name:s}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+######################################################################################
+def _trace_event(kind, query=None, **kwargs):
+    """ Add an event to the trace (returns the event so that fetches can be added to it) """
+    Event = {'label': _trace_label(), 'kind': kind, 'stmt': None, 'start': time.time() - _Trace['start'],
+             'parse': 0.0, 'execute': 0.0, 'fetch': 0.0, 'rows': 0, 'bytes': 0,
+             'thread': threading.current_thread().name}
+    Event.update(kwargs)
+    with _TraceLock:
+        if query is not None:
+            Event['stmt'] = _Trace['statements'].setdefault(query, len(_Trace['statements']))
+        _Trace['events'].append(Event)
+    return Event
+
+
+######################################################################################
+def _row_bytes(row):
+    """ Approximate size (bytes) of the values in a row """
+    nbytes = 0
+    for val in row:
+        if isinstance(val, (str, bytes)):
+            nbytes += len(val)
+        elif val is not None:
+            nbytes += 8
+    return nbytes
+
+
+######################################################################################
+class TracedCursor:
+    """ Cursor wrapper that records each execute (and the fetches that follow it).
+        Attributes (other than its own, which start with '_') are read from and set on the
+        wrapped cursor (e.g. arraysize), so tracing does not change how results are fetched.
+    """
+
+    def __init__(self, cursor):
+        self._cur = cursor
+        self._event = None
+        self._tparse = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cur, name, value)
+
+    def prepare(self, query):
+        t0 = time.time()
+        if hasattr(self._cur, 'prepare'):
+            self._cur.prepare(query)
+        self._tparse += time.time() - t0
+
+    def execute(self, query, *args, **kwargs):
+        t0 = time.time()
+        result = self._cur.execute(query, *args, **kwargs)
+        self._event = _trace_event('query', query, parse=self._tparse, execute=time.time() - t0)
+        self._tparse = 0.0
+        return self if result is self._cur else result
+
+    def _fetched(self, rows, tfetch):
+        if self._event is not None:
+            self._event['fetch'] += tfetch
+            self._event['rows'] += len(rows)
+            self._event['bytes'] += sum([_row_bytes(row) for row in rows])
+
+    def fetchone(self):
+        t0 = time.time()
+        row = self._cur.fetchone()
+        self._fetched([] if row is None else [row], time.time() - t0)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        t0 = time.time()
+        rows = self._cur.fetchmany(*args, **kwargs)
+        self._fetched(rows, time.time() - t0)
+        return rows
+
+    def fetchall(self):
+        t0 = time.time()
+        rows = self._cur.fetchall()
+        self._fetched(rows, time.time() - t0)
+        return rows
+
+    def __iter__(self):
+        rows = iter(self._cur)
+        while True:
+            t0 = time.time()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self._fetched([], time.time() - t0)
+                return
+            self._fetched([row], time.time() - t0)
+            yield row
+
+
+######################################################################################
+class TracedConnection:
+    """ Connection wrapper: cursors are traced, as are insert_many calls (e.g. GTT loads) """
+
+    def __init__(self, dbh):
+        self._dbh = dbh
+
+    def __getattr__(self, name):
+        return getattr(self._dbh, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._dbh, name, value)
+
+    def cursor(self):
+        return TracedCursor(self._dbh.cursor())
+
+    def insert_many(self, table, columns, rows, *args, **kwargs):
+        rows = list(rows)
+        t0 = time.time()
+        result = self._dbh.insert_many(table, columns, rows, *args, **kwargs)
+        _trace_event('insert', table=table, execute=time.time() - t0, rows=len(rows))
+        return result
+
+
+######################################################################################
+def get_trace():
+    """ Return the trace: statements, events and a summary (per label, ordered by total time) """
+    with _TraceLock:
+        Events = [dict(Event) for Event in _Trace['events']]
+        Statements = [{'id': stmt, 'sql': ' '.join(query.split())} for query, stmt in _Trace['statements'].items()]
+
+    Summary = OrderedDict()
+    for Event in Events:
+        Sum = Summary.setdefault(Event['label'], {'label': Event['label'], 'nexec': 0, 'parse': 0.0, 'execute': 0.0,
+                                                  'fetch': 0.0, 'rows': 0, 'bytes': 0, 'ninsert': 0, 'insert_rows': 0})
+        if Event['kind'] == 'insert':
+            Sum['ninsert'] += 1
+            Sum['insert_rows'] += Event['rows']
+        else:
+            Sum['nexec'] += 1
+            Sum['rows'] += Event['rows']
+            Sum['bytes'] += Event['bytes']
+        for key in ['parse', 'execute', 'fetch']:
+            Sum[key] += Event[key]
+    Summary = sorted(Summary.values(), key=lambda Sum: Sum['parse'] + Sum['execute'] + Sum['fetch'], reverse=True)
+
+    return {'meta': {'argv': sys.argv, 'pid': os.getpid(), 'start': _Trace['start'],
+                     'wall': time.time() - _Trace['start']},
+            'statements': Statements, 'events': Events, 'summary': Summary}
+
+
+######################################################################################
+def write_trace(filename):
+    """ Write the trace (see get_trace) to a JSON file """
+    Trace = get_trace()
+    with open(filename, 'w') as fout:
+        json.dump(Trace, fout, indent=1)
+    tdb = sum([Sum['parse'] + Sum['execute'] + Sum['fetch'] for Sum in Trace['summary']])
+    print(f"# Wrote DB trace ({len(Trace['events']):d} calls, {tdb:.3f}s in the DB layer) to: {filename:s}")
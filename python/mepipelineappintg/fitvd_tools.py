@@ -1,12 +1,12 @@
 # Simple set of function to generate global,
 # chunk seeds and other utils for ngmixer
 
-import numpy
 import re
 import fitsio
 import math
 import os
 import fitvd
+from mepipelineappintg import meappintg_tools
 
 
 def get_globalseed(tilename, shift=''):
@@ -18,19 +18,15 @@ def get_globalseed(tilename, shift=''):
     return int(seed)
 
 
-def chunkseed(tilename, chunk, shift=''):
-    tile_seed = get_globalseed(tilename, shift)
-    rng = numpy.random.RandomState(tile_seed)
-    k = 1
-    while k <= chunk:
-        newseed = rng.randint(low=1, high=1000000000)
-        k = k+1
+def chunkseed(tilename, chunk, shift='', nranges=None):
+    # seeds for all chunks are drawn at once (same sequence as drawing one at a time)
+    newseed = meappintg_tools.chunkseed(tilename, chunk, shift, nranges=nranges)
     return newseed
 
 
 def find_number_fof(filename, ext='fofid'):
-    fofs = fitsio.read(filename)
-    num = numpy.unique(fofs[ext]).size
+    # only the group id column is read (counts are kept in a sidecar file)
+    num = meappintg_tools.fof_group_counts(filename, column=ext).size
     return num
 
 
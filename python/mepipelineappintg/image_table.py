@@ -0,0 +1,279 @@
+"""
+A compact (columnar) table of image records keyed by filename, for use in place of the
+dict-of-dicts ImgDict (ImgDict[filename] = {'filename': ..., 'band': ..., ...}).
+
+Values are held per column (one list, or a typed array for numeric columns after compact(),
+per column) with strings interned, so that a large set of images does not carry a dict per
+record.  An ImageTable behaves as a mapping from filename to a record (ImageRow), and each
+record behaves as a dict (reads, writes, 'key in rec', iteration over keys), so that code
+written for an ImgDict works unchanged.  Functions in coadd_query return an ImageTable
+when given one (and a dict when given a dict).
+"""
+
+import sys
+from array import array
+from collections.abc import Mapping, MutableMapping
+import numpy as np
+
+#
+#   Marker for a value that is absent from a record (as opposed to None/NULL)
+#
+_Missing = object()
+
+#
+#   Typecodes used by compact() for numeric columns (and the Python types they accept)
+#
+_ArrayTypes = {'q': (int,), 'd': (float, int)}
+
+
+######################################################################################
+def _intern(value):
+    """ Intern strings (band, path, compression... repeat many times across records) """
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+######################################################################################
+def empty_like(ImgDict):
+    """ Return a new, empty, container of the same kind as ImgDict (ImageTable or dict) """
+    if isinstance(ImgDict, ImageTable):
+        return ImageTable(key=ImgDict.key)
+    return {}
+
+
+######################################################################################
+class ImageRow(MutableMapping):
+    """ A record of an ImageTable (a view: reads and writes go to the table's columns) """
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, col):
+        column = self._table._cols.get(col)
+        if column is None:
+            raise KeyError(col)
+        value = column[self._row]
+        if value is _Missing:
+            raise KeyError(col)
+        return value
+
+    def __setitem__(self, col, value):
+        self._table._set(self._row, col, value)
+
+    def __delitem__(self, col):
+        if col not in self:
+            raise KeyError(col)
+        self._table._set(self._row, col, _Missing)
+
+    def __contains__(self, col):
+        column = self._table._cols.get(col)
+        return column is not None and column[self._row] is not _Missing
+
+    def __iter__(self):
+        for col, column in list(self._table._cols.items()):
+            if column[self._row] is not _Missing:
+                yield col
+
+    def __len__(self):
+        return sum([1 for col in self])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+######################################################################################
+class ImageTable(MutableMapping):
+    """ Columnar table of image records (keyed by filename by default).
+
+        Inputs:
+            Records:    Optional mapping (e.g. a legacy ImgDict) or ImageTable to load
+            key:        Name of the key column (default='filename')
+    """
+
+    def __init__(self, Records=None, key='filename'):
+        self.key = key
+        self._index = {}
+        self._keys = []
+        self._cols = {}
+        if Records is not None:
+            self.update(Records)
+
+    #
+    #   Storage
+    #
+    def _column(self, col):
+        column = self._cols.get(col)
+        if column is None:
+            column = [_Missing] * len(self._keys)
+            self._cols[sys.intern(col)] = column
+        return column
+
+    def _set(self, row, col, value):
+        column = self._column(col)
+        if isinstance(column, array):
+            if type(value) in _ArrayTypes[column.typecode]:
+                column[row] = value
+                return
+            column = self._cols[col] = list(column)
+        column[row] = _intern(value)
+
+    def _append(self, name):
+        row = len(self._keys)
+        self._index[name] = row
+        self._keys.append(name)
+        for col, column in self._cols.items():
+            if isinstance(column, array):
+                column = self._cols[col] = list(column)
+            column.append(_Missing)
+        return row
+
+    #
+    #   Mapping interface (filename --> record)
+    #
+    def __getitem__(self, name):
+        return ImageRow(self, self._index[name])
+
+    def __setitem__(self, name, Record):
+        """ Add (or replace) a record.  As with a dict of dicts, a replaced record loses any
+            values not present in the new one (Record may be a dict or an ImageRow).
+        """
+        name = _intern(name)
+        row = self._index.get(name)
+        if row is None:
+            row = self._append(name)
+        else:
+            Record = dict(Record)
+            for col in self._cols:
+                if col not in Record:
+                    self._set(row, col, _Missing)
+        for col, value in Record.items():
+            self._set(row, col, value)
+
+    def __delitem__(self, name):
+        row = self._index.pop(name)
+        del self._keys[row]
+        for col, column in self._cols.items():
+            del column[row]
+        for i in range(row, len(self._keys)):
+            self._index[self._keys[i]] = i
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"ImageTable({len(self):d} records, columns={self.columns})"
+
+    @property
+    def columns(self):
+        """ List of columns (in the order they were first set) """
+        return list(self._cols)
+
+    #
+    #   Bulk operations
+    #
+    def add_rows(self, desc, rows):
+        """ Add (or replace) records from query results.
+
+            Inputs:
+                desc:   List of column names (must include the key column)
+                rows:   Iterable of sequences (values in the order of desc)
+        """
+        ikey = desc.index(self.key)
+        for row in rows:
+            self[row[ikey]] = dict(zip(desc, row))
+        return self
+
+    def subset(self, names):
+        """ New table holding copies of the named records (those not present are skipped) """
+        Table = ImageTable(key=self.key)
+        rows = [self._index[name] for name in names if name in self._index]
+        Table._keys = [self._keys[row] for row in rows]
+        Table._index = {name: i for i, name in enumerate(Table._keys)}
+        for col, column in self._cols.items():
+            Table._cols[col] = [column[row] for row in rows]
+        return Table
+
+    def merge(self, Other, columns=None, how='left', prefix=''):
+        """ Join another table (or dict of records) onto this one by key.
+
+            Inputs:
+                Other:      ImageTable or mapping (key --> record)
+                columns:    Columns of Other to bring in (default: all)
+                how:        'left' keeps all records of this table, 'inner' only those also in Other
+                prefix:     Prefix added to the names of the columns brought in
+
+            Returns:
+                Table:      New ImageTable
+        """
+        if how not in ['left', 'inner']:
+            raise ValueError(f"ImageTable.merge: unsupported join type (how={how})")
+        names = [name for name in self._keys if how == 'left' or name in Other]
+        Table = self.subset(names)
+        for name in names:
+            if name not in Other:
+                continue
+            Record = Other[name]
+            row = Table._index[name]
+            for col in (Record if columns is None else columns):
+                if col in Record:
+                    Table._set(row, prefix + col, Record[col])
+        return Table
+
+    def column(self, col, default=None):
+        """ Values of a column as a numpy array (absent values are given by default) """
+        column = self._cols.get(col)
+        if column is None:
+            return np.array([default] * len(self._keys))
+        if isinstance(column, array):
+            return np.frombuffer(column, dtype=np.dtype(column.typecode))
+        return np.array([default if value is _Missing else value for value in column])
+
+    def compact(self):
+        """ Store numeric columns (present for every record, no NULLs) as typed arrays """
+        for col, column in self._cols.items():
+            if isinstance(column, array) or len(column) < 1:
+                continue
+            types = set([type(value) for value in column])
+            if types == {int}:
+                self._cols[col] = array('q', column)
+            elif types <= {int, float} and float in types:
+                self._cols[col] = array('d', column)
+        return self
+
+    def to_dict(self):
+        """ Convert to a (legacy) dict of dicts """
+        return {name: dict(self[name]) for name in self._keys}
+
+    def to_array(self, dtype):
+        """ Convert to a structured array (dtype: list of (column, type); absent values give 0/'') """
+        Arr = np.zeros(len(self._keys), dtype=dtype)
+        for col in Arr.dtype.names:
+            fill = '' if Arr.dtype[col].kind in 'SU' else 0
+            vals = self.column(col, default=fill)
+            Arr[col] = [fill if val is None else val for val in vals]
+        return Arr
+
+    @classmethod
+    def from_dict(cls, ImgDict, key='filename'):
+        """ Form a table from a (legacy) dict of dicts """
+        return cls(ImgDict, key=key)
+
+
+######################################################################################
+def to_image_dict(ImgDict):
+    """ Adapter to the legacy interface: return a dict of dicts (whatever the input) """
+    if isinstance(ImgDict, ImageTable):
+        return ImgDict.to_dict()
+    if isinstance(ImgDict, Mapping):
+        return {name: dict(Record) for name, Record in ImgDict.items()}
+    raise TypeError(f"to_image_dict: unsupported type {type(ImgDict)}")
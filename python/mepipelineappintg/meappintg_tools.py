@@ -5,6 +5,10 @@
 import re
 import math
 import os
+import sys
+import json
+import time
+import subprocess
 import numpy
 import fitsio
 import fitvd
@@ -17,18 +21,70 @@ def get_globalseed(tilename, shift=''):
     seed = result + shift
     return int(seed)
 
-def chunkseed(tilename, chunk, shift=''):
-    tile_seed = get_globalseed(tilename, shift)
-    rng = numpy.random.RandomState(tile_seed)
-    k = 1
-    while k <= chunk:
-        newseed = rng.randint(low=1, high=1000000000)
-        k += 1
+# seeds already drawn in this process (keyed by tilename and shift)
+_ChunkSeeds = {}
+
+def chunkseeds(tilename, n, shift=''):
+    """ Return the seeds for chunks 1..n of a tile (element k-1 is the seed
+        for chunk k).  The seeds are drawn in one call, which gives the same
+        sequence as drawing them one at a time from RandomState(tile_seed)
+    """
+    key = (tilename, shift)
+    if key not in _ChunkSeeds or _ChunkSeeds[key].size < n:
+        tile_seed = get_globalseed(tilename, shift)
+        rng = numpy.random.RandomState(tile_seed)
+        _ChunkSeeds[key] = rng.randint(low=1, high=1000000000, size=n)
+    return _ChunkSeeds[key][:n]
+
+def chunkseed(tilename, chunk, shift='', nranges=None):
+    """ Return the seed for a chunk of a tile.  When nranges is given the
+        seeds for all nranges chunks are drawn at once (so that asking for
+        each chunk in turn does not re-draw a longer sequence every time)
+    """
+    newseed = int(chunkseeds(tilename, max(chunk, nranges or 0), shift)[chunk - 1])
     return newseed
 
-def find_number_fof(filename, ext):
-    fofs = fitsio.read(filename)
-    num = numpy.unique(fofs['fofid']).size
+def write_chunkseeds(filename, tilename, n, shift=''):
+    """ Write the table of seeds for chunks 1..n of a tile (chunk seed) """
+    with open(filename, 'w') as fout:
+        fout.write(f"# chunk seed (tilename={tilename})\n")
+        for chunk, seed in enumerate(chunkseeds(tilename, n, shift), start=1):
+            fout.write(f"{chunk} {seed}\n")
+
+def fof_group_counts(filename, column='fofid'):
+    """Return the number of members of each FoF group (in order of the group
+    id).  Only the group id column is read, and the counts are kept in a
+    sidecar file (FILENAME.COLUMN.npz, keyed by the size/mtime of the FoF file)
+    so that the many chunks of a tile do not each re-read and re-sort it"""
+    fstat = os.stat(filename)
+    sidecar = f"{filename}.{column}.npz"
+    if os.path.isfile(sidecar):
+        try:
+            with numpy.load(sidecar) as cached:
+                if cached['size'] == fstat.st_size and cached['mtime_ns'] == fstat.st_mtime_ns:
+                    return cached['counts']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    fofid = fitsio.read(filename, columns=[column])[column]
+    if fofid.size > 1 and numpy.all(fofid[1:] >= fofid[:-1]):
+        # already ordered by group id (as written by the FoF makers), no sort needed
+        starts = numpy.flatnonzero(numpy.concatenate([[True], fofid[1:] != fofid[:-1]]))
+        counts = numpy.diff(numpy.append(starts, fofid.size))
+    else:
+        counts = numpy.unique(fofid, return_counts=True)[1]
+
+    try:
+        # write to a temporary file then move into place (chunks may count at the same time)
+        tmpfile = f"{sidecar}.tmp{os.getpid()}.npz"
+        numpy.savez(tmpfile, size=fstat.st_size, mtime_ns=fstat.st_mtime_ns, counts=counts)
+        os.replace(tmpfile, sidecar)
+    except OSError as err:
+        print(f"# Unable to write FoF sidecar {sidecar}: {err}")
+    return counts
+
+def find_number_fof(filename, ext, column='fofid'):
+    num = fof_group_counts(filename, column=column).size
     return num
 
 def find_number_meds(filename):
@@ -55,6 +111,196 @@ def getrange_dynamical(n, fof_file, nranges, threshold):
     (j1, j2) = splits[n - 1]
     return j1, j2
 
+def estimate_costs(fof_file=None, meds_files=None, fofcol='fofid', group_exp=1.0):
+    """Estimate the relative cost of fitting each unit of work, i.e. each FoF
+    group (in order of fofid) when a FoF file is given, otherwise each object
+    (in MEDS order).  An object costs the number of cutout pixels it has over
+    all the MEDS files (or 1 without MEDS) and a group costs the sum over its
+    members times nmembers**group_exp (blended objects are fit jointly)"""
+    objcost = None
+    if meds_files:
+        for meds_file in meds_files:
+            objdata = fitsio.read(meds_file, ext='object_data', columns=['number', 'ncutout', 'box_size'])
+            if objcost is None:
+                numbers = objdata['number']
+                objcost = numpy.zeros(numbers.max() + 1)
+            pix = objdata['ncutout'].astype('f8') * objdata['box_size'].astype('f8')**2
+            numpy.add.at(objcost, objdata['number'], pix)
+        objcost = numpy.maximum(objcost, 1.0)
+
+    if fof_file is None:
+        if objcost is None:
+            raise ValueError("Need a FoF file and/or MEDS files to estimate costs")
+        return objcost[numbers]
+
+    if objcost is None:
+        counts = fof_group_counts(fof_file, column=fofcol)
+        return counts.astype('f8')**(1.0 + group_exp)
+
+    fofs = fitsio.read(fof_file, columns=[fofcol, 'number'])
+    _, inv, counts = numpy.unique(fofs[fofcol], return_inverse=True, return_counts=True)
+    number = numpy.clip(fofs['number'], 0, objcost.size - 1)
+    membercost = objcost[number]
+    return numpy.bincount(inv.ravel(), weights=membercost) * counts.astype('f8')**group_exp
+
+def count_units(fof_file=None, meds_files=None, fofcol='fofid'):
+    """Return the number of units of work (as from estimate_costs): the number
+    of FoF groups when a FoF file is given, otherwise the number of objects in
+    the first MEDS file"""
+    if fof_file is not None:
+        return int(fof_group_counts(fof_file, column=fofcol).size)
+    if not meds_files:
+        raise ValueError("Need a FoF file and/or MEDS files to count units")
+    return find_number_meds(meds_files[0])
+
+def plan_ranges(costs, nranges):
+    """Split units of work (with costs) into nranges contiguous [j1, j2] ranges
+    minimizing the cost of the most expensive range.  Ranges beyond the number
+    of units are empty (j1 > j2), as with getrange"""
+    nunits = costs.size
+    cum = numpy.cumsum(costs)
+
+    def split(cap):
+        ranges = []
+        j1 = 0
+        for k in range(nranges):
+            if j1 >= nunits:
+                ranges.append((nunits, nunits - 1))
+                continue
+            base = cum[j1 - 1] if j1 > 0 else 0.0
+            j2 = int(numpy.searchsorted(cum, base + cap, side='right'))
+            # keep at least one unit for each of the remaining ranges
+            j2 = max(min(j2, nunits - (nranges - k - 1)), j1 + 1)
+            ranges.append((j1, j2 - 1))
+            j1 = j2
+        return ranges, j1 >= nunits
+
+    if nunits == 0:
+        return [(0, -1)] * nranges
+    lo = costs.max()
+    hi = cum[-1]
+    for _ in range(60):
+        if hi - lo <= 1.e-6 * hi:
+            break
+        mid = 0.5 * (lo + hi)
+        if split(mid)[1]:
+            hi = mid
+        else:
+            lo = mid
+    return split(hi)[0]
+
+# plans already made in this process (e.g. when running all chunks of a tile)
+_Plans = {}
+
+def getrange_planned(n, nranges, fof_file=None, meds_files=None, fofcol='fofid', plan_out=None, tilename=None):
+    """Get the range for chunk n from a cost-weighted plan.  When plan_out is
+    given the plan is read from that file (or computed and written there) so
+    that all the chunks of a tile share one plan (a plan is also remembered
+    in-process).  A plan read from file is only used when it was made for the
+    same inputs (FoF/MEDS files, number of ranges and of units of work).  When
+    tilename is given the plan also records the chunk seeds"""
+    if plan_out is not None and os.path.isfile(plan_out):
+        with open(plan_out) as fplan:
+            plan = json.load(fplan)
+        stored = {'nranges': plan.get('nranges'), 'fof_file': plan.get('fof_file'),
+                  'meds_files': plan.get('meds_files') or [], 'fofcol': plan.get('fofcol', fofcol)}
+        current = {'nranges': nranges, 'fof_file': fof_file,
+                   'meds_files': list(meds_files or []), 'fofcol': fofcol}
+        mismatch = [name for name in current if stored[name] != current[name]]
+        if not mismatch and plan['nunits'] != count_units(fof_file=fof_file, meds_files=meds_files, fofcol=fofcol):
+            mismatch.append('nunits')
+        if not mismatch:
+            print(f"# Using chunk plan from {plan_out}")
+            (j1, j2) = plan['ranges'][n - 1]
+            return j1, j2
+        print(f"# Chunk plan in {plan_out} was made for different {', '.join(mismatch)}, will re-plan")
+
+    key = (fof_file, tuple(meds_files or []), fofcol, nranges)
+    if key in _Plans:
+        (j1, j2) = _Plans[key][n - 1]
+        return j1, j2
+
+    costs = estimate_costs(fof_file=fof_file, meds_files=meds_files, fofcol=fofcol)
+    ranges = plan_ranges(costs, nranges)
+    _Plans[key] = ranges
+    cum = numpy.concatenate([[0.0], numpy.cumsum(costs)])
+    chunkcost = [float(cum[j2 + 1] - cum[j1]) if j2 >= j1 else 0.0 for (j1, j2) in ranges]
+    print(f"# Planned {nranges} ranges for {costs.size} units, max/mean cost: {max(chunkcost) / numpy.mean(chunkcost):.3f}")
+    if plan_out is not None:
+        plan = {'nranges': nranges, 'nunits': int(costs.size), 'fof_file': fof_file,
+                'meds_files': list(meds_files or []), 'fofcol': fofcol, 'ranges': [[int(j1), int(j2)] for (j1, j2) in ranges], 'costs': chunkcost}
+        if tilename is not None:
+            plan['seeds'] = [int(seed) for seed in chunkseeds(tilename, nranges)]
+        # write to a temporary file then move into place (chunks may plan at the same time)
+        tmpfile = f"{plan_out}.tmp{os.getpid()}"
+        with open(tmpfile, 'w') as fplan:
+            json.dump(plan, fplan, indent=1)
+        os.replace(tmpfile, plan_out)
+        print(f"# Wrote chunk plan to {plan_out}")
+    (j1, j2) = ranges[n - 1]
+    return int(j1), int(j2)
+
+def chunk_args(args, wrange):
+    """Return a copy of a list of command-line arguments with {wrange}
+    replaced by the chunk number (e.g. to give each chunk its own output)"""
+    return [arg.replace('{wrange}', str(wrange)) if isinstance(arg, str) else arg for arg in args]
+
+def has_chunk_args(args):
+    """Check whether any of a list of command-line arguments contains {wrange}
+    (i.e. whether the chunks run by run_chunks get distinct outputs)"""
+    return any(isinstance(arg, str) and '{wrange}' in arg for arg in args)
+
+def run_chunks(cmds, max_workers=1, retries=0, logdir='.', logname='chunk', dryrun=False):
+    """Run the commands for a set of chunks (dict of command keyed by chunk
+    number) as a local pool of at most max_workers processes.  The output of
+    each chunk goes to its own log (LOGDIR/LOGNAME_CHUNK.log, appended to on
+    a retry) and a failed chunk is re-run up to retries times.  Returns the
+    exit status (0 if every chunk succeeded) after printing a summary"""
+    if dryrun:
+        for chunk, cmd in cmds.items():
+            print(f"# chunk {chunk}: {cmd}")
+        return 0
+
+    os.makedirs(logdir, exist_ok=True)
+    pending = list(cmds)
+    running = {}
+    attempts = {chunk: 0 for chunk in cmds}
+    walltime = {chunk: 0.0 for chunk in cmds}
+    status = {}
+    while pending or running:
+        while pending and len(running) < max(max_workers, 1):
+            chunk = pending.pop(0)
+            attempts[chunk] += 1
+            logfile = os.path.join(logdir, f"{logname}_{chunk:03d}.log")
+            flog = open(logfile, 'a')
+            proc = subprocess.Popen(cmds[chunk], shell=True, stdout=flog, stderr=subprocess.STDOUT)
+            running[chunk] = (proc, flog, time.time())
+            print(f"# Started chunk {chunk} (attempt {attempts[chunk]}), log: {logfile}")
+            sys.stdout.flush()
+        time.sleep(0.1)
+        for chunk in list(running):
+            proc, flog, t0 = running[chunk]
+            if proc.poll() is None:
+                continue
+            flog.close()
+            del running[chunk]
+            walltime[chunk] += time.time() - t0
+            status[chunk] = proc.returncode
+            if proc.returncode != 0 and attempts[chunk] <= retries:
+                print(f"# Chunk {chunk} failed (status {proc.returncode}), will retry")
+                pending.append(chunk)
+            else:
+                print(f"# Finished chunk {chunk} with status {proc.returncode}")
+            sys.stdout.flush()
+
+    print("# chunk  attempts  status  walltime[s]")
+    for chunk in cmds:
+        print(f"# {chunk:5d}  {attempts[chunk]:8d}  {status[chunk]:6d}  {walltime[chunk]:11.1f}")
+    nfail = sum(1 for chunk in cmds if status[chunk] != 0)
+    print(f"# {len(cmds) - nfail} of {len(cmds)} chunks succeeded, "
+          f"max/mean walltime: {max(walltime.values()):.1f}/{numpy.mean(list(walltime.values())):.1f}")
+    return 1 if nfail > 0 else 0
+
 def read_meds_list(filename):
     """Reads and return a dictionary with meds filenames by band"""
     fnames = {}
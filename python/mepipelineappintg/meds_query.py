@@ -6,6 +6,8 @@
 A set of queries to obtain inputs for the COADD pipeline.
 """
 
+from mepipelineappintg.db_query import bind, query_cursor
+
 ######################################################################################
 def query_imgs_from_attempt(attemptID, bands, dbh, dbSchema, verbose=0):
     """ Query code to obtain image inputs for COADD (based on a previous successful
@@ -38,7 +40,7 @@ def query_imgs_from_attempt(attemptID, bands, dbh, dbSchema, verbose=0):
         i.ccdnum as ccdnum,
         j.mag_zero as mag_zero
     FROM {dbSchema:s}image i, {dbSchema:s}image j, {dbSchema:s}desfile d, {dbSchema:s}desfile d2, {dbSchema:s}opm_was_derived_from wdf, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai
-    WHERE d.pfw_attempt_id={attemptID:s}
+    WHERE d.pfw_attempt_id={bind(dbh, 'attempt_id')}
         and d.filetype='coadd_nwgint'
         and d.id=wdf.child_desfile_id
         and wdf.parent_desfile_id=d2.id
@@ -58,8 +60,7 @@ def query_imgs_from_attempt(attemptID, bands, dbh, dbSchema, verbose=0):
             print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
         if verbose > 1:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'attempt_id': int(attemptID)}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     ImgDict = {}
@@ -86,6 +87,7 @@ def query_imgs_from_attempt(attemptID, bands, dbh, dbSchema, verbose=0):
     for ImgName in HeadDict:
         ImgList.append([HeadDict[ImgName]['filename']])
 #   Make sure teh GTT_FILENAME table is empty
+    curDB = dbh.cursor()
     curDB.execute('delete from GTT_FILENAME')
 #   load img ids into opm_filename_gtt table
     print(f"# Loading GTT_FILENAME table with headfile names for secondary query to get paths with {len(ImgList):d} images")
@@ -105,8 +107,7 @@ def query_imgs_from_attempt(attemptID, bands, dbh, dbSchema, verbose=0):
             print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
         if verbose > 1:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
 #
@@ -154,10 +155,10 @@ def query_attempt_from_tag_tile(ProcTag, TileName, dbh, dbSchema, verbose=0):
 #
     query = f"""SELECT t.pfw_attempt_id
     FROM {dbSchema:s}proctag t, {dbSchema:s}pfw_attempt_val av
-    WHERE t.tag='{ProcTag:s}'
+    WHERE t.tag={bind(dbh, 'proctag')}
         and t.pfw_attempt_id=av.pfw_attempt_id
         and av.key='tilename'
-        and av.val='{TileName:s}'
+        and av.val={bind(dbh, 'tilename')}
         """
 
     if verbose > 0:
@@ -166,8 +167,7 @@ def query_attempt_from_tag_tile(ProcTag, TileName, dbh, dbSchema, verbose=0):
             print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
         if verbose > 1:
             print(f"# sql = {query:s}")
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': TileName}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     attemptID=None 
@@ -184,3 +184,189 @@ def query_attempt_from_tag_tile(ProcTag, TileName, dbh, dbSchema, verbose=0):
     return attemptID
 
 
+
+######################################################################################
+def query_attempts_from_tag_tiles(ProcTag, TileList, dbh, dbSchema, verbose=0):
+    """ Query code to obtain attempt IDs for a list of tiles given a tag
+        (a batched version of query_attempt_from_tag_tile)
+
+        Uses an existing DB connection to execute a single query (with the tilenames
+        loaded into GTT_STR).  As with query_attempt_from_tag_tile the PFW_ATTEMPT_IDs
+        returned are INT type.
+
+        Inputs:
+            ProcTag:   Tag name to use for query
+            TileList:  List of tile names to use for query
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            AttemptDict: Dict of PFW_ATTEMPT_IDs keyed by tilename (tiles with no run are absent)
+    """
+#
+#   Load the tilenames into GTT_STR
+#
+    curDB = dbh.cursor()
+    curDB.execute('delete from GTT_STR')
+    print(f"# Loading GTT_STR table with {len(TileList):d} tilenames for query to obtain PFW_ATTEMPT_IDs")
+    dbh.insert_many('GTT_STR', ['STR'], [[Tile] for Tile in TileList])
+
+    query = f"""SELECT av.val as tilename, t.pfw_attempt_id
+    FROM {dbSchema:s}proctag t, {dbSchema:s}pfw_attempt_val av, gtt_str g
+    WHERE t.tag={bind(dbh, 'proctag')}
+        and t.pfw_attempt_id=av.pfw_attempt_id
+        and av.key='tilename'
+        and av.val=g.str
+        """
+
+    if verbose > 0:
+        print("# Executing query to obtain PFW_ATTEMPT_IDs for a list of tiles")
+        if verbose == 1:
+            print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
+        if verbose > 1:
+            print(f"# sql = {query:s}")
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag}, verbose=verbose)
+    desc = [d[0].lower() for d in curDB.description]
+
+    AttemptDict = {}
+    for row in curDB:
+        rowd = dict(zip(desc, row))
+        AttemptDict[rowd['tilename']] = rowd['pfw_attempt_id']
+
+#
+#   Give warning for tiles where no value was found.
+#
+    for Tile in TileList:
+        if Tile not in AttemptDict:
+            print(f"Warning: No PFW_ATTEMPT_ID (i.e. no run) identified for tag={ProcTag:s} and tilename={Tile:s}")
+
+    return AttemptDict
+
+
+######################################################################################
+def query_imgs_from_attempts(AttemptDict, bands, dbh, dbSchema, verbose=0):
+    """ Query code to obtain image inputs for many COADD tiles at once (a batched
+        version of query_imgs_from_attempt).
+
+        The attempt IDs are loaded into GTT_ID so that the RED_IMMASK images (and
+        head files) for all attempts are found with a single query, and the paths for
+        all head files with a single secondary query.  Results are grouped by tile.
+
+        Inputs:
+            AttemptDict: Dict of existing (completed through first block) attempts keyed by tilename
+            bands:     List of bands (that should be included).
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            TileImgDict,TileHeadDict:   Dicts (keyed by tilename) of ImgDict and HeadDict
+    """
+    AttemptTile = {int(AttemptDict[Tile]): Tile for Tile in AttemptDict}
+    TileImgDict = {Tile: {} for Tile in AttemptDict}
+    TileHeadDict = {Tile: {} for Tile in AttemptDict}
+    if len(AttemptTile) < 1:
+        return TileImgDict, TileHeadDict
+
+    curDB = dbh.cursor()
+    curDB.execute('delete from GTT_ID')
+    print(f"# Loading GTT_ID table with {len(AttemptTile):d} PFW_ATTEMPT_IDs for query to obtain red_immask images")
+    dbh.insert_many('GTT_ID', ['ID'], [[attemptID] for attemptID in AttemptTile])
+
+    query = f"""SELECT
+        d.pfw_attempt_id as pfw_attempt_id,
+        i.filename as filename,
+        fai.path as path,
+        fai.compression as compression,
+        m.filename as headfile,
+        i.band as band,
+        i.expnum as expnum,
+        i.ccdnum as ccdnum,
+        j.mag_zero as mag_zero
+    FROM {dbSchema:s}image i, {dbSchema:s}image j, {dbSchema:s}desfile d, {dbSchema:s}desfile d2, {dbSchema:s}opm_was_derived_from wdf, {dbSchema:s}miscfile m, {dbSchema:s}file_archive_info fai, gtt_id g
+    WHERE d.pfw_attempt_id=g.id
+        and d.filetype='coadd_nwgint'
+        and d.id=wdf.child_desfile_id
+        and wdf.parent_desfile_id=d2.id
+        and d2.filetype='red_immask'
+        and d2.filename=i.filename
+        and d2.filename=fai.filename
+        and d.pfw_attempt_id=m.pfw_attempt_id
+        and m.filetype='coadd_head_scamp'
+        and m.expnum=i.expnum
+        and m.ccdnum=i.ccdnum
+        and d.filename=j.filename
+        """
+
+    if verbose > 0:
+        print("# Executing query to obtain red_immask images (based on their use in previous multiepoch attempts)")
+        if verbose == 1:
+            print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
+        if verbose > 1:
+            print(f"# sql = {query:s}")
+    curDB = query_cursor(dbh, query, verbose=verbose)
+    desc = [d[0].lower() for d in curDB.description]
+
+    for row in curDB:
+        rowd = dict(zip(desc, row))
+        ImgName = rowd['filename']
+        Band = rowd['band']
+        if (Band in bands):
+            Tile = AttemptTile[int(rowd['pfw_attempt_id'])]
+            TileImgDict[Tile][ImgName] = {}
+            TileHeadDict[Tile][ImgName] = {}
+            for key in ['filename', 'path', 'compression', 'band', 'expnum', 'ccdnum']:
+                TileImgDict[Tile][ImgName][key] = rowd[key]
+            if rowd['mag_zero'] is not None:
+                TileImgDict[Tile][ImgName]['mag_zero'] = rowd['mag_zero']
+            TileHeadDict[Tile][ImgName]['filename'] = rowd['headfile']
+            for key in ['band', 'expnum', 'ccdnum']:
+                TileHeadDict[Tile][ImgName][key] = rowd[key]
+
+#
+#   Secondary query to get paths for Head Files (for all tiles at once)
+#
+    HeadList = sorted({HeadDict[ImgName]['filename'] for HeadDict in TileHeadDict.values() for ImgName in HeadDict})
+    curDB = dbh.cursor()
+    curDB.execute('delete from GTT_FILENAME')
+    print(f"# Loading GTT_FILENAME table with headfile names for secondary query to get paths with {len(HeadList):d} images")
+    dbh.insert_many('GTT_FILENAME', ['FILENAME'], [[HeadFile] for HeadFile in HeadList])
+
+    query = f"""SELECT
+        fai.filename as filename,
+        fai.path as path,
+        fai.compression as compression
+    FROM {dbSchema:s}file_archive_info fai, gtt_filename g
+    WHERE fai.filename=g.filename
+        """
+
+    if verbose > 0:
+        print("# Executing query to obtain paths for head files (based on their use in previous multiepoch attempts)")
+        if verbose == 1:
+            print(f"# sql = " + ' '.join([d.strip() for d in query.split('\n')]))
+        if verbose > 1:
+            print(f"# sql = {query:s}")
+    curDB = query_cursor(dbh, query, verbose=verbose)
+    desc = [d[0].lower() for d in curDB.description]
+
+    tmpDict = {}
+    for row in curDB:
+        rowd = dict(zip(desc, row))
+        tmpDict[rowd['filename']] = rowd
+
+#
+#   Go through each HeadDict and assign path and compression fields from the tmpDict
+#
+    for Tile in TileHeadDict:
+        HeadDict = TileHeadDict[Tile]
+        for Img in HeadDict:
+            if HeadDict[Img]['filename'] in tmpDict:
+                HeadDict[Img]['path'] = tmpDict[HeadDict[Img]['filename']]['path']
+                HeadDict[Img]['compression'] = tmpDict[HeadDict[Img]['filename']]['compression']
+            else:
+                print(f"Warning: No entry in FILE_ARCHIVE_INFO found for {HeadDict[Img]['filename']:s}")
+
+    print(f"# Found images for {len([Tile for Tile in TileImgDict if TileImgDict[Tile]]):d} of {len(TileImgDict):d} tiles")
+
+    return TileImgDict, TileHeadDict
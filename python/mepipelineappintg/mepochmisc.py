@@ -3,19 +3,34 @@
 # $LastChangedBy:: rgruendl               $:  # Author of last commit.
 
 import os
+import re
+import json
 import time
 from despydb import desdbi
+from mepipelineappintg.db_query import bind, query_cursor
 
 ######################################################################################
 def get_tile_info(indict):
     # indict must have submit_des_services, submit_des_db_section, tilename
 
-    dbh = desdbi.DesDbi(indict['submit_des_services'], indict['submit_des_db_section'])
+    # use the (cached) snapshot of coaddtile_geom for this DB section when present (avoids a DB connection)
+    from mepipelineappintg.tile_geom import get_tile_geom
+    GeomCols = {'tileid': 'id', 'ra_cent': 'ra_cent', 'dec_cent': 'dec_cent', 'pixelscale': 'pixelscale',
+                'naxis1': 'naxis1', 'naxis2': 'naxis2', 'uramin': 'uramin', 'uramax': 'uramax',
+                'udecmin': 'udecmin', 'udecmax': 'udecmax', 'crossra0': 'crossra0'}
+    section = indict['submit_des_db_section']
+    CacheDict = get_tile_geom(indict['tilename'], 'coaddtile_geom', columns=GeomCols, section=section)
+    if indict['tilename'] in CacheDict:
+        return CacheDict[indict['tilename']]
 
-    sql = f"select id as tileid, ra_cent, dec_cent, pixelscale, naxis1, naxis2, uramin, uramax, udecmin, udecmax, crossra0 from coaddtile_geom where tilename={dbh.get_named_bind_string('tilename')}"
+    dbh = desdbi.DesDbi(indict['submit_des_services'], section)
+    CacheDict = get_tile_geom(indict['tilename'], 'coaddtile_geom', dbh, columns=GeomCols, section=section)
+    if indict['tilename'] in CacheDict:
+        return CacheDict[indict['tilename']]
 
-    curs = dbh.cursor()
-    curs.execute(sql, {'tilename': indict['tilename']})
+    sql = f"select id as tileid, ra_cent, dec_cent, pixelscale, naxis1, naxis2, uramin, uramax, udecmin, udecmax, crossra0 from coaddtile_geom where tilename={bind(dbh, 'tilename')}"
+
+    curs = query_cursor(dbh, sql, {'tilename': indict['tilename']})
     desc = [d[0].lower() for d in curs.description]
 
     d = dict(zip(desc, curs.fetchone()))
@@ -59,16 +74,92 @@ def write_textlist(dbh, dict_input, outfile, archive_name='desar2home', sel_band
 
 
 ######################################################################################
+#
+#   Archive roots (keyed by DB, see db_cache_key, then by archive name) from OPS_ARCHIVE, loaded
+#   once per process for each DB.  When a TTL (seconds) is given (or $MEPIPELINEAPPINTG_ARCHIVE_TTL
+#   is set) the table is also kept in a small file (per DB) in the cache directory and re-used
+#   until it is older than the TTL.
+#
+_ArchiveRoots = {}
+
+
+def archive_roots_ttl(ttl=None):
+    """ Resolve the time (seconds) that a persisted copy of OPS_ARCHIVE remains valid (0 means do not persist) """
+    if ttl is None:
+        try:
+            ttl = float(os.environ.get('MEPIPELINEAPPINTG_ARCHIVE_TTL', 0))
+        except ValueError:
+            ttl = 0
+    return ttl
+
+
+def load_archive_roots(dbh=None, section=None, cachedir=None, ttl=None, reload=False, verb=None):
+    """ Load the root of every archive in OPS_ARCHIVE (once per process for each DB).
+
+        Inputs:
+            dbh:        Database connection (None means only the in-memory/persisted copy is used)
+            section:    DB section (identifies the DB when no connection is given)
+            cachedir:   Directory holding the persisted copy (None uses get_cache_dir)
+            ttl:        Age (seconds) for which a persisted copy is valid (None uses
+                            $MEPIPELINEAPPINTG_ARCHIVE_TTL; 0 means no persisted copy)
+            reload:     Force the table to be re-read from the DB.
+            verb:       Verbosity
+
+        Returns:
+            ArchiveRoots:   Dict of root (keyed by archive name)
+    """
+    dbkey = db_cache_key(dbh, section)
+    if dbkey is not None and dbkey in _ArchiveRoots and not reload:
+        return _ArchiveRoots[dbkey]
+
+    ttl = archive_roots_ttl(ttl)
+    fname = None
+    if ttl > 0 and dbkey is not None:
+        fname = os.path.join(get_cache_dir(cachedir), f"ops_archive.{dbkey}.json")
+        if not reload and os.path.isfile(fname) and time.time() - os.path.getmtime(fname) < ttl:
+            with open(fname, 'r') as fin:
+                _ArchiveRoots[dbkey] = json.load(fin)
+            if verb:
+                print(f"Read roots for {len(_ArchiveRoots[dbkey])} archives from: {fname}")
+            return _ArchiveRoots[dbkey]
+
+    if dbh is None:
+        return {}
+
+    query = "SELECT name, root FROM ops_archive"
+    if verb:
+        print(f"Will execute the SQL query:\n********\n** {query}\n********")
+    cur = query_cursor(dbh, query)
+    Roots = {name: root for name, root in cur.fetchall()}
+    if verb:
+        print(f"Loaded roots for {len(Roots)} archives")
+    if dbkey is None:
+        # the DB cannot be identified so the table is not kept
+        return Roots
+    _ArchiveRoots[dbkey] = Roots
+
+    if fname is not None:
+        # write to a temporary file then move into place (so a partial file is never read)
+        tmpfile = f"{fname}.tmp{os.getpid()}"
+        with open(tmpfile, 'w') as fout:
+            json.dump(Roots, fout)
+        os.replace(tmpfile, fname)
+
+    return Roots
+
+
 def get_root_archive(dbh, archive_name='desar2home', verb=None):
-    """ Get the root-archive fron the database"""
-    cur = dbh.cursor()
-    # root_archive
-    query = f"SELECT root FROM ops_archive WHERE name='{archive_name}'"
+    """ Get the root-archive (from the process-wide copy of OPS_ARCHIVE for the DB, so that writing
+        many lists or forming many fullnames only queries once)"""
     if verb:
         print(f"Getting the archive root name for section: {archive_name}")
-        print(f"Will execute the SQL query:\n********\n** {query}\n********")
-    cur.execute(query)
-    root_archive = cur.fetchone()[0]
+    ArchiveRoots = load_archive_roots(dbh, verb=verb)
+    if archive_name not in ArchiveRoots and dbh is not None:
+        # an archive added since the table was loaded (or persisted)
+        ArchiveRoots = load_archive_roots(dbh, reload=True, verb=verb)
+    if archive_name not in ArchiveRoots:
+        raise ValueError(f"Archive {archive_name} not found in OPS_ARCHIVE")
+    root_archive = ArchiveRoots[archive_name]
     if verb:
         print(f"root_archive: {root_archive}")
     return root_archive
@@ -102,10 +193,10 @@ def find_tile_attempt(TileName, ProcTag, dbh, dbSchema, releasePrefix=None, Timi
     query = f"""SELECT
             distinct t.pfw_attempt_id as pfw_attempt_id
         FROM {dbSchema:s}{relPrefix:s}proctag t, {dbSchema:s}{relPrefix:s}catalog c
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
             and t.pfw_attempt_id=c.pfw_attempt_id
             and c.filetype='coadd_cat'
-            and c.tilename='{TileName:s}'
+            and c.tilename={bind(dbh, 'tilename')}
         """
 
     if verbose > 0:
@@ -120,8 +211,7 @@ def find_tile_attempt(TileName, ProcTag, dbh, dbSchema, releasePrefix=None, Timi
     #
     #   Establish a DB connection
     #
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': TileName}, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     attval = None
@@ -142,9 +232,9 @@ def find_tile_attempt(TileName, ProcTag, dbh, dbSchema, releasePrefix=None, Timi
         query = f"""SELECT
                 distinct t.pfw_attempt_id as pfw_attempt_id
             FROM {dbSchema:s}{relPrefix:s}proctag t, {dbSchema:s}{relPrefix:s}miscfile m
-            WHERE t.tag='{ProcTag:s}'
+            WHERE t.tag={bind(dbh, 'proctag')}
                 and t.pfw_attempt_id=m.pfw_attempt_id
-                and m.tilename='{TileName:s}'
+                and m.tilename={bind(dbh, 'tilename')}
             """
 
         if verbose > 0:
@@ -157,7 +247,7 @@ def find_tile_attempt(TileName, ProcTag, dbh, dbSchema, releasePrefix=None, Timi
             if verbose > 1:
                 print(f"{query:s}")
 #
-        curDB.execute(query)
+        curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'tilename': TileName}, verbose=verbose)
         desc = [d[0].lower() for d in curDB.description]
 
         for row in curDB:
@@ -171,7 +261,6 @@ def find_tile_attempt(TileName, ProcTag, dbh, dbSchema, releasePrefix=None, Timi
     if Timing:
         t1 = time.time()
         print(f" Query to find attempt execution time: {t1 - t0:.2f}")
-    curDB.close()
 
     return attval
 
@@ -196,10 +285,54 @@ def read_target_path(tpath_file, verbose=0):
     return tpath_Dict
 
 ######################################################################################
-def update_fullname(Dict,tpath):
-    """Update/create a 'fullname' entry that uses an updated tpath rather than archive path"""
+def update_fullname(Dict,tpath=None,dbh=None,archive_name='desar2home'):
+    """Update/create a 'fullname' entry that uses an updated tpath rather than archive path
+       (or when tpath is None the archive path under the root of archive_name)"""
+    if (tpath is None):
+        root_archive=get_root_archive(dbh,archive_name=archive_name)
     for Img in Dict:
         if (Dict[Img]['compression'] is None):
             Dict[Img]['compression']=''
-        Dict[Img]['fullname']=tpath+'/'+Dict[Img]['filename']+Dict[Img]['compression']
+        if (tpath is None):
+            Dict[Img]['fullname']=os.path.join(root_archive,Dict[Img]['path'],Dict[Img]['filename']+Dict[Img]['compression'])
+        else:
+            Dict[Img]['fullname']=tpath+'/'+Dict[Img]['filename']+Dict[Img]['compression']
     return Dict
+
+######################################################################################
+def get_cache_dir(cachedir=None, verbose=0):
+    """ Resolve (and create if needed) the directory used to hold local on-disk caches.
+        Precedence is: cachedir (if given), $MEPIPELINEAPPINTG_CACHE_DIR, ~/.cache/mepipelineappintg
+    """
+    if cachedir is None:
+        cachedir = os.environ.get('MEPIPELINEAPPINTG_CACHE_DIR',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'mepipelineappintg'))
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+        if verbose > 0:
+            print(f"Created cache directory: {cachedir:s}")
+    return cachedir
+
+
+######################################################################################
+def db_cache_key(dbh=None, section=None):
+    """ Form a (filename safe) key identifying the database that a cache was built from.
+        The DB section is used when known (given, or held by the connection), otherwise the
+        server/service (or file) of the connection.  Returns None when the DB cannot be identified
+        (in which case callers should not use a cache).
+    """
+    if section is None and dbh is not None:
+        section = getattr(dbh, 'section', None)
+    if section is not None:
+        key = f"section_{section}"
+    elif dbh is None:
+        return None
+    elif getattr(dbh, 'configdict', None):
+        config = dbh.configdict
+        key = '_'.join([str(config.get(k)) for k in ['type', 'server', 'port', 'service', 'name'] if config.get(k)])
+    elif getattr(dbh, 'dbfile', None):
+        key = str(dbh.dbfile)
+    else:
+        return None
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', key).lower()
+
@@ -1,14 +1,15 @@
 import os
 import time
-from functools import lru_cache
 
+from mepipelineappintg.db_query import bind, query_cursor
 from mepipelineappintg.mepochmisc import get_root_archive
+from mepipelineappintg.tile_geom import get_tile_geom
 
 MAGZP_REF = 30.0
 
 
-def _execute_query(query, dbh, verbose, Timing):
-    """actually execute a query"""
+def _execute_query(query, dbh, verbose, Timing, params=None):
+    """actually execute a query (with params providing values for any bind variables)"""
     t0 = time.time()
 
     if verbose > 0:
@@ -21,10 +22,9 @@ def _execute_query(query, dbh, verbose, Timing):
         if verbose > 1:
             print(f"{query:s}")
     #
-    #   Establish a DB connection
+    #   Execute (re-using the cursor when the statement has been seen before)
     #
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    curDB = query_cursor(dbh, query, params, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     rowds = []
@@ -34,7 +34,6 @@ def _execute_query(query, dbh, verbose, Timing):
     if Timing:
         t1 = time.time()
         print(f"Query execution time: {t1 - t0:.2f}")
-    curDB.close()
 
     return rowds
 
@@ -63,6 +62,17 @@ def add_coaddtile_geom(
     else:
         relPrefix = releasePrefix
 
+    # use the (cached) snapshot of coaddtile_geom when possible
+    res = get_tile_geom(
+        tilename, f"{dbSchema:s}{relPrefix:s}coaddtile_geom", dbh,
+        columns=['crossra0', 'udecmin', 'udecmax', 'uramin', 'uramax'],
+        verbose=verbose,
+    )
+    if tilename in res:
+        for band in yaml_data:
+            yaml_data[band].update(res[tilename])
+        return
+
     query = f"""SELECT
                     cast(crossra0 as VARCHAR(1)) as crossra0,
                     udecmin,
@@ -72,19 +82,34 @@ def add_coaddtile_geom(
                 FROM
                     {dbSchema:s}{relPrefix:s}coaddtile_geom ctg
                 WHERE
-                    ctg.tilename = '{tilename:s}'
+                    ctg.tilename = {bind(dbh, 'tilename')}
                 """
-    res = _execute_query(query, dbh, verbose, Timing)
+    res = _execute_query(query, dbh, verbose, Timing, {'tilename': tilename})
     for band in yaml_data:
         yaml_data[band].update(res[0])
 
 
-@lru_cache(maxsize=1024)
 def _do_piff_info_query(
-    dbh, verbose, Timing, expnum, PiffTag, relPrefix, dbSchema
+    dbh, verbose, Timing, expnums, PiffTag, relPrefix, dbSchema
 ):
+    """Get PIFF QA info for a set of exposures with a single query
+    (the expnums are loaded into GTT_ID).
+
+    Returns a dict keyed by (expnum, filename) of the QA rows."""
+    ExpList = [[int(expnum)] for expnum in sorted(set(expnums))]
+    if not ExpList:
+        return {}
+
+    curDB = dbh.cursor()
+    curDB.execute('delete from GTT_ID')
+    curDB.close()
+    if verbose > 0:
+        print(f"# Loading GTT_ID table with {len(ExpList):d} expnums for PIFF QA query")
+    dbh.insert_many('GTT_ID', ['ID'], ExpList)
+
     query = f"""SELECT
                     DISTINCT
+                    qa.expnum,
                     qa.filename,
                     qa.flag as desdm_flags,
                     qa.fwhm_cen,
@@ -96,16 +121,22 @@ def _do_piff_info_query(
                 FROM
                     {dbSchema:s}{relPrefix:s}proctag t,
                     {dbSchema:s}{relPrefix:s}miscfile m,
-                    {dbSchema:s}{relPrefix:s}PIFF_HSM_MODEL_QA qa
+                    {dbSchema:s}{relPrefix:s}PIFF_HSM_MODEL_QA qa,
+                    gtt_id g
                 where
-                    qa.expnum = {expnum:d}
-                    and t.tag = '{PiffTag:s}'
+                    qa.expnum = g.id
+                    and t.tag = {bind(dbh, 'proctag')}
                     and t.pfw_attempt_id = m.pfw_attempt_id
                     and m.filetype = 'piff_model'
                     and m.filename = qa.filename
                 """
 
-    return _execute_query(query, dbh, verbose, Timing)
+    piff_info = {}
+    for row in _execute_query(query, dbh, verbose, Timing, {'proctag': PiffTag}):
+        expnum = row.pop('expnum')
+        piff_info[(int(expnum), row['filename'])] = row
+
+    return piff_info
 
 
 def add_piff_info_to_yaml(
@@ -131,19 +162,19 @@ def add_piff_info_to_yaml(
     else:
         relPrefix = releasePrefix
 
+    expnums = [
+        src["expnum"] for band in yaml_data for src in yaml_data[band]["src_info"]
+    ]
+    piff_rows = _do_piff_info_query(
+        dbh, verbose, Timing, expnums, PiffTag, relPrefix, dbSchema
+    )
+
     for band in yaml_data:
         for isrc in range(len(yaml_data[band]["src_info"])):
             expnum = yaml_data[band]["src_info"][isrc]["expnum"]
-            piff_rows = _do_piff_info_query(
-                dbh, verbose, Timing, expnum, PiffTag, relPrefix, dbSchema
+            piff_info = piff_rows.get(
+                (int(expnum), os.path.basename(yaml_data[band]["src_info"][isrc]["piff_path"]))
             )
-            piff_info = None
-            for row in piff_rows:
-                if (
-                    row["filename"]
-                    == os.path.basename(yaml_data[band]["src_info"][isrc]["piff_path"])
-                ):
-                    piff_info = row
             if piff_info is None:
                 raise RuntimeError("could not find piff info for expnum %s" % expnum)
             yaml_data[band]["src_info"][isrc]["piff_info"] = piff_info
@@ -185,6 +216,7 @@ def get_coadd_info_from_attempt(
             db_table = "coadd"
         else:
             db_table = "miscfile"
+        QueryParams = {'proctag': ProcTag, 'tilename': tilename, 'band': band, 'filetype': filetype}
 
         query = f"""SELECT
                 m.tilename as tilename,
@@ -198,16 +230,16 @@ def get_coadd_info_from_attempt(
                 {dbSchema:s}{relPrefix:s}{db_table} m,
                 {dbSchema:s}{relPrefix:s}file_archive_info fai
             where
-                t.tag='{ProcTag:s}'
+                t.tag={bind(dbh, 'proctag')}
                 and t.pfw_attempt_id=m.pfw_attempt_id
-                and m.tilename='{tilename:s}'
-                and m.band='{band:s}'
-                and m.filetype='{filetype:s}'
+                and m.tilename={bind(dbh, 'tilename')}
+                and m.band={bind(dbh, 'band')}
+                and m.filetype={bind(dbh, 'filetype')}
                 and fai.filename=m.filename
                 and fai.archive_name='desar2home'
             """
 
-        rowds = _execute_query(query, dbh, verbose, Timing)
+        rowds = _execute_query(query, dbh, verbose, Timing, QueryParams)
         assert len(rowds) == 1
         rowd = rowds[0]
 
@@ -234,16 +266,17 @@ def get_coadd_info_from_attempt(
             {dbSchema:s}{relPrefix:s}catalog m,
             {dbSchema:s}{relPrefix:s}file_archive_info fai
         where
-            t.tag='{ProcTag:s}'
+            t.tag={bind(dbh, 'proctag')}
             and t.pfw_attempt_id=m.pfw_attempt_id
-            and m.tilename='{tilename:s}'
-            and m.band='{band:s}'
-            and m.filetype='{filetype:s}'
+            and m.tilename={bind(dbh, 'tilename')}
+            and m.band={bind(dbh, 'band')}
+            and m.filetype={bind(dbh, 'filetype')}
             and fai.filename=m.filename
             and fai.archive_name='desar2home'
         """
 
-    rowds = _execute_query(query, dbh, verbose, Timing)
+    QueryParams['filetype'] = filetype
+    rowds = _execute_query(query, dbh, verbose, Timing, QueryParams)
     assert len(rowds) == 1
     rowd = rowds[0]
     if rowd["compression"] is None:
@@ -259,6 +292,103 @@ def get_coadd_info_from_attempt(
     return data
 
 
+def get_coadd_info_from_attempt_bands(
+    tilename, bands, AttemptID, ProcTag, dbh, dbSchema, releasePrefix=None,
+    Timing=False, verbose=0
+):
+    """Get coadd info for several bands (as get_coadd_info_from_attempt) with a
+    single query covering all bands and filetypes.
+
+        Inputs:
+            tilename: The name of the tile.
+            bands: list of bands (as strings)
+            AttemptID:  The AttemptID for which to extract a tilename.
+            ProcTag:   Proctag name containing set to be worked on
+            dbh:       Database connection to be used
+            dbSchema:  Schema over which queries will occur.
+            releasePrefix: Prefix string (including _'s) to identify a specific
+                           set of tables
+                           (Useful when working from releases in DESSCI).
+                           None --> will substitute a null string.
+            Timing:    Causes internal timing to report results.
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            coadd_data: A dictionary (keyed by band then filetype) containing the
+                        relevant coadd data.
+    """
+    if releasePrefix is None:
+        relPrefix = ""
+    else:
+        relPrefix = releasePrefix
+
+    root_archive = get_root_archive(dbh, archive_name='desar2home', verb=verbose)
+
+    QueryParams = {'proctag': ProcTag, 'tilename': tilename}
+    BandBinds = []
+    for iband, band in enumerate(bands):
+        QueryParams[f'band{iband:d}'] = band
+        BandBinds.append(bind(dbh, f'band{iband:d}'))
+    BandConstraint = ", ".join(BandBinds)
+
+    QueryBranch = []
+    for db_table, filetypes in [
+        ("coadd", ["coadd"]),
+        ("miscfile", ["coadd_segmap", "coadd_psfex_model"]),
+        ("catalog", ["coadd_cat"]),
+    ]:
+        FileTypeConstraint = ", ".join([f"'{filetype:s}'" for filetype in filetypes])
+        QueryBranch.append(f"""SELECT
+                m.filetype as filetype,
+                m.tilename as tilename,
+                fai.path as path,
+                fai.filename as filename,
+                fai.compression as compression,
+                m.band as band,
+                m.pfw_attempt_id as pfw_attempt_id
+            from
+                {dbSchema:s}{relPrefix:s}proctag t,
+                {dbSchema:s}{relPrefix:s}{db_table} m,
+                {dbSchema:s}{relPrefix:s}file_archive_info fai
+            where
+                t.tag={bind(dbh, 'proctag')}
+                and t.pfw_attempt_id=m.pfw_attempt_id
+                and m.tilename={bind(dbh, 'tilename')}
+                and m.band in ({BandConstraint:s})
+                and m.filetype in ({FileTypeConstraint:s})
+                and fai.filename=m.filename
+                and fai.archive_name='desar2home'
+            """)
+    query = "UNION ALL\n            ".join(QueryBranch)
+
+    rowds = _execute_query(query, dbh, verbose, Timing, QueryParams)
+
+    band_data = {band: {} for band in bands}
+    for rowd in rowds:
+        band = rowd['band']
+        filetype = rowd.pop('filetype')
+        assert filetype not in band_data[band]
+
+        if rowd["compression"] is None:
+            rowd["compression"] = ""
+
+        rowd["fullname"] = os.path.join(
+            root_archive,
+            rowd['path'],
+            rowd['filename'] + rowd['compression'],
+        )
+        band_data[band][filetype] = rowd
+
+    coadd_data = {}
+    for band in bands:
+        coadd_data[band] = {}
+        for filetype in ["coadd", "coadd_segmap", "coadd_psfex_model", "coadd_cat"]:
+            assert filetype in band_data[band]
+            coadd_data[band][filetype] = band_data[band][filetype]
+
+    return coadd_data
+
+
 ######################################################################################
 def get_tilename_from_attempt(
     AttemptID, ProcTag, dbh, dbSchema, releasePrefix=None, Timing=False, verbose=0
@@ -291,10 +421,10 @@ def get_tilename_from_attempt(
     query = f"""SELECT
             distinct c.tilename as tilename
         FROM {dbSchema:s}{relPrefix:s}proctag t, {dbSchema:s}{relPrefix:s}catalog c
-        WHERE t.tag='{ProcTag:s}'
+        WHERE t.tag={bind(dbh, 'proctag')}
             and t.pfw_attempt_id=c.pfw_attempt_id
             and c.filetype='coadd_cat'
-            and t.pfw_attempt_id='{AttemptID:s}'
+            and t.pfw_attempt_id={bind(dbh, 'attempt_id')}
         """
 
     if verbose > 0:
@@ -307,10 +437,10 @@ def get_tilename_from_attempt(
         if verbose > 1:
             print(f"{query:s}")
     #
-    #   Establish a DB connection
+    #   Execute the query
     #
-    curDB = dbh.cursor()
-    curDB.execute(query)
+    QueryParams = {'proctag': ProcTag, 'attempt_id': int(AttemptID)}
+    curDB = query_cursor(dbh, query, QueryParams, verbose=verbose)
     desc = [d[0].lower() for d in curDB.description]
 
     attval = None
@@ -338,9 +468,9 @@ def get_tilename_from_attempt(
         query = f"""SELECT
                 distinct m.tilename as tilename
             FROM {dbSchema:s}{relPrefix:s}proctag t, {dbSchema:s}{relPrefix:s}miscfile m
-            WHERE t.tag='{ProcTag:s}'
+            WHERE t.tag={bind(dbh, 'proctag')}
                 and t.pfw_attempt_id=m.pfw_attempt_id
-                and m.pfw_attempt_id='{AttemptID:s}'
+                and m.pfw_attempt_id={bind(dbh, 'attempt_id')}
             """
 
         if verbose > 0:
@@ -353,7 +483,7 @@ def get_tilename_from_attempt(
             if verbose > 1:
                 print(f"{query:s}")
 #
-        curDB.execute(query)
+        curDB = query_cursor(dbh, query, QueryParams, verbose=verbose)
         desc = [d[0].lower() for d in curDB.description]
 
         for row in curDB:
@@ -370,7 +500,6 @@ def get_tilename_from_attempt(
     if Timing:
         t1 = time.time()
         print(f" Query to find tilename execution time: {t1 - t0:.2f}")
-    curDB.close()
 
     return attval
 
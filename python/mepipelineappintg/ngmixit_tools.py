@@ -16,15 +16,13 @@ def get_globalseed(tilename,shift=''):
 def chunkseed(tilename,chunk, shift=''):
     tile_seed = get_globalseed(tilename,shift)
     rng = numpy.random.RandomState(tile_seed)
-    k = 1
-    while k <= chunk:
-        newseed = rng.randint(low=1,high=1000000000)
-        k=k+1
+    # draw the seeds for chunks 1..chunk at once (same sequence as one at a time)
+    newseed = int(rng.randint(low=1,high=1000000000,size=chunk)[-1])
     return newseed
 
 def find_number_fof(filename,ext):
 
-    fofs = fitsio.read(filename)
+    fofs = fitsio.read(filename, columns=['fofid'])
     num = numpy.unique(fofs['fofid']).size
     return num
 
@@ -0,0 +1,370 @@
+"""
+A local (on-disk cached) index of RED_IMMASK image extents.  The extents for all images
+within a PROCTAG are queried once and stored as a compact array.  The index then resolves
+which images overlap a COADD tile (using the same edge criterion as
+coadd_query.query_coadd_img_by_edges) without further queries against the IMAGE table.
+
+The cache is keyed by DB (section/service, see mepochmisc.db_cache_key), schema, PROCTAG and
+archive.  It records when it was built and the state of the PROCTAG (number and maximum of the
+tagged attempts), and is rebuilt when older than $MEPIPELINEAPPINTG_EXTENT_CACHE_TTL seconds
+(default 1 day) or when attempts have been tagged/untagged since it was built.
+"""
+
+import os
+import json
+import time
+import numpy as np
+
+from mepipelineappintg.mepochmisc import get_cache_dir, db_cache_key
+from mepipelineappintg.db_query import bind, query_cursor
+
+#
+#   Columns held in the cache (strings are stored as bytes to keep the cache compact).
+#   Paths are highly redundant (one per exposure) and are stored separately (with an index).
+#
+ImgExtentDtype = [('filename', 'S64'), ('path_idx', 'i4'), ('compression', 'S8'), ('band', 'S8'),
+                  ('expnum', 'i8'), ('ccdnum', 'i4'),
+                  ('racmin', 'f8'), ('racmax', 'f8'), ('deccmin', 'f8'), ('deccmax', 'f8'),
+                  ('rac1', 'f8'), ('rac2', 'f8'), ('rac3', 'f8'), ('rac4', 'f8'),
+                  ('decc1', 'f8'), ('decc2', 'f8'), ('decc3', 'f8'), ('decc4', 'f8')]
+
+
+######################################################################################
+def image_extent_cache_ttl(ttl=None):
+    """ Resolve the age (seconds) for which an image extent cache remains valid """
+    if ttl is None:
+        try:
+            ttl = float(os.environ.get('MEPIPELINEAPPINTG_EXTENT_CACHE_TTL', 86400))
+        except ValueError:
+            ttl = 86400
+    return ttl
+
+
+######################################################################################
+def image_extent_cache_names(ProcTag, ArchiveSite, dbkey, dbSchema='', cachedir=None):
+    """ Form the names of the files holding the image extent cache for a DB/schema/PROCTAG/archive
+
+        Inputs:
+            ProcTag:     Processing Tag used to constrain pool of images
+            ArchiveSite: Archive site that paths are drawn from
+            dbkey:       Key identifying the DB (from mepochmisc.db_cache_key)
+            dbSchema:    Schema over which queries occur.
+            cachedir:    Directory holding the cache (None uses mepochmisc.get_cache_dir)
+
+        Returns:
+            extfile, pathfile, metafile: Names of the files holding the extents, paths and
+                                         a description of the cache (when/what it was built from)
+    """
+    cachedir = get_cache_dir(cachedir)
+    schema = dbSchema.strip('.').lower()
+    if schema == '':
+        schema = 'default'
+    root = os.path.join(cachedir, f"red_immask_extent.{dbkey:s}.{schema:s}.{ProcTag:s}.{ArchiveSite:s}")
+    return f"{root:s}.npy", f"{root:s}.paths.npy", f"{root:s}.json"
+
+
+######################################################################################
+def proctag_state(ProcTag, dbh, dbSchema, verbose=0):
+    """ Cheap summary of a PROCTAG (number of tagged attempts and the largest attempt ID) used to
+        check whether an image extent cache is out of date.
+
+        Inputs:
+            ProcTag:     Processing Tag used to constrain pool of images
+            dbh:         Database connection to be used
+            dbSchema:    Schema over which queries will occur.
+            verbose:     Integer setting level of verbosity when running.
+
+        Returns:
+            State:      Dict with nattempt and max_attempt_id
+    """
+    query = f"""SELECT count(*) as nattempt, max(t.pfw_attempt_id) as max_attempt_id
+        FROM {dbSchema:s}proctag t
+        WHERE t.tag={bind(dbh, 'proctag')}"""
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag}, verbose=verbose)
+    nattempt, max_attempt_id = curDB.fetchone()
+    return {'nattempt': int(nattempt), 'max_attempt_id': None if max_attempt_id is None else int(max_attempt_id)}
+
+
+######################################################################################
+def build_image_extent_cache(ProcTag, ArchiveSite, dbh, dbSchema, cachedir=None, arraysize=100000, verbose=0):
+    """ Query the extents of all RED_IMMASK images in a PROCTAG (one query) and write them
+        to an on-disk cache (when the DB can be identified, see mepochmisc.db_cache_key).
+
+        Inputs:
+            ProcTag:     Processing Tag used to constrain pool of images
+            ArchiveSite: Constraint that data/files exist within a specific archive
+            dbh:         Database connection to be used
+            dbSchema:    Schema over which queries will occur.
+            cachedir:    Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            arraysize:   Number of rows fetched from the DB in each batch.
+            verbose:     Integer setting level of verbosity when running.
+
+        Returns:
+            ImgExt, Paths: Structured array of image extents and array of (unique) paths
+    """
+
+    t0 = time.time()
+    State = proctag_state(ProcTag, dbh, dbSchema, verbose=verbose)
+    query = f"""SELECT
+        fai.filename as filename,
+        fai.path as path,
+        fai.compression as compression,
+        i.band as band,
+        i.expnum as expnum,
+        i.ccdnum as ccdnum,
+        i.racmin as racmin, i.racmax as racmax, i.deccmin as deccmin, i.deccmax as deccmax,
+        i.rac1 as rac1, i.rac2 as rac2, i.rac3 as rac3, i.rac4 as rac4,
+        i.decc1 as decc1, i.decc2 as decc2, i.decc3 as decc3, i.decc4 as decc4
+        FROM {dbSchema:s}image i, {dbSchema:s}file_archive_info fai, {dbSchema:s}proctag t
+        WHERE t.tag={bind(dbh, 'proctag')}
+        and t.pfw_attempt_id=i.pfw_attempt_id
+        and i.filetype='red_immask'
+        and i.filename=fai.filename
+        and fai.archive_name={bind(dbh, 'archive_name')}"""
+
+    if verbose > 0:
+        print("# Executing query to obtain red_immask image extents (for local overlap index)")
+        if verbose == 1:
+            print("# sql = " + " ".join([d.strip() for d in query.split('\n')]))
+        else:
+            print(f"# sql = {query:s}")
+
+    curDB = query_cursor(dbh, query, {'proctag': ProcTag, 'archive_name': ArchiveSite}, verbose=verbose)
+    curDB.arraysize = arraysize
+    desc = [d[0].lower() for d in curDB.description]
+
+    ColType = dict(ImgExtentDtype)
+    ColType['path'] = 'O'
+    RowDtype = [(col, ColType[col]) for col in desc]
+    BatchList = []
+    while True:
+        rows = curDB.fetchmany()
+        if not rows:
+            break
+        #
+        #       NULL compression/band are carried as empty strings (and restored as None when read back).
+        #
+        BatchList.append(np.array([tuple('' if (val is None and RowDtype[ic][1][0] == 'S') else val
+                                         for ic, val in enumerate(row)) for row in rows], dtype=RowDtype))
+    curDB.close()
+    if BatchList:
+        RawExt = np.concatenate(BatchList)
+    else:
+        RawExt = np.zeros(0, dtype=RowDtype)
+
+    Paths, PathIdx = np.unique(RawExt['path'].astype(str), return_inverse=True)
+    ImgExt = np.zeros(RawExt.size, dtype=ImgExtentDtype)
+    for col in ImgExt.dtype.names:
+        if col == 'path_idx':
+            ImgExt[col] = PathIdx
+        else:
+            ImgExt[col] = RawExt[col]
+    t1 = time.time()
+
+    dbkey = db_cache_key(dbh)
+    if dbkey is None:
+        print("# Unable to identify the DB, image extents are not cached")
+        return ImgExt, Paths
+
+    #
+    #   Write to a temporary file then move into place (so a partially written cache is never read).
+    #   The description is written last (a cache without one is not used).
+    #
+    extfile, pathfile, metafile = image_extent_cache_names(ProcTag, ArchiveSite, dbkey, dbSchema, cachedir)
+    Meta = {'built': t0, 'db': dbkey, 'schema': dbSchema, 'proctag': ProcTag, 'archive': ArchiveSite,
+            'nimage': int(ImgExt.size), 'state': State}
+    for fname, arr in [(pathfile, Paths), (extfile, ImgExt), (metafile, Meta)]:
+        tmpfile = f"{fname:s}.tmp{os.getpid():d}"
+        if fname == metafile:
+            with open(tmpfile, 'w') as fout:
+                json.dump(arr, fout, indent=1)
+        else:
+            with open(tmpfile, 'wb') as fout:
+                np.save(fout, arr)
+        os.replace(tmpfile, fname)
+
+    print(f"# Cached extents for {ImgExt.size:d} images ({Paths.size:d} paths) to {extfile:s}")
+    if verbose > 0:
+        print(f"#   Query/fetch time: {t1 - t0:.2f}  Write time: {time.time() - t1:.2f}")
+
+    return ImgExt, Paths
+
+
+######################################################################################
+def load_image_extent_cache(ProcTag, ArchiveSite, dbkey, dbSchema='', cachedir=None, ttl=None, State=None,
+                            mmap=True, verbose=0):
+    """ Read an existing image extent cache (if it is still valid)
+
+        Inputs:
+            ProcTag:     Processing Tag used to constrain pool of images
+            ArchiveSite: Archive site that paths are drawn from
+            dbkey:       Key identifying the DB (from mepochmisc.db_cache_key)
+            dbSchema:    Schema over which queries occur.
+            cachedir:    Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            ttl:         Age (seconds) for which a cache is valid (None uses image_extent_cache_ttl)
+            State:       Current state of the PROCTAG (from proctag_state); when given a cache built
+                            for a different state is not used
+            mmap:        Memory map the extents (rather than reading into memory)
+            verbose:     Integer setting level of verbosity when running.
+
+        Returns:
+            ImgExt, Paths: Structured array of image extents and array of paths (None, None if no valid cache present)
+    """
+    extfile, pathfile, metafile = image_extent_cache_names(ProcTag, ArchiveSite, dbkey, dbSchema, cachedir)
+    if not (os.path.isfile(extfile) and os.path.isfile(pathfile) and os.path.isfile(metafile)):
+        if verbose > 0:
+            print(f"# No image extent cache present at {extfile:s}")
+        return None, None
+
+    with open(metafile, 'r') as fin:
+        Meta = json.load(fin)
+    age = time.time() - Meta['built']
+    if age > image_extent_cache_ttl(ttl):
+        print(f"# Image extent cache {extfile:s} is out of date (built {age / 3600.:.1f} hours ago)")
+        return None, None
+    if State is not None and Meta['state'] != State:
+        print(f"# Image extent cache {extfile:s} is out of date (PROCTAG {ProcTag:s} has changed: "
+              f"{Meta['state']} --> {State})")
+        return None, None
+
+    ImgExt = np.load(extfile, mmap_mode='r' if mmap else None)
+    Paths = np.load(pathfile)
+    if verbose > 0:
+        print(f"# Read image extent cache with {ImgExt.size:d} images from {extfile:s}")
+
+    return ImgExt, Paths
+
+
+######################################################################################
+def make_overlap_index(ImgExt, Paths, verbose=0):
+    """ Form an index over image extents.  Images are sorted separately on their lower and
+        upper declination limits so that candidates for a tile can be found with a binary search
+        (the RA constraint is then applied to the candidates only).
+
+        Inputs:
+            ImgExt:     Structured array of image extents
+            Paths:      Array of paths (referenced by ImgExt['path_idx'])
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            Index:      Dict holding the extents, paths and the sorted declination limits.
+    """
+    t0 = time.time()
+    Index = {'ext': ImgExt, 'paths': Paths}
+    for col in ['deccmin', 'deccmax']:
+        dec = np.asarray(ImgExt[col])
+        order = np.argsort(dec, kind='stable')
+        Index[f'{col:s}_order'] = order
+        Index[f'{col:s}_sorted'] = dec[order]
+    if verbose > 0:
+        print(f"# Formed overlap index for {ImgExt.size:d} images. Execution time: {time.time() - t0:.2f}")
+
+    return Index
+
+
+######################################################################################
+def get_overlap_index(ProcTag, ArchiveSite, dbh, dbSchema, cachedir=None, rebuild=False, ttl=None, verbose=0):
+    """ Obtain an overlap index for a PROCTAG (reading the on-disk cache if present and
+        still valid, otherwise querying and writing the cache).
+
+        Inputs:
+            ProcTag:     Processing Tag used to constrain pool of images
+            ArchiveSite: Constraint that data/files exist within a specific archive
+            dbh:         Database connection to be used (identifies the cache and checks that it is current)
+            dbSchema:    Schema over which queries will occur.
+            cachedir:    Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            rebuild:     Force the cache to be rebuilt.
+            ttl:         Age (seconds) for which a cache is valid (None uses image_extent_cache_ttl)
+            verbose:     Integer setting level of verbosity when running.
+
+        Returns:
+            Index:      Dict holding the extents, paths and the sorted declination limits.
+    """
+    ImgExt = None
+    dbkey = db_cache_key(dbh)
+    if not rebuild and dbkey is not None:
+        State = proctag_state(ProcTag, dbh, dbSchema, verbose=verbose)
+        ImgExt, Paths = load_image_extent_cache(ProcTag, ArchiveSite, dbkey, dbSchema, cachedir,
+                                                ttl=ttl, State=State, verbose=verbose)
+    if ImgExt is None:
+        ImgExt, Paths = build_image_extent_cache(ProcTag, ArchiveSite, dbh, dbSchema, cachedir, verbose=verbose)
+
+    return make_overlap_index(ImgExt, Paths, verbose=verbose)
+
+
+######################################################################################
+def find_tile_overlaps(Index, TileGeom):
+    """ Find images that overlap a COADD tile.  The criterion is the same as used by
+        coadd_query.query_coadd_img_by_edges (i.e. either RA edge and either Dec edge of an
+        image falls within the tile boundaries, with tiles that cross RA=0 handled).
+
+        Inputs:
+            Index:      Overlap index (from make_overlap_index or get_overlap_index)
+            TileGeom:   Dict with tile geometry (racmin, racmax, deccmin, deccmax, crossra0)
+
+        Returns:
+            rows:       Sorted array of (row) indices into Index['ext']
+    """
+    DecLo = TileGeom['deccmin']
+    DecHi = TileGeom['deccmax']
+    CandList = []
+    for col in ['deccmin', 'deccmax']:
+        dec = Index[f'{col:s}_sorted']
+        i0 = np.searchsorted(dec, DecLo, side='left')
+        i1 = np.searchsorted(dec, DecHi, side='right')
+        CandList.append(Index[f'{col:s}_order'][i0:i1])
+    cand = np.union1d(CandList[0], CandList[1])
+
+    racmin = np.asarray(Index['ext']['racmin'][cand])
+    racmax = np.asarray(Index['ext']['racmax'][cand])
+    RaLo = TileGeom['racmin']
+    RaHi = TileGeom['racmax']
+    if TileGeom['crossra0'] == 'Y':
+        keep = ((racmin >= RaLo) & (racmin <= 360.)) | ((racmin >= 0.0) & (racmin <= RaHi)) | \
+               ((racmax >= RaLo) & (racmax <= 360.)) | ((racmax >= 0.0) & (racmax <= RaHi))
+    else:
+        keep = ((racmin >= RaLo) & (racmin <= RaHi)) | ((racmax >= RaLo) & (racmax <= RaHi))
+
+    return cand[keep]
+
+
+######################################################################################
+def query_coadd_img_by_index(ImgDict, TileGeom, BandList, Index, verbose=0):
+    """ Obtain image inputs for COADD from a local overlap index (rather than querying
+        IMAGE for each tile).  Returns the same records as coadd_query.query_coadd_img_by_edges
+        (rac1..rac4, decc1..decc4, etc.) with the addition of the image RA/Dec limits
+        (racmin, racmax, deccmin, deccmax).
+
+        Inputs:
+            ImgDict:   Existing ImgDict, new records are added (and possibly old records updated)
+            TileGeom:  Dict with tile geometry (racmin, racmax, deccmin, deccmax, crossra0)
+            BandList:  List of bands (returned ImgDict list will be restricted to only these bands)
+            Index:     Overlap index (from get_overlap_index)
+            verbose:   Integer setting level of verbosity when running.
+
+        Returns:
+            ImgDict:   Updated version of input ImgDict
+    """
+    t0 = time.time()
+    rows = find_tile_overlaps(Index, TileGeom)
+    ImgExt = Index['ext'][rows]
+    Paths = Index['paths']
+    for rec in ImgExt:
+        rowd = {}
+        for col in ImgExt.dtype.names:
+            if col == 'path_idx':
+                rowd['path'] = str(Paths[rec[col]])
+            elif ImgExt.dtype[col].kind == 'S':
+                val = rec[col].decode()
+                rowd[col] = None if (val == '' and col != 'filename') else val
+            else:
+                rowd[col] = rec[col].item()
+        if rowd['band'] in BandList:
+            ImgDict[rowd['filename']] = rowd
+        else:
+            if verbose > 1:
+                print(f" Post query constraint removed {rowd['band']} band image: {rowd['filename']:s} ")
+    if verbose > 0:
+        print(f"# Overlap index search found {rows.size:d} images. Execution time: {time.time() - t0:.3f}")
+
+    return ImgDict
@@ -0,0 +1,290 @@
+"""
+A local (on-disk) store of a reference catalog (e.g. GAIA_DR2) partitioned by HEALPix
+pixel, so that the objects on (or near) a tile can be obtained without querying the DB.
+
+The catalog is exported once (in declination stripes, so that the whole table is never
+held in memory) into one raw binary file per column.  Within each stripe the rows are
+ordered by (NESTED) HEALPix pixel, and the index records a segment (pixel, first row,
+number of rows, RA/Dec bounds of its objects) for each pixel in each stripe.  A box query
+selects the segments whose bounds overlap the box, reads those rows through memory maps,
+and then applies the same RA/Dec constraints as cat_query.get_cat_radec_range.
+
+Layout of a store (a directory):
+    index.json          table, columns (name, dtype), nside, number of rows
+    segments.npy        structured array describing each segment
+    COLUMN.bin          one raw file per column (native byte order)
+"""
+
+import os
+import json
+import time
+import numpy as np
+
+from mepipelineappintg.cat_query import get_cat_radec_range, select_radec_box
+
+SegmentDtype = [('pixel', 'i8'), ('start', 'i8'), ('count', 'i8'),
+                ('ramin', 'f8'), ('ramax', 'f8'), ('decmin', 'f8'), ('decmax', 'f8')]
+
+#
+#   Stores already opened in this process (keyed by path)
+#
+_OpenStores = {}
+
+
+######################################################################################
+def healpix_nest(nside, ra, dec):
+    """ Compute (NESTED scheme) HEALPix pixel numbers.
+
+        Inputs:
+            nside:      HEALPix resolution parameter (power of 2)
+            ra:         Array of RA (degrees)
+            dec:        Array of Dec (degrees)
+
+        Returns:
+            pix:        Array of pixel numbers
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype='f8'))
+    dec = np.atleast_1d(np.asarray(dec, dtype='f8'))
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(ra, 360.0) / 90.0
+
+    face = np.zeros(ra.size, dtype='i8')
+    ix = np.zeros(ra.size, dtype='i8')
+    iy = np.zeros(ra.size, dtype='i8')
+
+    #
+    #   Equatorial region
+    #
+    eq = za <= 2.0 / 3.0
+    temp1 = nside * (0.5 + tt[eq])
+    temp2 = nside * z[eq] * 0.75
+    jp = (temp1 - temp2).astype('i8')
+    jm = (temp1 + temp2).astype('i8')
+    ifp = jp // nside
+    ifm = jm // nside
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    #
+    #   Polar caps
+    #
+    po = ~eq
+    ntt = np.minimum(3, tt[po].astype('i8'))
+    tp = tt[po] - ntt
+    tmp = nside * np.sqrt(3.0 * (1.0 - za[po]))
+    jp = np.minimum((tp * tmp).astype('i8'), nside - 1)
+    jm = np.minimum(((1.0 - tp) * tmp).astype('i8'), nside - 1)
+    north = z[po] >= 0
+    face[po] = np.where(north, ntt, ntt + 8)
+    ix[po] = np.where(north, nside - jm - 1, jp)
+    iy[po] = np.where(north, nside - jp - 1, jm)
+
+    #
+    #   Interleave the bits of ix (even) and iy (odd) to form the index within a face
+    #
+    ipf = np.zeros(ra.size, dtype='i8')
+    for bit in range(int(np.log2(nside)) + 1):
+        ipf |= ((ix >> bit) & 1) << (2 * bit)
+        ipf |= ((iy >> bit) & 1) << (2 * bit + 1)
+
+    return face * nside * nside + ipf
+
+
+######################################################################################
+def export_refcat(dbh, store, dbSchema='des_admin.', table='GAIA_DR2', cols=['ra', 'dec', 'phot_g_mean_mag'],
+                  nside=32, dec_step=1.0, Timing=False, verbose=0):
+    """ Export a catalog table (must have RA,Dec) into a HEALPix partitioned store.
+
+        Inputs:
+            dbh:        Database connection to be used
+            store:      Directory to hold the store (created, existing contents are replaced)
+            dbSchema:   DB schema (including '.')
+            table:      Catalog Table to export (default='GAIA_DR2')
+            cols:       List of columns to export (must include ra and dec)
+            nside:      HEALPix resolution used to partition (power of 2, default=32)
+            dec_step:   Width (degrees) of the declination stripes queried
+            Timing:     Report execution time
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            Index:      Dict describing the store (as written to index.json)
+    """
+    t0 = time.time()
+    if nside < 1 or (nside & (nside - 1)) != 0:
+        raise ValueError(f"nside must be a power of 2 (given {nside})")
+    lcols = [col.lower() for col in cols]
+    if 'ra' not in lcols or 'dec' not in lcols:
+        raise ValueError("Columns exported to a reference catalog store must include ra and dec")
+
+    os.makedirs(store, exist_ok=True)
+    Columns = None
+    Files = {}
+    Segments = []
+    nrow = 0
+    try:
+        for dec1 in np.arange(-90.0, 90.0, dec_step):
+            dec2 = min(dec1 + dec_step, 90.0)
+            radec_box = {'crossra0': False, 'ra1': 0.0, 'ra2': 360.0, 'dec1': dec1, 'dec2': dec2}
+            CatDict, header = get_cat_radec_range(radec_box, dbh, dbSchema=dbSchema, table=table, cols=cols,
+                                                  verbose=max(verbose - 1, 0))
+            #
+            #   Stripes overlap at their edges (between is inclusive) so keep dec < dec2 (except at the pole)
+            #
+            if dec2 < 90.0:
+                keep = CatDict['DEC'] < dec2
+            else:
+                keep = np.ones(CatDict['DEC'].size, dtype=bool)
+            if not np.any(keep):
+                continue
+
+            if Columns is None:
+                Columns = []
+                for col in header:
+                    if CatDict[col].dtype.kind not in 'biuf':
+                        raise ValueError(f"Column {col} is not numeric (only numeric columns can be stored)")
+                    Columns.append({'name': col, 'dtype': CatDict[col].dtype.str})
+                    Files[col] = open(os.path.join(store, f"{col}.bin"), 'wb')
+
+            pix = healpix_nest(nside, CatDict['RA'][keep], CatDict['DEC'][keep])
+            order = np.argsort(pix, kind='stable')
+            pix = pix[order]
+            for Col in Columns:
+                vals = CatDict[Col['name']][keep][order]
+                if vals.dtype.kind != np.dtype(Col['dtype']).kind:
+                    raise ValueError(f"Column {Col['name']} changed type between stripes ({Col['dtype']} vs {vals.dtype.str})")
+                vals.astype(Col['dtype']).tofile(Files[Col['name']])
+
+            ra = CatDict['RA'][keep][order]
+            dec = CatDict['DEC'][keep][order]
+            upix, ustart, ucount = np.unique(pix, return_index=True, return_counts=True)
+            for p, i0, n in zip(upix.tolist(), ustart.tolist(), ucount.tolist()):
+                Segments.append((p, nrow + i0, n,
+                                 ra[i0:i0 + n].min(), ra[i0:i0 + n].max(), dec[i0:i0 + n].min(), dec[i0:i0 + n].max()))
+            nrow += pix.size
+            if verbose > 0:
+                print(f"# Exported Dec {dec1:7.2f} -- {dec2:7.2f}: {pix.size:d} objects ({nrow:d} total)")
+    finally:
+        for fout in Files.values():
+            fout.close()
+
+    if Columns is None:
+        raise ValueError(f"No objects found in {dbSchema}{table} (nothing exported)")
+
+    np.save(os.path.join(store, 'segments.npy'), np.array(Segments, dtype=SegmentDtype))
+    Index = {'table': f"{dbSchema}{table}", 'columns': Columns, 'nside': nside, 'nrows': nrow}
+    #
+    #   Write the index last (to a temporary file then move into place) so that a partial store is never used
+    #
+    fname = os.path.join(store, 'index.json')
+    tmpfile = f"{fname}.tmp{os.getpid()}"
+    with open(tmpfile, 'w') as fout:
+        json.dump(Index, fout, indent=1)
+    os.replace(tmpfile, fname)
+    _OpenStores.pop(os.path.abspath(store), None)
+
+    if Timing or verbose > 0:
+        print(f"# Exported {nrow:d} objects in {len(Segments):d} segments to {store}. Execution time: {time.time() - t0:.2f}")
+
+    return Index
+
+
+######################################################################################
+def open_refcat(store, verbose=0):
+    """ Open a store (index, segments and memory-mapped columns), once per process.
+
+        Inputs:
+            store:      Directory holding the store
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            Store:      Dict with keys: index, segments, columns (dict of memory-mapped arrays)
+    """
+    skey = os.path.abspath(store)
+    if skey in _OpenStores:
+        return _OpenStores[skey]
+
+    fname = os.path.join(store, 'index.json')
+    if not os.path.isfile(fname):
+        raise ValueError(f"No reference catalog store found at {store} (missing index.json)")
+    with open(fname, 'r') as fin:
+        Index = json.load(fin)
+    Store = {'index': Index,
+             'segments': np.load(os.path.join(store, 'segments.npy')),
+             'columns': {}}
+    for Col in Index['columns']:
+        if Index['nrows'] > 0:
+            Store['columns'][Col['name']] = np.memmap(os.path.join(store, f"{Col['name']}.bin"), dtype=Col['dtype'],
+                                                      mode='r', shape=(Index['nrows'],))
+        else:
+            Store['columns'][Col['name']] = np.zeros(0, dtype=Col['dtype'])
+    if verbose > 0:
+        print(f"# Opened reference catalog store {store} ({Index['table']}: {Index['nrows']:d} objects)")
+    _OpenStores[skey] = Store
+
+    return Store
+
+
+######################################################################################
+def get_refcat_radec_range(radec_box, store, cols=None, Timing=False, verbose=0):
+    """ Pull catalog data in an RA/Dec range from a local store (counterpart of
+        cat_query.get_cat_radec_range, applying the same constraints).
+
+        Inputs:
+            radec_box:  Dict w/ keys: ra1,ra2,dec1,dec2, and crossra0[bool] that describe box to search
+            store:      Directory holding the store
+            cols:       List of columns to return (default is all columns in the store)
+            Timing:     Report execution time
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            CatDict:    Dict of numpy arrays (one for each column)
+            header:     List of columns
+    """
+    t0 = time.time()
+    Store = open_refcat(store, verbose=verbose)
+    if cols is None:
+        header = [Col['name'] for Col in Store['index']['columns']]
+    else:
+        header = [col.upper() for col in cols]
+    for col in header:
+        if col not in Store['columns']:
+            raise ValueError(f"Column {col} is not present in reference catalog store {store}")
+
+    ra1 = float(radec_box['ra1'])
+    ra2 = float(radec_box['ra2'])
+    dec1 = float(radec_box['dec1'])
+    dec2 = float(radec_box['dec2'])
+
+    #
+    #   Segments whose objects could fall in the box
+    #
+    Seg = Store['segments']
+    use = (Seg['decmax'] >= dec1) & (Seg['decmin'] <= dec2)
+    if radec_box['crossra0']:
+        use &= (Seg['ramin'] < ra2) | (Seg['ramax'] > ra1)
+    else:
+        use &= (Seg['ramax'] >= ra1) & (Seg['ramin'] <= ra2)
+    Seg = Seg[use]
+    rows = np.concatenate([np.arange(s, s + n) for s, n in zip(Seg['start'].tolist(), Seg['count'].tolist())]
+                          + [np.zeros(0, dtype='i8')])
+
+    #
+    #   Apply the constraints exactly as in cat_query.get_cat_radec_range
+    #
+    sel = select_radec_box({'RA': Store['columns']['RA'][rows], 'DEC': Store['columns']['DEC'][rows]},
+                           {'crossra0': radec_box['crossra0'], 'ra1': ra1, 'ra2': ra2, 'dec1': dec1, 'dec2': dec2})
+    rows = rows[sel]
+
+    CatDict = {col: np.array(Store['columns'][col][rows]) for col in header}
+
+    if rows.size < 1:
+        print(f"# No values returned from reference catalog store {store}")
+    if verbose > 0:
+        print(f"# Number of objects found in {Store['index']['table']} (store: {store}) is {rows.size:d} "
+              f"(from {Seg.size:d} segments)")
+    if Timing:
+        print(f" Store lookup time: {time.time() - t0:.2f}")
+
+    return CatDict, header
@@ -0,0 +1,159 @@
+"""
+A local stand-in for despydb.desdbi.DesDbi backed by SQLite, so that the query modules
+(coadd_query, meds_query, cat_query, mepochmisc, metadetect_pizza_cutter_tools, ...) can be
+run, profiled and benchmarked offline (e.g. against a database made by synthetic_des).
+
+It provides the parts of the DesDbi interface used in this package: cursor(), insert_many(),
+get_named_bind_string(), commit(), rollback() and close(), along with the (session private)
+GTT_FILENAME, GTT_ID and GTT_STR tables.  Schema qualified names (e.g. des_admin.image) refer
+to the tables of the (single) SQLite database: the schema names are removed from the SQL text.
+The few Oracle constructs used by the queries (LISTAGG ... WITHIN GROUP, NVL, DUAL) are
+translated or emulated.
+"""
+
+import re
+import sqlite3
+import itertools
+
+#
+#   Schemas recognized by default (so that e.g. des_admin.image resolves to image)
+#
+DefaultSchemas = ['des_admin', 'prod', 'dessci']
+
+#
+#   Global temporary tables (created per connection, as with a session in Oracle)
+#
+GTTables = {'gtt_filename': 'filename text', 'gtt_id': 'id integer', 'gtt_str': 'str text'}
+
+_ListAgg = re.compile(r"listagg\s*\((.+?),\s*('[^']*')\s*\)\s*within\s+group\s*\(\s*order\s+by[^)]*\)",
+                      re.IGNORECASE | re.DOTALL)
+_MemoryDB = itertools.count()
+
+
+######################################################################################
+def translate_sql(query, schemas=None):
+    """ Translate the Oracle specific constructs used by the package queries to SQLite
+
+        Inputs:
+            query:      SQL text (Oracle dialect)
+            schemas:    Schema names to remove from schema qualified table names
+
+        Returns:
+            query:      SQL text (SQLite dialect)
+    """
+    if schemas:
+        query = re.sub(r"\b(" + "|".join(schemas) + r")\.(?=[a-z_])", "", query, flags=re.IGNORECASE)
+    # LISTAGG(x, sep) WITHIN GROUP (ORDER BY ...) --> GROUP_CONCAT(x, sep) (order not guaranteed)
+    return _ListAgg.sub(r"group_concat(\1, \2)", query)
+
+
+######################################################################################
+class SqliteCursor:
+    """ Cursor (DB-API like that of cx_Oracle) over a SQLite connection.  Column names in
+        the description are upper case (as returned by Oracle).
+    """
+
+    def __init__(self, conn, schemas=None):
+        self._cur = conn.cursor()
+        self._schemas = schemas
+        self.arraysize = 100
+
+    def prepare(self, query):
+        """ Nothing to do (SQLite caches compiled statements itself) """
+
+    def execute(self, query, params=None):
+        if params is None:
+            params = {}
+        self._cur.execute(translate_sql(query, self._schemas), params)
+        return self
+
+    def executemany(self, query, rows):
+        self._cur.executemany(translate_sql(query, self._schemas), rows)
+        return self
+
+    @property
+    def description(self):
+        if self._cur.description is None:
+            return None
+        return [(d[0].upper(),) + tuple(d[1:]) for d in self._cur.description]
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, numRows=None):
+        return self._cur.fetchmany(self.arraysize if numRows is None else numRows)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def close(self):
+        self._cur.close()
+
+
+######################################################################################
+class SqliteDbi:
+    """ Stand-in for despydb.desdbi.DesDbi using a SQLite database
+
+        Inputs:
+            dbfile:     SQLite database file (None gives a new, empty, in-memory database)
+            schemas:    Schema names (removed from schema qualified table names)
+            verbose:    Integer setting level of verbosity when running.
+    """
+
+    def __init__(self, dbfile=None, schemas=None, verbose=0):
+        if dbfile is None:
+            self.dbfile = f"file:mepipelineappintg_{next(_MemoryDB):d}?mode=memory&cache=shared"
+        else:
+            self.dbfile = f"file:{dbfile:s}"
+        self.verbose = verbose
+        self.con = sqlite3.connect(self.dbfile, uri=True, check_same_thread=False)
+        self.con.create_function('nvl', 2, lambda val, default: default if val is None else val)
+
+        self.schemas = []
+        for schema in (DefaultSchemas if schemas is None else schemas):
+            self.add_schema(schema)
+
+        for table, cols in GTTables.items():
+            self.con.execute(f"create temp table if not exists {table:s} ({cols:s})")
+        self.con.execute("create temp view if not exists dual as select 'X' as dummy")
+        if verbose > 0:
+            print(f"# Connected to SQLite database {self.dbfile:s} (schemas: {','.join(self.schemas):s})")
+
+    def add_schema(self, schema):
+        """ Make schema qualified names (schema.table) refer to the tables of this database """
+        schema = schema.strip().rstrip('.').lower()
+        if schema and schema not in self.schemas:
+            self.schemas.append(re.escape(schema))
+
+    def cursor(self):
+        return SqliteCursor(self.con, self.schemas)
+
+    def get_named_bind_string(self, name):
+        return f":{name:s}"
+
+    def insert_many(self, table, columns, rows):
+        """ Insert rows (each a sequence in the order of columns, or a dict keyed by column) """
+        rows = list(rows)
+        if len(rows) < 1:
+            return
+        if isinstance(rows[0], dict):
+            rows = [[row[col] for col in columns] for row in rows]
+        table = translate_sql(table, self.schemas)
+        query = f"insert into {table:s} ({','.join(columns):s}) values ({','.join(['?'] * len(columns)):s})"
+        self.con.executemany(query, rows)
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,130 @@
+"""
+A small scheduler that runs independent query stages concurrently.  Stages (and the
+stages they depend on) are declared as a dictionary; stages whose dependencies are
+complete are run in a pool of threads, each stage using a DB connection taken from a
+pool of connections (so that each has its own session and therefore its own GTT tables).
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+######################################################################################
+def stage_order(Stages):
+    """ Check a stage graph and return the stage names in a valid (topological) order
+
+        Inputs:
+            Stages:     Dict of stages (keyed by name), each a dict with keys:
+                            func: callable(dbh, Results) returning the stage result
+                            deps: list of stage names that must complete first (optional)
+
+        Returns:
+            Order:      List of stage names
+    """
+    Order = []
+    Done = set()
+    Remaining = list(Stages)
+    while Remaining:
+        Ready = [name for name in Remaining if set(Stages[name].get('deps', [])) <= Done]
+        if not Ready:
+            for name in Remaining:
+                for dep in Stages[name].get('deps', []):
+                    if dep not in Stages:
+                        raise ValueError(f"Stage {name:s} depends on unknown stage {dep:s}")
+            raise ValueError(f"Stage dependencies contain a cycle among: {','.join(Remaining):s}")
+        for name in Ready:
+            Order.append(name)
+            Done.add(name)
+            Remaining.remove(name)
+
+    return Order
+
+
+######################################################################################
+def run_stages(Stages, dbh, connect=None, nconn=1, verbose=0):
+    """ Run a set of stages (respecting their dependencies), concurrently when more than
+        one connection is allowed.
+
+        Inputs:
+            Stages:     Dict of stages (keyed by name), each a dict with keys:
+                            func: callable(dbh, Results) returning the stage result
+                            deps: list of stage names that must complete first (optional)
+            dbh:        Existing database connection (used by the first stage(s) to run)
+            connect:    Callable returning a new database connection (needed when nconn > 1)
+            nconn:      Maximum number of connections (and therefore stages) in use at once
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            Results:    Dict (keyed by stage name) of results from each stage
+            Timing:     Dict (keyed by stage name) of execution time for each stage
+    """
+    Order = stage_order(Stages)
+    Results = {}
+    Timing = {}
+
+    if nconn <= 1 or connect is None or len(Stages) < 2:
+        for name in Order:
+            t0 = time.time()
+            Results[name] = Stages[name]['func'](dbh, Results)
+            Timing[name] = time.time() - t0
+            if verbose > 0:
+                print(f"# Stage {name:s} completed. Execution time: {Timing[name]:.2f}")
+        return Results, Timing
+
+    #
+    #   Pool of connections (grown on demand up to nconn, the existing connection is re-used)
+    #
+    ConnPool = queue.Queue()
+    ConnPool.put(dbh)
+    NewConn = []
+    PoolLock = threading.Lock()
+
+    def acquire():
+        try:
+            return ConnPool.get_nowait()
+        except queue.Empty:
+            pass
+        with PoolLock:
+            if len(NewConn) + 1 < nconn:
+                conn = connect()
+                NewConn.append(conn)
+                if verbose > 1:
+                    print(f"# Opened DB connection {len(NewConn) + 1:d} of (at most) {nconn:d}")
+                return conn
+        return ConnPool.get()
+
+    def run_one(name):
+        conn = acquire()
+        try:
+            t0 = time.time()
+            result = Stages[name]['func'](conn, Results)
+            return result, time.time() - t0
+        finally:
+            ConnPool.put(conn)
+
+    t00 = time.time()
+    Submitted = set()
+    Running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=nconn) as executor:
+            while len(Results) < len(Stages):
+                for name in Order:
+                    if name not in Submitted and set(Stages[name].get('deps', [])) <= set(Results):
+                        Running[executor.submit(run_one, name)] = name
+                        Submitted.add(name)
+                Finished, _ = wait(list(Running), return_when=FIRST_COMPLETED)
+                for future in Finished:
+                    name = Running.pop(future)
+                    Results[name], Timing[name] = future.result()
+                    if verbose > 0:
+                        print(f"# Stage {name:s} completed. Execution time: {Timing[name]:.2f}")
+    finally:
+        for conn in NewConn:
+            conn.close()
+
+    if verbose > 0:
+        print(f"# Ran {len(Stages):d} stages using up to {nconn:d} connections. Execution time: {time.time() - t00:.2f}")
+
+    return Results, Timing
@@ -0,0 +1,348 @@
+"""
+Generate a synthetic DES-like database (for use through sqlite_dbi.SqliteDbi) so that the
+query paths of this package can be exercised, profiled and scaled without access to the
+DESDM Oracle database.
+
+A block of coadd tiles (ntile_ra x ntile_dec) is covered by exposures (nexp per band), each
+made of nccd CCD images laid out in a grid around the pointing.  For every exposure the
+single-epoch products (red_immask, red_bkg, red_segmap, psfex_model, piff_model,
+cat_finalcut, cat_trailbox), zeropoints, bleed trails and PIFF QA are made, and for every
+tile the multi-epoch products (coadd_nwgint, coadd_head_scamp, coadd, coadd_segmap,
+coadd_psfex_model, coadd_cat) along with their provenance (OPM_WAS_DERIVED_FROM).  GAIA_DR2
+is filled with random stars over the area.  Tables follow the DESDM names and carry the
+columns used by the queries in this package (plus the usual indices).
+"""
+
+import time
+import numpy as np
+
+#
+#   Table definitions (name: list of "column type")
+#
+SyntheticTables = {
+    'ops_archive': ['name text', 'root text'],
+    'proctag': ['tag text', 'pfw_attempt_id integer', 'created_date text'],
+    'pfw_attempt': ['id integer', 'reqnum integer', 'unitname text', 'attnum integer'],
+    'pfw_attempt_val': ['pfw_attempt_id integer', 'key text', 'val text'],
+    'desfile': ['id integer', 'filename text', 'filetype text', 'pfw_attempt_id integer', 'compression text',
+                'wgb_task_id integer'],
+    'file_archive_info': ['filename text', 'path text', 'compression text', 'archive_name text',
+                          'desfile_id integer'],
+    'opm_was_derived_from': ['parent_desfile_id integer', 'child_desfile_id integer'],
+    'image': ['filename text', 'filetype text', 'pfw_attempt_id integer', 'band text', 'expnum integer',
+              'ccdnum integer', 'nite text', 'tilename text', 'mag_zero real', 'exptime real',
+              'ra_cent real', 'dec_cent real', 'rac1 real', 'rac2 real', 'rac3 real', 'rac4 real',
+              'decc1 real', 'decc2 real', 'decc3 real', 'decc4 real', 'racmin real', 'racmax real',
+              'deccmin real', 'deccmax real', 'crossra0 text'],
+    'coadd': ['filename text', 'filetype text', 'pfw_attempt_id integer', 'band text', 'tilename text'],
+    'miscfile': ['filename text', 'filetype text', 'pfw_attempt_id integer', 'band text', 'expnum integer',
+                 'ccdnum integer', 'tilename text'],
+    'catalog': ['filename text', 'filetype text', 'pfw_attempt_id integer', 'band text', 'expnum integer',
+                'ccdnum integer', 'tilename text', 'objects integer'],
+    'zeropoint': ['imagename text', 'mag_zero real', 'sigma_mag_zero real', 'source text', 'version text',
+                  'flag integer', 'expnum integer', 'ccdnum integer', 'band text'],
+    'blacklist': ['expnum integer', 'ccdnum integer', 'reason text'],
+    'bleedtrail': ['filename text', 'ra_1 real', 'ra_2 real', 'ra_3 real', 'ra_4 real',
+                   'dec_1 real', 'dec_2 real', 'dec_3 real', 'dec_4 real'],
+    'piff_hsm_model_qa': ['filename text', 'expnum integer', 'ccdnum integer', 'band text', 'flag integer',
+                          'nstar integer', 'fwhm_cen real', 'star_t_mean real', 'star_t_std real',
+                          'exp_star_t_mean real', 'exp_star_t_std real'],
+    'coaddtile_geom': ['id integer', 'tilename text', 'ra_cent real', 'dec_cent real',
+                       'rac1 real', 'rac2 real', 'rac3 real', 'rac4 real',
+                       'decc1 real', 'decc2 real', 'decc3 real', 'decc4 real', 'crossra0 text',
+                       'racmin real', 'racmax real', 'deccmin real', 'deccmax real',
+                       'uramin real', 'uramax real', 'udecmin real', 'udecmax real',
+                       'ra_size real', 'dec_size real', 'pixelscale real', 'naxis1 integer', 'naxis2 integer'],
+    'fiat_tile_input': ['filename text', 'tilename text'],
+    'gaia_dr2': ['source_id integer', 'ra real', 'dec real', 'phot_g_mean_mag real', 'phot_bp_mean_mag real',
+                 'phot_rp_mean_mag real'],
+}
+
+SyntheticIndices = {
+    'proctag': ['tag', 'pfw_attempt_id'],
+    'pfw_attempt_val': ['pfw_attempt_id'],
+    'desfile': ['id', 'filename', 'pfw_attempt_id'],
+    'file_archive_info': ['filename', 'desfile_id'],
+    'opm_was_derived_from': ['parent_desfile_id', 'child_desfile_id'],
+    'image': ['filename', 'pfw_attempt_id', 'expnum', 'racmin', 'racmax'],
+    'coadd': ['pfw_attempt_id'],
+    'miscfile': ['filename', 'pfw_attempt_id', 'expnum'],
+    'catalog': ['filename', 'pfw_attempt_id', 'expnum'],
+    'zeropoint': ['imagename', 'expnum'],
+    'bleedtrail': ['filename'],
+    'piff_hsm_model_qa': ['filename', 'expnum'],
+    'coaddtile_geom': ['tilename'],
+    'fiat_tile_input': ['tilename'],
+    'gaia_dr2': ['dec', 'ra'],
+}
+
+TileSize = 0.7306
+PixelScale = 0.263
+BandList = ['g', 'r', 'i', 'z', 'Y']
+
+
+######################################################################################
+def tilename_from_center(ra, dec):
+    """ Form a DES style tilename (e.g. DES0219-0416) from a tile center """
+    rah = ra / 15.0
+    hh = int(rah)
+    mm = int(round((rah - hh) * 60.0))
+    if mm == 60:
+        hh, mm = hh + 1, 0
+    sign = '-' if dec < 0 else '+'
+    adec = abs(dec)
+    dd = int(adec)
+    dm = int(round((adec - dd) * 60.0))
+    if dm == 60:
+        dd, dm = dd + 1, 0
+    return f"DES{hh % 24:02d}{mm:02d}{sign:s}{dd:02d}{dm:02d}"
+
+
+######################################################################################
+def box_corners(ra, dec, dra, ddec):
+    """ Corners, bounds and crossra0 flag for a box (sizes in degrees on the sky) """
+    hra = 0.5 * dra / np.cos(np.radians(dec))
+    rac = [(ra - hra) % 360.0, (ra + hra) % 360.0, (ra + hra) % 360.0, (ra - hra) % 360.0]
+    decc = [dec - 0.5 * ddec, dec - 0.5 * ddec, dec + 0.5 * ddec, dec + 0.5 * ddec]
+    if max(rac) - min(rac) > 180.0:
+        crossra0 = 'Y'
+        racmin = min([r for r in rac if r > 180.0])
+        racmax = max([r for r in rac if r < 180.0])
+    else:
+        crossra0 = 'N'
+        racmin = min(rac)
+        racmax = max(rac)
+    return rac, decc, racmin, racmax, min(decc), max(decc), crossra0
+
+
+######################################################################################
+def create_synthetic_tables(dbh, release_prefixes=None, verbose=0):
+    """ Create (empty) synthetic DES tables and their indices.
+
+        Inputs:
+            dbh:                Database connection (SqliteDbi)
+            release_prefixes:   List of prefixes (e.g. ['Y6A1_']) for which views are made
+                                    (e.g. Y6A1_COADDTILE_GEOM), as in release schemas
+            verbose:            Integer setting level of verbosity when running.
+    """
+    curDB = dbh.cursor()
+    for table, cols in SyntheticTables.items():
+        curDB.execute(f"create table if not exists {table:s} ({', '.join(cols):s})")
+        for col in SyntheticIndices.get(table, []):
+            curDB.execute(f"create index if not exists {table:s}_{col:s}_idx on {table:s} ({col:s})")
+        for prefix in (release_prefixes or []):
+            curDB.execute(f"create view if not exists {prefix:s}{table:s} as select * from {table:s}")
+    curDB.close()
+    dbh.commit()
+    if verbose > 0:
+        print(f"# Created {len(SyntheticTables):d} synthetic tables")
+
+
+######################################################################################
+def make_synthetic_des(dbh, ntile_ra=2, ntile_dec=2, nexp=10, nccd=62, bands=None, ra0=30.0, dec0=-30.0,
+                       gaia_density=2000.0, ntrail=0.3, zpt_missing=0.02, nblacklist=5,
+                       se_tag='Y6A1_FINALCUT', me_tag='Y6A1_COADD', piff_tag='Y6A1_PIFF',
+                       zpt_source='FGCM', zpt_version='v2.0', archive_name='desar2home',
+                       release_prefixes=None, seed=1, verbose=0):
+    """ Populate a database with a synthetic DES-like data set.
+
+        Inputs:
+            dbh:            Database connection (SqliteDbi)
+            ntile_ra:       Number of tiles (along RA) in the block of tiles
+            ntile_dec:      Number of tiles (along Dec) in the block of tiles
+            nexp:           Number of exposures (per band) over the block of tiles
+            nccd:           Number of CCDs per exposure
+            bands:          List of bands (default g,r,i,z,Y)
+            ra0, dec0:      Center of the first tile (degrees)
+            gaia_density:   GAIA_DR2 stars per square degree
+            ntrail:         Mean number of bleed trails per CCD
+            zpt_missing:    Fraction of CCD images without a zeropoint
+            nblacklist:     Number of CCD images entered in the blacklist
+            se_tag:         Proctag for single-epoch processing
+            me_tag:         Proctag for multi-epoch (coadd) processing
+            piff_tag:       Proctag for PIFF models
+            zpt_source:     Zeropoint SOURCE
+            zpt_version:    Zeropoint VERSION
+            archive_name:   Archive holding the files
+            release_prefixes: List of table prefixes also made available (as views)
+            seed:           Random seed
+            verbose:        Integer setting level of verbosity when running.
+
+        Returns:
+            Summary:        Dict with the tilenames and the number of rows written to each table
+    """
+    t0 = time.time()
+    if bands is None:
+        bands = BandList
+    rng = np.random.default_rng(seed)
+    create_synthetic_tables(dbh, release_prefixes=release_prefixes, verbose=verbose)
+
+    Rows = {table: [] for table in SyntheticTables}
+    Rows['ops_archive'].append((archive_name, '/archive_data/desarchive'))
+    counter = {'attempt': 1000, 'desfile': 0, 'reqnum': 100}
+
+    def new_attempt(tag, unitname):
+        counter['attempt'] += 1
+        counter['reqnum'] += 1
+        Rows['pfw_attempt'].append((counter['attempt'], counter['reqnum'], unitname, 1))
+        if tag is not None:
+            Rows['proctag'].append((tag, counter['attempt'], '2020-01-01'))
+        return counter['attempt']
+
+    def new_file(filename, filetype, attid, path, compression='.fz'):
+        counter['desfile'] += 1
+        Rows['desfile'].append((counter['desfile'], filename, filetype, attid, compression, counter['desfile']))
+        Rows['file_archive_info'].append((filename, path, compression, archive_name, counter['desfile']))
+        return counter['desfile']
+
+    #
+    #   Tiles
+    #
+    Tiles = []
+    for jdec in range(ntile_dec):
+        dec = dec0 + jdec * TileSize
+        for ira in range(ntile_ra):
+            ra = (ra0 + ira * TileSize / np.cos(np.radians(dec))) % 360.0
+            tilename = tilename_from_center(ra, dec)
+            rac, decc, racmin, racmax, deccmin, deccmax, crossra0 = box_corners(ra, dec, TileSize, TileSize)
+            urac, udecc, uramin, uramax, udecmin, udecmax, _ = box_corners(ra, dec, TileSize - 0.0306, TileSize - 0.0306)
+            Rows['coaddtile_geom'].append((len(Tiles) + 1, tilename, ra, dec, *rac, *decc, crossra0,
+                                           racmin, racmax, deccmin, deccmax, uramin, uramax, udecmin, udecmax,
+                                           TileSize / np.cos(np.radians(dec)), TileSize, PixelScale, 10000, 10000))
+            Tiles.append({'tilename': tilename, 'ra': ra, 'dec': dec, 'dra': TileSize / np.cos(np.radians(dec)),
+                          'inputs': []})
+
+    #
+    #   Exposures (and their CCDs) scattered over the block of tiles
+    #
+    ccd_dra = 0.15
+    ccd_ddec = 0.30
+    ncol = int(np.ceil(np.sqrt(2.0 * nccd)))
+    nrow = int(np.ceil(nccd / ncol))
+    dec_lo = dec0 - 0.5 * TileSize
+    dec_hi = dec0 + (ntile_dec - 0.5) * TileSize
+    ra_span = ntile_ra * TileSize / np.cos(np.radians(dec0))
+    expnum = 200000
+    Exposures = []
+    for band in bands:
+        for _ in range(nexp):
+            expnum += 1
+            pra = (ra0 - 0.5 * TileSize + rng.uniform(0.0, ra_span)) % 360.0
+            pdec = rng.uniform(dec_lo, dec_hi)
+            Exposures.append((expnum, band, pra, pdec))
+
+    SEimages = []
+    for expnum, band, pra, pdec in Exposures:
+        nite = f"2019{1 + expnum % 12:02d}{1 + expnum % 28:02d}"
+        attid = new_attempt(se_tag, f"D{expnum:08d}")
+        piffid = new_attempt(piff_tag, f"D{expnum:08d}")
+        base = f"D{expnum:08d}_{band:s}"
+        sepath = f"OPS/finalcut/Y6A1/r{counter['reqnum']:d}/{nite:s}/D{expnum:08d}/p01"
+        seeing = rng.uniform(0.8, 1.4)
+        for ccd in range(1, nccd + 1):
+            irow, icol = divmod(ccd - 1, ncol)
+            cdec = pdec + (irow - 0.5 * (nrow - 1)) * ccd_ddec
+            cra = (pra + (icol - 0.5 * (ncol - 1)) * ccd_dra / np.cos(np.radians(cdec))) % 360.0
+            rac, decc, racmin, racmax, deccmin, deccmax, crossra0 = box_corners(cra, cdec, ccd_dra, ccd_ddec)
+            fname = f"{base:s}_c{ccd:02d}_r{counter['reqnum']:d}p01_immasked.fits"
+            did = new_file(fname, 'red_immask', attid, f"{sepath:s}/red/immask")
+            Rows['image'].append((fname, 'red_immask', attid, band, expnum, ccd, nite, None, None, 90.0,
+                                  cra, cdec, *rac, *decc, racmin, racmax, deccmin, deccmax, crossra0))
+            bkg = f"{base:s}_c{ccd:02d}_r{counter['reqnum']:d}p01_bkg.fits"
+            new_file(bkg, 'red_bkg', attid, f"{sepath:s}/red/bkg")
+            Rows['image'].append((bkg, 'red_bkg', attid, band, expnum, ccd, nite, None, None, 90.0,
+                                  cra, cdec, *rac, *decc, racmin, racmax, deccmin, deccmax, crossra0))
+            for ftype, suffix, sub in [('red_segmap', 'segmap.fits', 'seg'), ('psfex_model', 'psfexcat.psf', 'psf')]:
+                misc = f"{base:s}_c{ccd:02d}_r{counter['reqnum']:d}p01_{suffix:s}"
+                new_file(misc, ftype, attid, f"{sepath:s}/{sub:s}", compression=None)
+                Rows['miscfile'].append((misc, ftype, attid, band, expnum, ccd, None))
+            piff = f"{base:s}_c{ccd:02d}_r{counter['reqnum']:d}p01_piff-model.fits"
+            pid = new_file(piff, 'piff_model', piffid, f"{sepath:s}/piff", compression=None)
+            Rows['opm_was_derived_from'].append((did, pid))
+            Rows['miscfile'].append((piff, 'piff_model', piffid, band, expnum, ccd, None))
+            Rows['piff_hsm_model_qa'].append((piff, expnum, ccd, band, 0, int(rng.integers(20, 200)),
+                                              seeing * rng.uniform(0.95, 1.05), 0.5, 0.01, 0.5, 0.02))
+            for ftype, suffix in [('cat_finalcut', 'red-fullcat.fits'), ('cat_trailbox', 'trailbox.fits')]:
+                cat = f"{base:s}_c{ccd:02d}_r{counter['reqnum']:d}p01_{suffix:s}"
+                new_file(cat, ftype, attid, f"{sepath:s}/cat", compression=None)
+                Rows['catalog'].append((cat, ftype, attid, band, expnum, ccd, None, int(rng.integers(500, 5000))))
+                if ftype == 'cat_trailbox':
+                    for _ in range(rng.poisson(ntrail)):
+                        tra = cra + rng.uniform(-0.4, 0.4) * ccd_dra
+                        tdec = cdec + rng.uniform(-0.4, 0.4) * ccd_ddec
+                        Rows['bleedtrail'].append((cat, tra - 0.001, tra + 0.001, tra + 0.001, tra - 0.001,
+                                                   tdec - 0.01, tdec - 0.01, tdec + 0.01, tdec + 0.01))
+            mag_zero = 30.0 + rng.normal(0.0, 0.1)
+            if rng.uniform() >= zpt_missing:
+                Rows['zeropoint'].append((fname, mag_zero, 0.005, zpt_source, zpt_version, 0, expnum, ccd, band))
+            SEimages.append((fname, did, band, expnum, ccd, mag_zero, cra, cdec, racmin, racmax, deccmin, deccmax,
+                             crossra0))
+
+    for k in rng.choice(len(SEimages), size=min(nblacklist, len(SEimages)), replace=False):
+        Rows['blacklist'].append((SEimages[k][3], SEimages[k][4], 'synthetic'))
+
+    #
+    #   Coadd tiles: inputs (those CCDs that overlap), provenance and coadd products
+    #
+    for Tile in Tiles:
+        attid = new_attempt(me_tag, Tile['tilename'])
+        reqnum = counter['reqnum']
+        Rows['pfw_attempt_val'].append((attid, 'tilename', Tile['tilename']))
+        Rows['pfw_attempt_val'].append((attid, 'reqnum', str(reqnum)))
+        mepath = f"OPS/multiepoch/Y6A1/r{reqnum:d}/{Tile['tilename']:s}/p01"
+        for fname, did, band, expnum, ccd, mag_zero, cra, cdec, racmin, racmax, deccmin, deccmax, crossra0 in SEimages:
+            dra = (cra - Tile['ra'] + 180.0) % 360.0 - 180.0
+            if abs(dra) > 0.5 * (Tile['dra'] + ccd_dra / np.cos(np.radians(cdec))):
+                continue
+            if abs(cdec - Tile['dec']) > 0.5 * (TileSize + ccd_ddec):
+                continue
+            Rows['fiat_tile_input'].append((fname, Tile['tilename']))
+            nwg = f"{Tile['tilename']:s}_r{reqnum:d}p01_D{expnum:08d}_{band:s}_c{ccd:02d}_nwgint.fits"
+            nid = new_file(nwg, 'coadd_nwgint', attid, f"{mepath:s}/nwgint")
+            Rows['image'].append((nwg, 'coadd_nwgint', attid, band, expnum, ccd, None, Tile['tilename'], mag_zero, 90.0,
+                                  cra, cdec, None, None, None, None, None, None, None, None,
+                                  racmin, racmax, deccmin, deccmax, crossra0))
+            Rows['opm_was_derived_from'].append((did, nid))
+            head = f"{Tile['tilename']:s}_r{reqnum:d}p01_D{expnum:08d}_{band:s}_c{ccd:02d}_scamp.ohead"
+            new_file(head, 'coadd_head_scamp', attid, f"{mepath:s}/aux", compression=None)
+            Rows['miscfile'].append((head, 'coadd_head_scamp', attid, band, expnum, ccd, Tile['tilename']))
+            Tile['inputs'].append(fname)
+        for band in bands:
+            base = f"{Tile['tilename']:s}_r{reqnum:d}p01_{band:s}"
+            new_file(f"{base:s}.fits", 'coadd', attid, f"{mepath:s}/coadd")
+            Rows['coadd'].append((f"{base:s}.fits", 'coadd', attid, band, Tile['tilename']))
+            for ftype, suffix in [('coadd_segmap', 'segmap.fits'), ('coadd_psfex_model', 'psfcat.psf')]:
+                new_file(f"{base:s}_{suffix:s}", ftype, attid, f"{mepath:s}/aux", compression=None)
+                Rows['miscfile'].append((f"{base:s}_{suffix:s}", ftype, attid, band, None, None, Tile['tilename']))
+            new_file(f"{base:s}_cat.fits", 'coadd_cat', attid, f"{mepath:s}/cat", compression=None)
+            Rows['catalog'].append((f"{base:s}_cat.fits", 'coadd_cat', attid, band, None, None, Tile['tilename'],
+                                    int(rng.integers(50000, 150000))))
+
+    #
+    #   GAIA stars over the whole area (with a margin)
+    #
+    area = (ra_span + 2.0) * (dec_hi - dec_lo + 2.0) * np.cos(np.radians(dec0))
+    nstar = int(rng.poisson(gaia_density * area))
+    gra = (ra0 - 0.5 * TileSize - 1.0 / np.cos(np.radians(dec0)) + rng.uniform(0.0, ra_span + 2.0 / np.cos(np.radians(dec0)), nstar)) % 360.0
+    gdec = rng.uniform(dec_lo - 1.0, dec_hi + 1.0, nstar)
+    gmag = rng.uniform(12.0, 21.0, nstar)
+    Rows['gaia_dr2'] = list(zip(range(1, nstar + 1), gra.tolist(), gdec.tolist(), gmag.tolist(),
+                                (gmag + 0.4).tolist(), (gmag - 0.5).tolist()))
+
+    #
+    #   Write
+    #
+    Summary = {'tilenames': [Tile['tilename'] for Tile in Tiles], 'nrows': {}}
+    for table, rows in Rows.items():
+        if len(rows) > 0:
+            cols = [col.split()[0] for col in SyntheticTables[table]]
+            dbh.insert_many(table, cols, rows)
+        Summary['nrows'][table] = len(rows)
+    dbh.commit()
+    if verbose > 0:
+        for table, nrows in Summary['nrows'].items():
+            print(f"#   {table:24s} {nrows:10d}")
+        print(f"# Generated synthetic DES data for {len(Tiles):d} tiles, {len(Exposures):d} exposures "
+              f"({len(SEimages):d} CCD images). Execution time: {time.time() - t0:.2f}")
+
+    return Summary
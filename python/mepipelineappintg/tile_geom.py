@@ -0,0 +1,252 @@
+"""
+A persistent (on-disk, memory-mappable) snapshot of a COADDTILE_GEOM table.  The whole
+table (~10k rows) is queried once and kept as a structured array sorted by tilename, so that
+the geometry for one or many tiles can be looked up without a query.  Snapshots are keyed by
+the DB (section/service, see mepochmisc.db_cache_key) and the (schema qualified) table name,
+and lookups that miss fall back to the DB in the callers.
+
+Use of the snapshot is opt-in: it is only used when $MEPIPELINEAPPINTG_TILE_CACHE=1.  It is
+written in the directory given by mepochmisc.get_cache_dir and is rebuilt once older than
+$MEPIPELINEAPPINTG_TILE_CACHE_TTL seconds (default 1 day).
+"""
+
+import os
+import time
+import numpy as np
+
+from mepipelineappintg.mepochmisc import get_cache_dir, db_cache_key
+
+#
+#   Columns (and types) retained in the snapshot (any not present in a given table are skipped).
+#
+TileGeomDtype = [('tilename', 'U16'), ('id', 'i8'),
+                 ('ra_cent', 'f8'), ('dec_cent', 'f8'),
+                 ('rac1', 'f8'), ('rac2', 'f8'), ('rac3', 'f8'), ('rac4', 'f8'),
+                 ('decc1', 'f8'), ('decc2', 'f8'), ('decc3', 'f8'), ('decc4', 'f8'),
+                 ('crossra0', 'U1'),
+                 ('racmin', 'f8'), ('racmax', 'f8'), ('deccmin', 'f8'), ('deccmax', 'f8'),
+                 ('uramin', 'f8'), ('uramax', 'f8'), ('udecmin', 'f8'), ('udecmax', 'f8'),
+                 ('ra_size', 'f8'), ('dec_size', 'f8'),
+                 ('pixelscale', 'f8'), ('naxis1', 'i8'), ('naxis2', 'i8')]
+
+#
+#   Suffix of the (boolean) fields that flag NULL values of a column in the snapshot.
+#
+NullSuffix = '__null'
+
+#
+#   Snapshots already read in this process (keyed by DB and table).
+#
+_TileGeomSnapshots = {}
+
+
+######################################################################################
+def tile_geom_cache_enabled():
+    """ Check whether use of the tile geometry snapshot has been enabled by the environment """
+    return os.environ.get('MEPIPELINEAPPINTG_TILE_CACHE', '0') in ['1', 'yes', 'YES', 'True', 'true']
+
+
+######################################################################################
+def tile_geom_cache_ttl(ttl=None):
+    """ Resolve the age (seconds) for which a snapshot on disk remains valid """
+    if ttl is None:
+        try:
+            ttl = float(os.environ.get('MEPIPELINEAPPINTG_TILE_CACHE_TTL', 86400))
+        except ValueError:
+            ttl = 86400
+    return ttl
+
+
+######################################################################################
+def tile_geom_cache_name(table, dbkey, cachedir=None):
+    """ Form the name of the file holding the snapshot of a COADDTILE_GEOM table
+
+        Inputs:
+            table:      Table name (including schema and/or release prefix)
+            dbkey:      Key identifying the DB (from mepochmisc.db_cache_key)
+            cachedir:   Directory holding the cache (None uses mepochmisc.get_cache_dir)
+
+        Returns:
+            fname:      Name of the snapshot file
+    """
+    tname = table.strip().lower()
+    if tname.endswith('.'):
+        tname = tname[:-1]
+    return os.path.join(get_cache_dir(cachedir), f"tile_geom.{dbkey:s}.{tname:s}.npy")
+
+
+######################################################################################
+def build_tile_geom_cache(table, dbh, dbkey=None, cachedir=None, verbose=0):
+    """ Query a complete COADDTILE_GEOM table and write it as a snapshot.
+        NULL values are recorded in a boolean field (column+NullSuffix) for columns where they occur.
+
+        Inputs:
+            table:      Table name (including schema and/or release prefix)
+            dbh:        Database connection to be used
+            dbkey:      Key identifying the DB (None uses mepochmisc.db_cache_key(dbh))
+            cachedir:   Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            TileGeom:   Structured array (sorted by tilename)
+    """
+    t0 = time.time()
+    query = f"SELECT * FROM {table:s}"
+    if verbose > 0:
+        print(f"# Executing query to snapshot tile geometry: {query:s}")
+
+    curDB = dbh.cursor()
+    curDB.execute(query)
+    desc = [d[0].lower() for d in curDB.description]
+    rows = curDB.fetchall()
+    curDB.close()
+
+    Cols = [(col, ctype) for col, ctype in TileGeomDtype if col in desc]
+    NullCols = [col for col, ctype in Cols if any([row[desc.index(col)] is None for row in rows])]
+    TileGeom = np.zeros(len(rows), dtype=Cols + [(col + NullSuffix, '?') for col in NullCols])
+    for col, ctype in Cols:
+        icol = desc.index(col)
+        fill = '' if TileGeom.dtype[col].kind == 'U' else 0
+        TileGeom[col] = [fill if row[icol] is None else row[icol] for row in rows]
+        if col in NullCols:
+            TileGeom[col + NullSuffix] = [row[icol] is None for row in rows]
+    TileGeom = TileGeom[np.argsort(TileGeom['tilename'], kind='stable')]
+
+    #
+    #   Write to a temporary file then move into place (so a partially written cache is never read).
+    #   Failure to write only means the snapshot is not persisted.
+    #
+    if dbkey is None:
+        dbkey = db_cache_key(dbh)
+    if dbkey is not None:
+        fname = tile_geom_cache_name(table, dbkey, cachedir)
+        tmpfile = f"{fname:s}.tmp{os.getpid():d}"
+        try:
+            with open(tmpfile, 'wb') as fout:
+                np.save(fout, TileGeom)
+            os.replace(tmpfile, fname)
+            if verbose > 0:
+                print(f"# Wrote snapshot of {TileGeom.size:d} tiles to {fname:s}. Execution time: {time.time() - t0:.2f}")
+        except OSError as err:
+            print(f"# Warning: unable to write tile geometry snapshot {fname:s} ({err})")
+
+    return TileGeom
+
+
+######################################################################################
+def load_tile_geom(table, dbh=None, section=None, cachedir=None, ttl=None, rebuild=False, verbose=0):
+    """ Obtain the snapshot of a COADDTILE_GEOM table (from memory, from disk, or by
+        querying the DB when a connection is provided).
+
+        Inputs:
+            table:      Table name (including schema and/or release prefix)
+            dbh:        Database connection (None means the snapshot is not built if absent)
+            section:    DB section (identifies the DB when no connection is given)
+            cachedir:   Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            ttl:        Age (seconds) for which a snapshot on disk is valid (None uses tile_geom_cache_ttl)
+            rebuild:    Force the snapshot to be rebuilt from the DB.
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            TileGeom:   Structured array (sorted by tilename) or None if unavailable
+    """
+    if not tile_geom_cache_enabled():
+        return None
+    dbkey = db_cache_key(dbh, section)
+    if dbkey is None:
+        if verbose > 0:
+            print(f"# Unable to identify the DB for a snapshot of {table:s} (not used)")
+        return None
+
+    tkey = (dbkey, table.strip().lower())
+    if not rebuild and tkey in _TileGeomSnapshots:
+        return _TileGeomSnapshots[tkey]
+
+    TileGeom = None
+    fname = tile_geom_cache_name(table, dbkey, cachedir)
+    if (not rebuild and os.path.isfile(fname)
+            and time.time() - os.path.getmtime(fname) < tile_geom_cache_ttl(ttl)):
+        TileGeom = np.load(fname, mmap_mode='r')
+        if verbose > 0:
+            print(f"# Read tile geometry snapshot ({TileGeom.size:d} tiles) from {fname:s}")
+    elif dbh is not None:
+        TileGeom = build_tile_geom_cache(table, dbh, dbkey=dbkey, cachedir=cachedir, verbose=verbose)
+
+    if TileGeom is not None:
+        _TileGeomSnapshots[tkey] = TileGeom
+
+    return TileGeom
+
+
+######################################################################################
+def lookup_tiles(TileGeom, TileNames):
+    """ Vectorized lookup of tiles in a snapshot
+
+        Inputs:
+            TileGeom:   Structured array (sorted by tilename)
+            TileNames:  Tilename or list/array of tilenames
+
+        Returns:
+            idx:        Array of indices into TileGeom (-1 where a tile is not present)
+    """
+    names = np.atleast_1d(np.asarray(TileNames, dtype=str))
+    if TileGeom is None or TileGeom.size == 0:
+        return np.full(names.size, -1, dtype=int)
+    idx = np.searchsorted(TileGeom['tilename'], names)
+    idx[idx >= TileGeom.size] = TileGeom.size - 1
+    idx[TileGeom['tilename'][idx] != names] = -1
+
+    return idx
+
+
+######################################################################################
+def get_tile_geom(TileNames, table, dbh=None, columns=None, section=None, cachedir=None, verbose=0):
+    """ Obtain geometry for one or more tiles from the snapshot of a COADDTILE_GEOM table.
+
+        Inputs:
+            TileNames:  Tilename or list of tilenames
+            table:      Table name (including schema and/or release prefix)
+            dbh:        Database connection (used to build the snapshot if it is absent)
+            columns:    Columns to return; a list of names or a dict mapping output name to snapshot
+                            column (None returns all columns)
+            section:    DB section (identifies the DB when no connection is given)
+            cachedir:   Directory holding the cache (None uses mepochmisc.get_cache_dir)
+            verbose:    Integer setting level of verbosity when running.
+
+        Returns:
+            TileDict:   Dict (keyed by tilename) with the requested columns for tiles that were found.
+                            Tiles that are absent (or a request for a column not in the snapshot) are
+                            left out so that the caller can fall back to a query.  NULLs are given as None.
+    """
+    TileGeom = load_tile_geom(table, dbh=dbh, section=section, cachedir=cachedir, verbose=verbose)
+    if TileGeom is None:
+        return {}
+
+    if columns is None:
+        ColMap = {col: col for col in TileGeom.dtype.names if not col.endswith(NullSuffix)}
+    elif isinstance(columns, dict):
+        ColMap = columns
+    else:
+        ColMap = {col: col for col in columns}
+    for col in ColMap.values():
+        if col not in TileGeom.dtype.names:
+            if verbose > 0:
+                print(f"# Tile geometry snapshot for {table:s} lacks column {col:s}")
+            return {}
+
+    names = np.atleast_1d(np.asarray(TileNames, dtype=str))
+    idx = lookup_tiles(TileGeom, names)
+    TileDict = {}
+    for name, ix in zip(names.tolist(), idx.tolist()):
+        if ix >= 0:
+            rec = TileGeom[ix]
+            TileDict[name] = {}
+            for outcol, col in ColMap.items():
+                if col + NullSuffix in TileGeom.dtype.names and rec[col + NullSuffix]:
+                    TileDict[name][outcol] = None
+                else:
+                    TileDict[name][outcol] = rec[col].item()
+    if verbose > 0:
+        print(f"# Tile geometry snapshot provided {len(TileDict):d} of {names.size:d} tiles")
+
+    return TileDict